@@ -0,0 +1,175 @@
+import math
+from datetime import datetime, timezone
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class _Window:
+    """Running count/min/max/mean/variance of one field (Welford)."""
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count > 1 else 0.0
+
+
+class EdgeAggregator:
+    """
+    Reduce 1 Hz readings to one summary per window, and report at full rate during events.
+
+    In steady state every `window` seconds (aligned to the UTC clock) yields one record,
+    stamped with the time of its first reading so it cannot overwrite a full-rate point,
+    with the mean of each field under its usual name plus '<field>_min', '<field>_max',
+    '<field>_wstd' and 'samples'. Dashboards that plot MQ4/TGS keep working, they just
+    get fewer points. The window std has its own suffix because '<field>_std' is the std
+    within one burst (BURST_SAMPLES); those of the latest reading are left out.
+
+    Readings with a 'seq' number (see gap_detector.py) are summarised as 'seq' (first)
+    to 'seq_last'. A reading that does not follow the previous one, because one was lost
+    in between or the node restarted, closes the window early, so a summary never hides
+    a hole in the sequence.
+
+    When a trigger field reaches `threshold` ppm, or changes faster than `rate_threshold`
+    ppm/s between two readings, the partial window is sent and every reading is passed
+    through unchanged until no trigger has fired for `hold` seconds.
+    """
+
+    def __init__(self, window=30.0, fields=("MQ4", "TGS", "TGS_voltage"), trigger_fields=("MQ4", "TGS"),
+                 threshold=None, rate_threshold=None, hold=60.0):
+        """
+        Args:
+            window (float): Aggregation window in seconds, 0 passes every reading through
+            fields (tuple): Numeric fields summarised per window
+            trigger_fields (tuple): ppm fields checked by the triggers
+            threshold (float): ppm level that switches to full rate, None to disable
+            rate_threshold (float): ppm/s change that switches to full rate, None to disable
+            hold (float): Seconds to stay at full rate after the last trigger
+        """
+        self.name = "aggregator"
+        self.window = window
+        self.fields = fields
+        self.trigger_fields = trigger_fields
+        self.threshold = threshold
+        self.rate_threshold = rate_threshold
+        self.hold = hold
+        self.windows_sent = 0
+        self.raw_sent = 0
+        self.triggers = 0
+        self._stats = {}
+        self._window_start = None
+        self._window_first = None  # epoch of the first reading in the window
+        self._window_record = None  # latest reading of the window, supplies the other fields
+        self._window_seq = None  # 'seq' of the first reading in the window
+        self._last = None  # (epoch, record) of the previous reading
+        self._full_rate_until = None
+
+    def add(self, record):
+        """
+        Add a reading.
+
+        Returns:
+            list: Records to publish now (none, a window summary and/or the reading itself)
+        """
+        if not self.window:
+            # a window left open when the aggregation was switched off at runtime goes out first
+            out = self.flush()
+            out.append(record)
+            self.raw_sent += 1
+            return out
+        epoch = datetime.strptime(record["timestamp"], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+        triggered = self._triggered(epoch, record)
+        self._last = (epoch, record)
+        if triggered:
+            self.triggers += 1
+            self._full_rate_until = epoch + self.hold
+        if self._full_rate_until is not None and epoch <= self._full_rate_until:
+            out = self.flush()
+            out.append(record)
+            self.raw_sent += 1
+            return out
+        self._full_rate_until = None
+
+        out = []
+        window_start = epoch - epoch % self.window
+        if self._window_start is not None and (window_start != self._window_start or not self._follows(record)):
+            out = self.flush()
+        if self._window_start is None:
+            self._window_first = epoch
+            self._window_seq = record.get("seq")
+        self._window_start = window_start
+        self._window_record = record
+        for field in self.fields:
+            value = record.get(field)
+            if value is not None:
+                self._stats.setdefault(field, _Window()).add(value)
+        return out
+
+    def flush(self):
+        """Summarise the pending window, e.g. before switching to full rate or on shutdown."""
+        if not self._stats:
+            self._window_start = None
+            return []
+        summary = {key: value for key, value in self._window_record.items() if not key.endswith("_std")}
+        summary["timestamp"] = datetime.fromtimestamp(self._window_first, tz=timezone.utc).strftime(TIMESTAMP_FORMAT)
+        summary["samples"] = max(w.count for w in self._stats.values())
+        if self._window_seq is not None:
+            summary["seq"] = self._window_seq
+            summary["seq_last"] = self._window_record["seq"]
+        for field, w in self._stats.items():
+            summary[field] = round(w.mean, 4)
+            summary[f"{field}_min"] = round(w.min, 4)
+            summary[f"{field}_max"] = round(w.max, 4)
+            summary[f"{field}_wstd"] = round(w.std(), 4)
+        self._stats = {}
+        self._window_start = None
+        self.windows_sent += 1
+        return [summary]
+
+    def full_rate(self):
+        """True while an event keeps the aggregator passing readings through."""
+        return self._full_rate_until is not None
+
+    def stats(self):
+        return {
+            "windows": self.windows_sent,
+            "raw": self.raw_sent,
+            "triggers": self.triggers,
+            "full_rate": self.full_rate(),
+        }
+
+    def _follows(self, record):
+        """True unless record and the latest reading of the window both have a seq and are not consecutive."""
+        last = self._window_record
+        if record.get("seq") is None or last.get("seq") is None:
+            return True
+        return record.get("run") == last.get("run") and record["seq"] == last["seq"] + 1
+
+    def _triggered(self, epoch, record):
+        for field in self.trigger_fields:
+            value = record.get(field)
+            if value is None:
+                continue
+            if self.threshold is not None and value >= self.threshold:
+                return True
+            if self.rate_threshold is not None and self._last is not None:
+                last_epoch, last_record = self._last
+                last_value = last_record.get(field)
+                dt = epoch - last_epoch
+                if last_value is not None and dt > 0 and abs(value - last_value) / dt >= self.rate_threshold:
+                    return True
+        return False
@@ -0,0 +1,391 @@
+"""
+Streaming CH4 anomaly and leak detection on the live node topics.
+
+Subscribes to data/# (JSON) and bin/# (wire_format.py) and keeps a small, fixed-size
+state per node and field, so every reading costs O(1) whatever the history:
+    baseline      EWMA mean and variance of MQ4 and TGS; the z-score of each reading
+                  against it. Anomalous readings barely move the baseline, so a slow
+                  leak does not become the new normal within minutes.
+    rise          ppm change over the last ANOMALY_WINDOW readings, from a ring buffer
+    level         absolute ppm threshold
+    disagreement  smoothed |MQ4 - TGS| relative to their mean; both sensors see the same
+                  air, so a lasting disagreement points at a drifting or failed sensor
+
+Alerts are JSON on alert/<location>/<node>, once when a condition starts ("raised") and
+once after it stayed clear for ANOMALY_CLEAR_AFTER readings ("cleared"):
+    {"alert": "MQ4_zscore", "state": "raised", "location": ..., "node": ..., "timestamp": ...,
+     "value": 14.2, "baseline": 2.1, "z": 9.3, "MQ4": 14.2, "TGS": 11.8}
+
+Run next to the server stack (broker settings and ANOMALY_* knobs from .env):
+    python anomaly_detector.py
+Throughput on one core, without a broker:
+    python anomaly_detector.py --bench --nodes 500 --readings 200000
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+import wire_format
+
+load_dotenv()
+
+host = os.getenv("HOST", "localhost")
+port = int(os.getenv("PORT", 1883))
+username = os.getenv("USERNAME", "")
+password = os.getenv("PASSWORD")
+anomaly_alpha = float(os.getenv("ANOMALY_ALPHA", 0.01))
+anomaly_z = float(os.getenv("ANOMALY_Z", 6))
+anomaly_min_std = float(os.getenv("ANOMALY_MIN_STD", 0.2))
+anomaly_window = int(os.getenv("ANOMALY_WINDOW", 60))
+anomaly_rise = float(os.getenv("ANOMALY_RISE_PPM", 5)) or None
+anomaly_level = float(os.getenv("ANOMALY_LEVEL_PPM", 0)) or None
+anomaly_disagreement = float(os.getenv("ANOMALY_DISAGREEMENT", 1.0)) or None
+anomaly_warmup = int(os.getenv("ANOMALY_WARMUP", 300))
+anomaly_clear_after = int(os.getenv("ANOMALY_CLEAR_AFTER", 30))
+stats_interval = float(os.getenv("STATS_INTERVAL", 60))
+
+
+class RingBuffer:
+    """The last `size` values in a preallocated list."""
+
+    __slots__ = ("values", "size", "index", "full")
+
+    def __init__(self, size):
+        self.values = [0.0] * size
+        self.size = size
+        self.index = 0
+        self.full = False
+
+    def append(self, value):
+        """Store a value and return the one it replaced, None while the buffer fills."""
+        index = self.index
+        old = self.values[index] if self.full else None
+        self.values[index] = value
+        index += 1
+        if index == self.size:
+            index = 0
+            self.full = True
+        self.index = index
+        return old
+
+
+class _FieldState:
+    """EWMA baseline and recent values of one field of one node."""
+
+    __slots__ = ("mean", "var", "count", "recent")
+
+    def __init__(self, window):
+        self.mean = 0.0
+        self.var = 0.0
+        self.count = 0
+        self.recent = RingBuffer(window)
+
+    def update(self, value, alpha):
+        if not self.count:
+            self.mean = value
+        else:
+            delta = value - self.mean
+            step = alpha * delta
+            self.mean += step
+            self.var = (1 - alpha) * (self.var + delta * step)
+        self.count += 1
+
+
+class _NodeState:
+    __slots__ = ("fields", "disagreement", "active", "quiet")
+
+    def __init__(self, fields, window):
+        self.fields = {field: _FieldState(window) for field in fields}
+        self.disagreement = 0.0
+        self.active = set()  # alerts currently raised
+        self.quiet = {}  # alert -> readings since its condition last held
+
+
+class AnomalyDetector:
+    """Per-node baselines and alert state for the MQ4/TGS stream."""
+
+    def __init__(self, fields=("MQ4", "TGS"), alpha=0.01, z_threshold=6.0, min_std=0.2, window=60,
+                 rise_threshold=5.0, level_threshold=None, disagreement_threshold=1.0,
+                 disagreement_alpha=0.1, warmup=300, clear_after=30):
+        """
+        Args:
+            fields (tuple): ppm fields to watch, the first two are compared for disagreement
+            alpha (float): EWMA weight of a new reading, ~1/alpha readings of memory
+            z_threshold (float): |z| that raises a '<field>_zscore' alert
+            min_std (float): Lower bound of the baseline std in ppm, keeps flat signals from
+                turning sensor noise into huge z-scores
+            window (int): Readings covered by the rise check
+            rise_threshold (float): ppm increase over `window` readings, None to disable
+            level_threshold (float): ppm level, None to disable
+            disagreement_threshold (float): Smoothed |a - b| / mean(a, b), None to disable
+            disagreement_alpha (float): EWMA weight of the disagreement smoothing
+            warmup (int): Readings per node before baseline and disagreement alerts start
+            clear_after (int): Readings without the condition before an alert is cleared
+        """
+        self.fields = fields
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_std = min_std
+        self.window = window
+        self.rise_threshold = rise_threshold
+        self.level_threshold = level_threshold
+        self.disagreement_threshold = disagreement_threshold if len(fields) > 1 else None
+        self.disagreement_alpha = disagreement_alpha
+        self.warmup = warmup
+        self.clear_after = clear_after
+        self.readings = 0
+        self.messages = 0
+        self.bad_payloads = 0
+        self.alerts_raised = 0
+        self.alerts_cleared = 0
+        self.process_time = 0.0
+        self._nodes = {}
+
+    def handle(self, topic, payload):
+        """
+        Decode one message of data/<location>/sensors/<node> or bin/...
+
+        Returns:
+            list: (topic, alert) pairs to publish
+        """
+        started = time.perf_counter()
+        parts = topic.split("/")
+        try:
+            if len(parts) != 4:
+                raise ValueError("unexpected topic")
+            if parts[0] == "bin":
+                records = wire_format.decode_batch(payload)
+            else:
+                records = json.loads(payload)
+                if not isinstance(records, list):
+                    records = [records]
+            location, node = parts[1], parts[3]
+            alerts = []
+            for record in records:
+                alerts.extend(self.process(location, node, record))
+        except (ValueError, TypeError, AttributeError, IndexError, KeyError, UnicodeDecodeError) as e:
+            self.bad_payloads += 1
+            print(f"dropping bad payload on {topic}: {e}")
+            return []
+        self.messages += 1
+        self.process_time += time.perf_counter() - started
+        alert_topic = f"alert/{location}/{node}"
+        return [(alert_topic, alert) for alert in alerts]
+
+    def process(self, location, node, record):
+        """
+        Update the state of a node with one reading.
+
+        Returns:
+            list: Alerts raised or cleared by this reading
+        """
+        key = (location, node)
+        state = self._nodes.get(key)
+        if state is None:
+            state = self._nodes[key] = _NodeState(self.fields, self.window)
+        self.readings += 1
+        alerts = []
+        warm = True
+        for field, fs in state.fields.items():
+            value = record.get(field)
+            if value is None or value != value:  # missing or NaN
+                continue
+            warm = warm and fs.count >= self.warmup
+            std = max(math.sqrt(fs.var), self.min_std)
+            z = (value - fs.mean) / std if fs.count and fs.count >= self.warmup else 0.0
+            anomalous = abs(z) >= self.z_threshold
+            status = self._transition(state, f"{field}_zscore", anomalous)
+            if status:
+                alerts.append(self._alert(location, node, record, f"{field}_zscore", status,
+                                          value=value, baseline=round(fs.mean, 3), z=round(z, 2)))
+            # an anomaly only nudges the baseline, a lasting step is still learnt eventually
+            fs.update(value, self.alpha * 0.1 if anomalous else self.alpha)
+
+            oldest = fs.recent.append(value)
+            if self.rise_threshold is not None and oldest is not None:
+                rise = value - oldest
+                status = self._transition(state, f"{field}_rise", rise >= self.rise_threshold)
+                if status:
+                    alerts.append(self._alert(location, node, record, f"{field}_rise", status,
+                                              value=value, rise=round(rise, 3), readings=self.window))
+            if self.level_threshold is not None:
+                status = self._transition(state, f"{field}_level", value >= self.level_threshold)
+                if status:
+                    alerts.append(self._alert(location, node, record, f"{field}_level", status,
+                                              value=value, threshold=self.level_threshold))
+
+        if self.disagreement_threshold is not None:
+            a, b = record.get(self.fields[0]), record.get(self.fields[1])
+            if a is not None and b is not None and a == a and b == b:
+                ratio = abs(a - b) / max((abs(a) + abs(b)) / 2, self.min_std)
+                state.disagreement += self.disagreement_alpha * (ratio - state.disagreement)
+                status = self._transition(state, "disagreement",
+                                          warm and state.disagreement >= self.disagreement_threshold)
+                if status:
+                    alerts.append(self._alert(location, node, record, "disagreement", status,
+                                              value=round(state.disagreement, 3)))
+        return alerts
+
+    def _transition(self, state, alert, condition):
+        """Track one alert of a node; returns 'raised', 'cleared' or None."""
+        if condition:
+            if alert in state.active:
+                state.quiet[alert] = 0
+                return None
+            state.active.add(alert)
+            state.quiet[alert] = 0
+            self.alerts_raised += 1
+            return "raised"
+        if alert not in state.active:
+            return None
+        quiet = state.quiet[alert] + 1
+        if quiet < self.clear_after:
+            state.quiet[alert] = quiet
+            return None
+        state.active.discard(alert)
+        del state.quiet[alert]
+        self.alerts_cleared += 1
+        return "cleared"
+
+    def _alert(self, location, node, record, alert, status, **details):
+        alert = {"alert": alert, "state": status, "location": location, "node": node,
+                 "timestamp": record.get("timestamp")}
+        alert.update(details)
+        for field in self.fields:
+            value = record.get(field)
+            if value is not None and value == value:
+                alert[field] = value
+        return alert
+
+    def active(self):
+        """Currently raised alerts, (location, node) -> sorted alert names."""
+        return {key: sorted(state.active) for key, state in self._nodes.items() if state.active}
+
+    def stats(self):
+        return {
+            "nodes": len(self._nodes),
+            "messages": self.messages,
+            "readings": self.readings,
+            "bad_payloads": self.bad_payloads,
+            "alerts_raised": self.alerts_raised,
+            "alerts_cleared": self.alerts_cleared,
+            "alerts_active": sum(len(state.active) for state in self._nodes.values()),
+            "us_per_reading": round(self.process_time / max(self.readings, 1) * 1e6, 2),
+        }
+
+
+def detector_from_env():
+    return AnomalyDetector(alpha=anomaly_alpha, z_threshold=anomaly_z, min_std=anomaly_min_std,
+                           window=anomaly_window, rise_threshold=anomaly_rise, level_threshold=anomaly_level,
+                           disagreement_threshold=anomaly_disagreement, warmup=anomaly_warmup,
+                           clear_after=anomaly_clear_after)
+
+
+def _bench_payloads(nodes, readings, batch_records, leak_nodes, seed=1):
+    """Synthetic data/... payloads, round robin over nodes; leak_nodes get a leak halfway."""
+    rng = random.Random(seed)
+    start = 1714521600
+    per_node = max(readings // nodes, 1)
+    payloads = []
+    for i in range(0, per_node, batch_records):
+        for n in range(nodes):
+            batch = []
+            for j in range(i, min(i + batch_records, per_node)):
+                leak = 40.0 * min(max(j - per_node // 2, 0) / 120, 1) if n < leak_nodes else 0.0
+                mq4 = 2.1 + rng.gauss(0, 0.05) + leak
+                batch.append({
+                    "node": f"{n:03d}",
+                    "MQ4": round(mq4, 3),
+                    "TGS": round(1.9 + rng.gauss(0, 0.05) + leak * 0.8, 3),
+                    "TGS_voltage": 2.1,
+                    "timestamp": datetime.fromtimestamp(start + j, tz=timezone.utc).strftime(
+                        wire_format.TIMESTAMP_FORMAT),
+                })
+            payload = json.dumps(batch[0] if batch_records == 1 else batch)
+            payloads.append((f"data/bench/sensors/{n:03d}", payload))
+    return payloads
+
+
+def bench(nodes, readings, batch_records, leak_nodes):
+    payloads = _bench_payloads(nodes, readings, batch_records, leak_nodes)
+    decoded = [(topic.split("/")[3], json.loads(payload)) for topic, payload in payloads]
+    decoded = [(node, r) for node, records in decoded for r in (records if isinstance(records, list) else [records])]
+
+    detector = detector_from_env()
+    started = time.perf_counter()
+    for node, record in decoded:
+        detector.process("bench", node, record)
+    process_rate = len(decoded) / (time.perf_counter() - started)
+
+    detector = detector_from_env()
+    started = time.perf_counter()
+    alerts = []
+    for topic, payload in payloads:
+        alerts.extend(detector.handle(topic, payload))
+    elapsed = time.perf_counter() - started
+
+    alerted = {alert["node"] for _, alert in alerts if alert["state"] == "raised"}
+    leaking = {f"{n:03d}" for n in range(leak_nodes)}
+    print(f"{len(decoded)} readings from {nodes} nodes in {len(payloads)} messages")
+    print(f"detector only:       {process_rate:>10.0f} readings/s")
+    print(f"with JSON decoding:  {len(decoded) / elapsed:>10.0f} readings/s "
+          f"({elapsed / len(decoded) * 1e6:.2f} us/reading)")
+    print(f"alerts: {detector.alerts_raised} raised, {detector.alerts_cleared} cleared; "
+          f"leaking nodes alerted {len(alerted & leaking)}/{len(leaking)}, "
+          f"false positives on {len(alerted - leaking)} nodes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect CH4 anomalies and leaks on the live data topics")
+    parser.add_argument("--bench", action="store_true", help="measure throughput on synthetic data and exit")
+    parser.add_argument("--nodes", type=int, default=500, help="bench: simulated nodes")
+    parser.add_argument("--readings", type=int, default=200000, help="bench: readings in total")
+    parser.add_argument("--batch-records", type=int, default=1, help="bench: readings per message")
+    parser.add_argument("--leak-nodes", type=int, default=10, help="bench: nodes with a leak halfway through")
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.nodes, args.readings, args.batch_records, args.leak_nodes)
+        raise SystemExit
+
+    detector = detector_from_env()
+
+    def on_connect(client, userdata, flags, rc):
+        _ = userdata, flags
+        if rc != 0:
+            print(f"connect failed: {mqtt.connack_string(rc)}")
+            return
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connected to {host}:{port}")
+        client.subscribe([("data/#", 1), ("bin/#", 1)])
+
+    def on_message(client, userdata, message):
+        _ = userdata
+        for topic, alert in detector.handle(message.topic, message.payload):
+            print(f"{alert['timestamp']} {topic}: {alert['alert']} {alert['state']}")
+            client.publish(topic, json.dumps(alert), qos=1)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="anomaly-detector", clean_session=False)
+    client.username_pw_set(username, password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(1, 60)
+    client.connect_async(host, port)
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(stats_interval)
+            stats = detector.stats()
+            stats["timestamp"] = datetime.utcnow().strftime(wire_format.TIMESTAMP_FORMAT)
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {stats}")
+            client.publish("metrics/server/anomaly_detector", json.dumps(stats))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
@@ -0,0 +1,355 @@
+"""
+Bulk backfill of node archives into InfluxDB, for data that never made it over MQTT.
+
+Reads the daily node{node}_YYYYMMDD.csv (+ _voltage.csv) and .bin archives and the loss
+queue (node{node}_loss_data.db, or the old _loss_data.csv) and writes them as line
+protocol straight to InfluxDB, in large gzip-compressed batches from parallel worker
+processes. Points are shaped like the ones Telegraf writes for the live JSON readings:
+measurement 'mqtt_consumer', tags host=<--host-tag> and topic=data/<location>/sensors/<node>,
+float fields MQ4, TGS, TGS_voltage, second precision. A point only replaces a live one if
+the host tag matches too: the default is the hostname pinned in telegraf.conf, while
+points Telegraf wrote before that carry its container id (pass that id, or '' for a
+Telegraf running with omit_hostname = true).
+
+Re-running is safe. InfluxDB keeps one point per series and timestamp, duplicate
+timestamps within a file are dropped, a day that has both a .csv and a .bin archive is
+read from the .bin only, and loss queue rows are skipped for days whose archive is part
+of the run (the archives hold every sample). Progress is checkpointed per file after
+every written batch, so an interrupted run continues where it stopped. Archives are
+checkpointed by row number; the loss queue deletes acked rows, so it is checkpointed by
+row id and read again after that id on every run.
+
+Example:
+    python backfill.py --location lab /mnt/node04/CH4_data --workers 4
+    python backfill.py --location lab node04_20240501.csv node04_20240502.bin --dry-run
+"""
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import re
+import time
+
+import influxdb_client
+from dotenv import load_dotenv
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+
+import binary_archive
+from loss_queue import LossQueue
+from wire_format import epoch_ms
+
+load_dotenv()
+
+influx_url = os.getenv("INFLUX_URL", "http://localhost:8086")
+influx_token = os.getenv("INFLUX_TOKEN", "")
+influx_org = os.getenv("INFLUX_ORG", "bblab")
+influx_bucket = os.getenv("INFLUX_BUCKET", "sensor_data")
+influx_host_tag = os.getenv("INFLUX_HOST_TAG", "telegraf")
+
+ARCHIVE_RE = re.compile(r"^node(?P<node>.+?)_(?P<day>\d{8})\.(?P<ext>csv|bin)$")
+LOSS_RE = re.compile(r"^node(?P<node>.+?)_loss_data\.(?P<ext>csv|db)$")
+
+_write_api = None  # one client per worker process, see _init_worker
+
+
+def find_sources(paths):
+    """
+    Expand files and directories into backfill units.
+
+    Returns:
+        list: dicts with 'path', 'kind' ('csv', 'bin', 'loss_csv' or 'loss_db'), 'node' and 'day'
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+    archives = {}
+    losses = []
+    for path in files:
+        name = os.path.basename(path)
+        match = ARCHIVE_RE.match(name)
+        if match:
+            key = (match["node"], match["day"])
+            # prefer the .bin archive of a day, it holds the same samples as the .csv
+            if match["ext"] == "bin" or key not in archives:
+                archives[key] = {"path": path, "kind": match["ext"], "node": key[0], "day": key[1]}
+            continue
+        match = LOSS_RE.match(name)
+        if match:
+            losses.append({"path": path, "kind": "loss_" + match["ext"], "node": match["node"], "day": None})
+    units = list(archives.values())
+    for unit in losses:
+        unit["covered_days"] = sorted(day for node, day in archives if node == unit["node"])
+        units.append(unit)
+    return units
+
+
+def _number(value):
+    """Parse a CSV value; returns None for empty or non-finite values."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number == number and abs(number) != float("inf") else None
+
+
+def read_csv_archive(path):
+    """Yield (timestamp, MQ4, TGS, TGS_voltage) from a daily ppm CSV and its _voltage.csv."""
+    voltages = {}
+    voltage_path = path[:-len(".csv")] + "_voltage.csv"
+    if os.path.exists(voltage_path):
+        with open(voltage_path, 'r', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) == 3 and row[0] != "time":
+                    voltages[row[0]] = _number(row[2])
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) != 3 or row[0] == "time":
+                continue
+            yield row[0], _number(row[1]), _number(row[2]), voltages.get(row[0])
+
+
+def read_bin_archive(path):
+    records = binary_archive.open_archive(path)
+    for start in range(0, len(records), 65536):
+        chunk = records[start:start + 65536]
+        # float32 values, rounded to 7 digits so 2.1 is not written as 2.0999999046325684
+        for time_ms, mq4, tgs, tgs_voltage in zip(
+            chunk["time_ms"].tolist(), chunk["MQ4"].tolist(), chunk["TGS"].tolist(), chunk["TGS_voltage"].tolist()
+        ):
+            yield time_ms, float(f"{mq4:.7g}"), float(f"{tgs:.7g}"), float(f"{tgs_voltage:.7g}")
+
+
+def read_loss_csv(path):
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) >= 3:
+                yield row[0], _number(row[1]), _number(row[2]), None
+
+
+def read_loss_db(path, after_id=0):
+    """Yield (row id, timestamp, MQ4, TGS, TGS_voltage) of the queued rows with an id above after_id."""
+    queue = LossQueue(path)
+    try:
+        last_id = after_id if queue.last_id() >= after_id else 0  # a new database counts from 1 again
+        while True:
+            rows = queue.peek(10000, after_id=last_id)
+            if not rows:
+                break
+            for row_id, record in rows:
+                yield row_id, record.get("timestamp"), record.get("MQ4"), record.get("TGS"), record.get("TGS_voltage")
+            last_id = rows[-1][0]
+    finally:
+        queue.close()
+
+
+READERS = {"csv": read_csv_archive, "bin": read_bin_archive, "loss_csv": read_loss_csv}
+
+
+def read_unit(unit, resume):
+    """
+    Yield (position, timestamp, MQ4, TGS, TGS_voltage) of the rows after the checkpointed position.
+
+    The position is the row number in a file, and the row id in a loss database: acked
+    rows are deleted from the queue, so row numbers shift between runs but ids do not.
+    """
+    if unit["kind"] == "loss_db":
+        yield from read_loss_db(unit["path"], resume)
+        return
+    for position, row in enumerate(READERS[unit["kind"]](unit["path"]), start=1):
+        if position > resume:
+            yield (position,) + row
+
+
+def to_line(tags, timestamp, mq4, tgs, tgs_voltage):
+    """
+    Format one reading as line protocol, or None if it has no usable value.
+
+    Args:
+        tags (str): Measurement and tags, e.g. 'mqtt_consumer,host=telegraf,topic=data/lab/sensors/04'
+        timestamp: ISO 'YYYY-mm-ddTHH:MM:SSZ' string or epoch milliseconds
+    """
+    fields = []
+    for name, value in (("MQ4", mq4), ("TGS", tgs), ("TGS_voltage", tgs_voltage)):
+        if value is not None and value == value:
+            fields.append(f"{name}={float(value)!r}")
+    if not fields:
+        return None
+    seconds = timestamp // 1000 if isinstance(timestamp, int) else epoch_ms(timestamp) // 1000
+    return f"{tags} {','.join(fields)} {seconds}"
+
+
+class Checkpoint:
+    """Progress of one source file (see read_unit()), stored as a small JSON file replaced atomically."""
+
+    def __init__(self, directory, location, unit):
+        # keyed by the absolute path: CH4_data directories of different nodes hold the same file names
+        source = os.path.realpath(unit["path"])
+        key = hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+        self.path = os.path.join(directory, f"{location}_{os.path.basename(source)}_{key}.json")
+        self.size = os.path.getsize(unit["path"])
+        self.position = 0
+        self.done = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            self.position = state["position"]
+            # a file that grew since (e.g. today's archive) continues after the rows already sent
+            self.done = state["done"] and state["size"] == self.size
+
+    def save(self, position, done=False):
+        self.position = position
+        self.done = done
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"position": position, "size": self.size, "done": done}, f)
+        os.replace(tmp, self.path)
+
+
+def _init_worker(url, token, org, gzip):
+    global _write_api
+    if url is not None:
+        client = influxdb_client.InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip, timeout=120000)
+        _write_api = client.write_api(write_options=SYNCHRONOUS)
+
+
+def write_batch(lines, bucket, org, max_retries, retry_interval):
+    """Write one batch, retrying server and connection errors with exponential backoff and jitter."""
+    body = "\n".join(lines)
+    for attempt in range(max_retries + 1):
+        try:
+            _write_api.write(bucket=bucket, org=org, record=body, write_precision=influxdb_client.WritePrecision.S)
+            return
+        except ApiException as e:
+            if e.status is not None and 400 <= e.status < 500 and e.status != 429:
+                raise
+            error = e
+        except OSError as e:
+            error = e
+        if attempt < max_retries:
+            delay = retry_interval * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay / 2))
+    raise error
+
+
+def backfill_unit(unit, args):
+    """
+    Backfill one source file (runs in a worker process).
+
+    Returns:
+        dict: unit path, rows read, points written, duplicates, skipped rows and seconds taken
+    """
+    started = time.monotonic()
+    checkpoint = Checkpoint(args.checkpoint_dir, args.location, unit)
+    result = {"path": unit["path"], "rows": 0, "points": 0, "duplicates": 0, "skipped": 0,
+              "resumed": checkpoint.position}
+    if checkpoint.done and not args.restart:
+        result["seconds"] = 0.0
+        return result
+    resume = 0 if args.restart else checkpoint.position
+    tags = "mqtt_consumer" + (f",host={args.host_tag}" if args.host_tag else "")
+    tags += f",topic=data/{args.location}/sensors/{unit['node']}"
+    covered = set(unit.get("covered_days", ()))
+    seen = set()
+    lines = []
+    position = resume
+    for position, timestamp, mq4, tgs, tgs_voltage in read_unit(unit, resume):
+        result["rows"] += 1
+        if timestamp is None:
+            result["skipped"] += 1
+            continue
+        if covered:
+            day = (time.strftime('%Y%m%d', time.gmtime(timestamp // 1000)) if isinstance(timestamp, int)
+                   else timestamp[:10].replace("-", ""))
+            if day in covered:
+                result["skipped"] += 1
+                continue
+        if timestamp in seen:
+            result["duplicates"] += 1
+            continue
+        seen.add(timestamp)
+        try:
+            line = to_line(tags, timestamp, mq4, tgs, tgs_voltage)
+        except ValueError:
+            line = None
+        if line is None:
+            result["skipped"] += 1
+            continue
+        lines.append(line)
+        if len(lines) >= args.batch_size:
+            _flush(lines, unit, args, result)
+            checkpoint.save(position)
+            lines = []
+    if lines:
+        _flush(lines, unit, args, result)
+    # a loss database keeps changing whatever its size, it is never done
+    checkpoint.save(position, done=unit["kind"] != "loss_db")
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def _flush(lines, unit, args, result):
+    if not args.dry_run:
+        write_batch(lines, args.bucket, influx_org, args.max_retries, args.retry_interval)
+    result["points"] += len(lines)
+
+
+def _run(job):
+    unit, args = job
+    try:
+        return backfill_unit(unit, args)
+    except ApiException as e:
+        return {"path": unit["path"], "error": f"HTTP {e.status} {e.reason}: {e.body}"}
+    except Exception as e:
+        return {"path": unit["path"], "error": f"{type(e).__name__}: {e}"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill node archives into InfluxDB")
+    parser.add_argument("paths", nargs="+", help="archive files or CH4_data directories")
+    parser.add_argument("--location", required=True, help="LOCATION of the node(s), used in the topic tag")
+    parser.add_argument("--node", help="only backfill this node")
+    parser.add_argument("--host-tag", default=influx_host_tag,
+                        help="host tag Telegraf writes (its hostname), '' if it runs with omit_hostname = true")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=50000, help="points per write request")
+    parser.add_argument("--bucket", default=influx_bucket)
+    parser.add_argument("--checkpoint-dir", default="backfill_checkpoints")
+    parser.add_argument("--restart", action="store_true", help="ignore existing checkpoints")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--retry-interval", type=float, default=2.0, help="seconds before the first retry")
+    parser.add_argument("--no-gzip", action="store_true")
+    parser.add_argument("--dry-run", action="store_true", help="read and format everything, write nothing")
+    args = parser.parse_args()
+
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    units = [u for u in find_sources(args.paths) if args.node is None or u["node"] == args.node]
+    print(f"{len(units)} files to backfill into {args.bucket} with {args.workers} workers")
+
+    started = time.monotonic()
+    totals = {"rows": 0, "points": 0, "duplicates": 0, "skipped": 0}
+    failed = []
+    init_args = (None, None, None, None) if args.dry_run else (influx_url, influx_token, influx_org, not args.no_gzip)
+    with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=init_args) as pool:
+        for result in pool.imap_unordered(_run, [(unit, args) for unit in units]):
+            if "error" in result:
+                failed.append(result)
+                print(f"{result['path']}: FAILED {result['error']}")
+                continue
+            for key in totals:
+                totals[key] += result[key]
+            resumed = f", resumed after row {result['resumed']}" if result["resumed"] and result["rows"] else ""
+            print(f"{result['path']}: {result['points']} points, {result['duplicates']} duplicates, "
+                  f"{result['skipped']} skipped in {result['seconds']:.1f} s{resumed}")
+    elapsed = time.monotonic() - started
+    print(f"total: {totals['points']} points from {totals['rows']} rows in {elapsed:.1f} s "
+          f"({totals['points'] / max(elapsed, 1e-9):.0f} points/s), {totals['duplicates']} duplicates, "
+          f"{totals['skipped']} skipped, {len(failed)} files failed")
+    if failed:
+        raise SystemExit(1)
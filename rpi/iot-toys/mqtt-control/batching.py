@@ -0,0 +1,97 @@
+import json
+import time
+
+
+def encode_batch(records):
+    """
+    Encode readings as one MQTT payload.
+
+    A single reading is sent as a plain JSON object like before; several readings are
+    sent as a JSON array. Telegraf's json parser turns every array element into its own
+    metric, so both forms land in InfluxDB the same way.
+    """
+    if len(records) == 1:
+        return json.dumps(records[0])
+    return json.dumps(records)
+
+
+def split_batches(records, max_records, max_bytes):
+    """
+    Split readings into chunks that respect the batch limits.
+
+    Args:
+        records (list): Readings (dicts) in the order they should be sent
+        max_records (int): Maximum readings per payload
+        max_bytes (int): Maximum encoded payload size; a single bigger reading is still sent alone
+
+    Returns:
+        list: Lists of readings, one per payload
+    """
+    batches = []
+    current = []
+    size = 2  # the enclosing brackets
+    for record in records:
+        record_size = len(json.dumps(record)) + 1  # plus the separating comma
+        if current and (len(current) >= max_records or size + record_size > max_bytes):
+            batches.append(current)
+            current = []
+            size = 2
+        current.append(record)
+        size += record_size
+    if current:
+        batches.append(current)
+    return batches
+
+
+class PayloadBatcher:
+    """
+    Collect live readings until a batch is full or has waited long enough.
+
+    A batch is released when it holds max_records readings, when adding the next reading
+    would exceed max_bytes, or when its oldest reading is max_latency seconds old.
+    With max_records=1 every reading is released immediately.
+    """
+
+    def __init__(self, max_records=1, max_bytes=16384, max_latency=10.0):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self._records = []
+        self._size = 2
+        self._first_added = None
+
+    def add(self, record):
+        """
+        Add a reading.
+
+        Returns:
+            list: Batches (lists of readings) that are ready to be published
+        """
+        ready = []
+        record_size = len(json.dumps(record)) + 1
+        if self._records and self._size + record_size > self.max_bytes:
+            ready.append(self.flush())
+        if not self._records:
+            self._first_added = time.monotonic()
+        self._records.append(record)
+        self._size += record_size
+        if len(self._records) >= self.max_records:
+            ready.append(self.flush())
+        elif self.is_due():
+            ready.append(self.flush())
+        return ready
+
+    def is_due(self):
+        """True when the pending batch has waited max_latency seconds."""
+        return bool(self._records) and time.monotonic() - self._first_added >= self.max_latency
+
+    def flush(self):
+        """Release the pending readings, even if the batch is not full."""
+        records = self._records
+        self._records = []
+        self._size = 2
+        self._first_added = None
+        return records
+
+    def __len__(self):
+        return len(self._records)
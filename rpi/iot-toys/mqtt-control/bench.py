@@ -0,0 +1,171 @@
+"""
+Throughput benchmark of the node's sample -> log -> publish path without hardware.
+
+Example:
+    python bench.py --samples 20000 --batch-records 60 --offline-every 5000
+    python bench.py --samples 20000 --agg-window 30 --agg-threshold 5000
+    python bench.py --replay /home/pi/CH4_data/node04_20240501_voltage.csv
+"""
+import argparse
+import contextlib
+import io
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import sim
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return f"p50 {p50:.3f} ms  p95 {p95:.3f} ms  p99 {p99:.3f} ms  max {max(values) * 1000:.3f} ms"
+
+
+def timed(stage, latencies):
+    # Items are submitted as (submit time, item); record queue wait + handling time
+    handler = stage.handler
+
+    def run(item):
+        submitted, payload = item
+        handler(payload)
+        latencies.append(time.perf_counter() - submitted)
+
+    stage.handler = run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the node pipeline against simulated sensors and broker")
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=0, help="samples/s to pace the sampler at (0 = as fast as possible)")
+    parser.add_argument("--replay", nargs="*", help="_voltage.csv archives to replay instead of synthetic data")
+    parser.add_argument("--batch-records", type=int, default=1)
+    parser.add_argument("--agg-window", type=float, default=0, help="edge aggregation window in seconds (0 = off)")
+    parser.add_argument("--agg-threshold", type=float, default=0, help="ppm that switches aggregation to full rate")
+    parser.add_argument("--wire-format", default="json", choices=["json", "binary"])
+    parser.add_argument("--archive-format", default="csv", choices=["csv", "bin", "both"])
+    parser.add_argument("--queue-size", type=int, default=600)
+    parser.add_argument("--offline-every", type=int, default=0, help="toggle the broker connection every N samples")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="ch4_bench_")
+    # node_client_thread reads its settings at import time
+    os.environ.update({
+        "NODE": os.environ.get("NODE", "99"),
+        "LOCATION": os.environ.get("LOCATION", "bench"),
+        "DATA_DIR": data_dir,
+        "BATCH_MAX_RECORDS": str(args.batch_records),
+        "ARCHIVE_FORMAT": args.archive_format,
+        "WIRE_FORMAT": args.wire_format,
+        "AGG_WINDOW": str(args.agg_window),
+        "AGG_PPM_THRESHOLD": str(args.agg_threshold),
+        "QUEUE_SIZE": str(args.queue_size),
+    })
+    import node_client_thread as nct
+    from aggregation import EdgeAggregator
+    from batching import PayloadBatcher
+    from lcd_worker import LcdWorker
+    from loss_queue import LossQueue
+    from publisher import ReliablePublisher
+
+    client = sim.FakeMqttClient()
+    nct.client = client
+    nct.mqtt_connected.set()
+
+    if args.replay:
+        chan0, chan1 = sim.replay_channels(args.replay)
+    else:
+        chan0 = sim.FakeChannel(sim.synthetic_voltage(1.2, spike_rate=0.001, seed=1))
+        chan1 = sim.FakeChannel(sim.synthetic_voltage(2.1, spike_rate=0.001, seed=2))
+    # arbitrated like the real devices, to include the arbiter in the timings
+    chan0 = nct.i2c_arbiter.wrap(chan0, "ads1115")
+    chan1 = nct.i2c_arbiter.wrap(chan1, "ads1115")
+    lcd = nct.i2c_arbiter.wrap(sim.FakeLCD(), "lcd", nct.DISPLAY)
+    lcd_worker = LcdWorker(lcd, refresh_hz=nct.lcd_refresh_hz, metrics=nct.metrics).start()
+    mq4_sensor, tgs_sensor, burst_sampler = nct.setup_sensors(sim.FakeADS(), chan0, chan1)
+
+    loss_queue = LossQueue(os.path.join(data_dir, f"node{nct.node}_loss_data.db"))
+    aggregator = EdgeAggregator(nct.agg_window, threshold=nct.agg_ppm_threshold,
+                                rate_threshold=nct.agg_rate_threshold, hold=nct.agg_hold)
+    batcher = PayloadBatcher(nct.batch_max_records, nct.batch_max_bytes, nct.batch_max_latency)
+    publisher = ReliablePublisher(
+        client, loss_queue, nct.data_topic(), qos=nct.mqtt_qos,
+        max_inflight=nct.mqtt_max_inflight, max_records=nct.batch_max_records,
+        max_bytes=nct.batch_max_bytes, read_size=nct.loss_batch_size, encode=nct.payload_encoder(),
+    )
+    client.on_publish = publisher.on_publish
+    archive_writers = nct.open_archive_writers()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    sample_latency, writer_latency, uploader_latency = [], [], []
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        writer, uploader = nct.start_stages(archive_writers, aggregator, batcher, publisher)
+        timed(writer, writer_latency)
+        timed(uploader, uploader_latency)
+
+        period = 1.0 / args.rate if args.rate else 0
+        start = time.perf_counter()
+        for i in range(args.samples):
+            if args.offline_every and i and i % args.offline_every == 0:
+                client.connected = not client.connected
+                if client.connected:
+                    nct.mqtt_connected.set()
+                else:
+                    nct.mqtt_connected.clear()
+            t0 = time.perf_counter()
+            sample, record = nct.take_sample(mq4_sensor, tgs_sensor, burst_sampler)
+            lcd_worker.show(*nct.lcd_lines(sample))
+            t1 = time.perf_counter()
+            writer.submit((t1, sample))
+            uploader.submit((t1, record))
+            sample_latency.append(time.perf_counter() - t0)
+            if period:
+                delay = start + (i + 1) * period - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        sampled = time.perf_counter() - start
+
+        client.connected = True
+        nct.mqtt_connected.set()
+        lcd_worker.stop()
+        nct.stop_stages(writer, uploader, archive_writers, aggregator, batcher, publisher)
+        while len(loss_queue) and publisher.pump():
+            pass
+        drained = time.perf_counter() - start
+
+    heap_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f"samples:        {args.samples} in {sampled:.2f} s -> {args.samples / sampled:.0f} samples/s")
+    print(f"drained after:  {drained:.2f} s -> {args.samples / drained:.0f} samples/s end to end")
+    print(f"sample+lcd:     {percentiles(sample_latency)}")
+    print(f"writer stage:   {percentiles(writer_latency)}")
+    print(f"uploader stage: {percentiles(uploader_latency)}")
+    print(f"stages:         writer {writer.stats()}")
+    print(f"                uploader {uploader.stats()}")
+    print(f"aggregator:     {aggregator.stats()}")
+    print(f"publisher:      {publisher.stats()}")
+    print(f"lcd:            {lcd_worker.stats()}")
+    print(f"i2c:            {nct.i2c_arbiter.stats()}")
+    timers = nct.metrics.snapshot()
+    print("timers (p50 / p99 / max ms):")
+    for name in sorted(key[:-len("_count")] for key in timers if key.endswith("_count")):
+        print(f"    {name:<16}{timers[name + '_count']:>8}x  {timers[name + '_p50_ms']:>8} / "
+              f"{timers[name + '_p99_ms']:>8} / {timers[name + '_max_ms']:>8}")
+    print(f"broker:         {client.messages} messages, {client.bytes} bytes "
+          f"({client.bytes / max(client.messages, 1):.0f} bytes/message)")
+    print(f"backlog left:   {len(loss_queue)}")
+    print(f"memory:         max RSS {max_rss_kb / 1024:.1f} MiB"
+          + (f", Python heap peak {heap_peak / 1024 / 1024:.1f} MiB" if heap_peak is not None else ""))
+
+    loss_queue.close()
+    shutil.rmtree(data_dir)
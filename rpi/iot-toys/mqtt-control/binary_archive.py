@@ -0,0 +1,276 @@
+import argparse
+import csv
+import math
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+# One fixed-width little-endian record per sample (24 bytes)
+RECORD_DTYPE = np.dtype([
+    ("time_ms", "<i8"),
+    ("MQ4", "<f4"),
+    ("TGS", "<f4"),
+    ("MQ4_voltage", "<f4"),
+    ("TGS_voltage", "<f4"),
+])
+RECORD_STRUCT = struct.Struct("<qffff")
+
+# Sidecar index: (time_ms, record number) of every INDEX_STRIDE-th record
+INDEX_DTYPE = np.dtype([("time_ms", "<i8"), ("record", "<i8")])
+INDEX_STRUCT = struct.Struct("<qq")
+INDEX_STRIDE = 60
+
+
+def to_epoch_ms(timestamp):
+    """Convert a naive UTC datetime to epoch milliseconds."""
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def index_path(path):
+    return path[:-len(".bin")] + ".idx" if path.endswith(".bin") else path + ".idx"
+
+
+class DailyBinaryWriter:
+    """
+    Append samples to node{node}_YYYYMMDD.bin files, one per UTC day.
+
+    Behaves like DailyCsvWriter (buffered, flush_interval, optional fsync) and also
+    maintains the .idx file next to every data file. Timestamps come from the wall clock,
+    which an NTP step can set back on a Pi without RTC. Once a record is older than the
+    previous one, the .idx file is emptied, so readers scan the whole file instead of
+    bisecting. On close the file is sorted and its index rebuilt.
+    """
+
+    def __init__(self, path_template, flush_interval=10.0, fsync=False, buffer_size=65536):
+        """
+        Args:
+            path_template (str): File path with a '{date}' field, filled with YYYYMMDD
+            flush_interval (float): Seconds between flushes to the OS
+            fsync (bool): Also fsync on every flush
+            buffer_size (int): Size of the file buffer in bytes
+        """
+        self.path_template = path_template
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        self.path = None
+        self._file = None
+        self._index = None
+        self._day = None
+        self._count = 0
+        self._last_ms = None
+        self._sorted = True
+        self._last_flush = time.monotonic()
+
+    def write(self, sample):
+        """Append a sample dict with 'time' (UTC datetime), 'MQ4', 'TGS', 'MQ4_voltage' and 'TGS_voltage'."""
+        timestamp = sample["time"]
+        day = timestamp.strftime('%Y%m%d')
+        if day != self._day:
+            self._rotate(day)
+        time_ms = to_epoch_ms(timestamp)
+        if self._sorted and self._last_ms is not None and time_ms < self._last_ms:
+            # the clock stepped back: an index over unsorted records would mislead read_range()
+            self._sorted = False
+            self._index.truncate(0)
+        self._last_ms = time_ms
+        if self._sorted and self._count % INDEX_STRIDE == 0:
+            self._index.write(INDEX_STRUCT.pack(time_ms, self._count))
+        self._file.write(RECORD_STRUCT.pack(
+            time_ms, *(math.nan if sample[field] is None else sample[field]
+                       for field in ("MQ4", "TGS", "MQ4_voltage", "TGS_voltage"))
+        ))
+        self._count += 1
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._file is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        for f in (self._file, self._index):
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._index = None
+            self._day = None
+            if not self._sorted:
+                sort_archive(self.path)
+                self._sorted = True
+
+    def _rotate(self, day):
+        self.close()
+        self.path = self.path_template.format(date=day)
+        self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        # Drop a half-written record left by a power cut so records stay aligned
+        size = self._file.tell()
+        if size % RECORD_DTYPE.itemsize:
+            self._file.truncate(size - size % RECORD_DTYPE.itemsize)
+            self._file.seek(0, os.SEEK_END)
+        self._count = self._file.tell() // RECORD_DTYPE.itemsize
+        self._last_ms = None
+        if self._count:
+            times = open_archive(self.path)["time_ms"]
+            self._last_ms = int(times.max())
+            if np.any(np.diff(times) < 0):
+                # left unsorted by a clock step and a crash before close()
+                del times
+                self._file.close()
+                sort_archive(self.path)
+                self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        self._index = open(index_path(self.path), 'ab')
+        expected = (self._count + INDEX_STRIDE - 1) // INDEX_STRIDE * INDEX_STRUCT.size
+        if self._index.tell() != expected:
+            self._index.close()
+            rebuild_index(self.path)
+            self._index = open(index_path(self.path), 'ab')
+        self._day = day
+
+
+def open_archive(path):
+    """Memory-map a .bin file as a structured NumPy array (empty array for an empty file)."""
+    if os.path.getsize(path) < RECORD_DTYPE.itemsize:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+
+
+def rebuild_index(path):
+    """Write the .idx file of a .bin file from scratch."""
+    records = open_archive(path)
+    index = np.empty((len(records) + INDEX_STRIDE - 1) // INDEX_STRIDE, dtype=INDEX_DTYPE)
+    index["record"] = np.arange(0, len(records), INDEX_STRIDE)
+    index["time_ms"] = records["time_ms"][::INDEX_STRIDE]
+    index.tofile(index_path(path))
+
+
+def sort_archive(path):
+    """Sort the records of a .bin file by time (stable) and rebuild its index."""
+    records = np.fromfile(path, dtype=RECORD_DTYPE)
+    if len(records) and np.any(np.diff(records["time_ms"]) < 0):
+        records[np.argsort(records["time_ms"], kind='stable')].tofile(path)
+    rebuild_index(path)
+
+
+def read_range(path, start_ms, end_ms):
+    """
+    Read the records of one .bin file with start_ms <= time_ms < end_ms.
+
+    The .idx file narrows the read down to the index blocks that overlap the range,
+    so only those pages of the data file are touched. An empty or missing .idx file
+    (records out of order, see DailyBinaryWriter) means a full scan.
+
+    Returns:
+        numpy.ndarray: Structured array with RECORD_DTYPE fields
+    """
+    records = open_archive(path)
+    idx_file = index_path(path)
+    lo, hi = 0, len(records)
+    if os.path.exists(idx_file):
+        index = np.fromfile(idx_file, dtype=INDEX_DTYPE)
+        if len(index):
+            first = np.searchsorted(index["time_ms"], start_ms, side='right') - 1
+            last = np.searchsorted(index["time_ms"], end_ms, side='left')
+            lo = int(index["record"][max(first, 0)])
+            hi = int(index["record"][last]) if last < len(index) else len(records)
+    block = records[lo:hi]
+    mask = (block["time_ms"] >= start_ms) & (block["time_ms"] < end_ms)
+    return np.array(block[mask])
+
+
+def query(directory, node, start, end):
+    """
+    Read all records of a node between two UTC datetimes from its daily .bin files.
+
+    Returns:
+        numpy.ndarray: Structured array with RECORD_DTYPE fields
+    """
+    start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+    parts = []
+    day = datetime(start.year, start.month, start.day)
+    while day < end:
+        path = os.path.join(directory, f"node{node}_{day.strftime('%Y%m%d')}.bin")
+        if os.path.exists(path):
+            parts.append(read_range(path, start_ms, end_ms))
+        day += timedelta(days=1)
+    if not parts:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.concatenate(parts)
+
+
+def convert_csv(csv_path, bin_path=None):
+    """
+    Convert a daily node{node}_YYYYMMDD.csv archive (plus its _voltage.csv) to a .bin file.
+
+    Voltages are matched to ppm rows by timestamp; rows without a voltage get NaN.
+
+    Returns:
+        str: Path of the written .bin file
+    """
+    bin_path = bin_path or csv_path[:-len(".csv")] + ".bin"
+    voltage_path = csv_path[:-len(".csv")] + "_voltage.csv"
+    voltages = {}
+    if os.path.exists(voltage_path):
+        with open(voltage_path, 'r') as f:
+            for row in csv.reader(f):
+                if len(row) == 3 and row[0] != "time":
+                    voltages[row[0]] = (float(row[1]), float(row[2]))
+    with open(csv_path, 'r') as f, open(bin_path, 'wb') as out:
+        for row in csv.reader(f):
+            if len(row) != 3 or row[0] == "time":
+                continue
+            timestamp = datetime.strptime(row[0], '%Y-%m-%dT%H:%M:%SZ')
+            mq4_voltage, tgs_voltage = voltages.get(row[0], (float("nan"), float("nan")))
+            out.write(RECORD_STRUCT.pack(
+                to_epoch_ms(timestamp), float(row[1]), float(row[2]), mq4_voltage, tgs_voltage
+            ))
+    # Old archives may contain clock jumps, the range search needs sorted records
+    sort_archive(bin_path)
+    return bin_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binary CH4 archive tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_convert = sub.add_parser("convert", help="convert daily CSV archives to .bin")
+    p_convert.add_argument("csv_files", nargs="+", help="node{node}_YYYYMMDD.csv files")
+    p_query = sub.add_parser("query", help="print a time range as CSV")
+    p_query.add_argument("--dir", default="/home/pi/CH4_data")
+    p_query.add_argument("--node", required=True)
+    p_query.add_argument("--start", required=True, help="UTC, e.g. 2024-05-01T00:00:00")
+    p_query.add_argument("--end", required=True, help="UTC, e.g. 2024-05-02T00:00:00")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        for csv_file in args.csv_files:
+            if csv_file.endswith("_voltage.csv"):
+                continue
+            print(f"{csv_file} -> {convert_csv(csv_file)}")
+    else:
+        records = query(
+            args.dir, args.node,
+            datetime.fromisoformat(args.start), datetime.fromisoformat(args.end),
+        )
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["time", "MQ4", "TGS2611", "MQ4_voltage", "TGS2611_voltage"])
+        for r in records:
+            timestamp = datetime.fromtimestamp(r["time_ms"] / 1000, tz=timezone.utc)
+            writer.writerow([
+                timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                round(float(r["MQ4"]), 3), round(float(r["TGS"]), 3),
+                round(float(r["MQ4_voltage"]), 3), round(float(r["TGS_voltage"]), 3),
+            ])
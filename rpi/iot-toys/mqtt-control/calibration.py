@@ -0,0 +1,124 @@
+import argparse
+import csv
+import os
+
+import numpy as np
+
+# Defaults match the values the nodes shipped with; override them per node in .env
+DEFAULT_CALIBRATION = {
+    "mq4": {"r0": 3.323, "a": 1000.0, "b": -2.95},
+    "tgs": {"r0": 0.679, "intercept": 1.4402, "slope": -0.3849},
+}
+
+# Supply voltage of the sensor divider
+VC = 5.0
+
+
+def load_calibration(env=os.environ):
+    """
+    Read this node's curve coefficients from the environment.
+
+    Keys: MQ4_R0, MQ4_CURVE_A, MQ4_CURVE_B, TGS_R0, TGS_CURVE_INTERCEPT, TGS_CURVE_SLOPE.
+
+    Returns:
+        dict: {'mq4': {...}, 'tgs': {...}}, usable as keyword arguments of the curve functions
+    """
+    mq4 = DEFAULT_CALIBRATION["mq4"]
+    tgs = DEFAULT_CALIBRATION["tgs"]
+    return {
+        "mq4": {
+            "r0": float(env.get("MQ4_R0", mq4["r0"])),
+            "a": float(env.get("MQ4_CURVE_A", mq4["a"])),
+            "b": float(env.get("MQ4_CURVE_B", mq4["b"])),
+        },
+        "tgs": {
+            "r0": float(env.get("TGS_R0", tgs["r0"])),
+            "intercept": float(env.get("TGS_CURVE_INTERCEPT", tgs["intercept"])),
+            "slope": float(env.get("TGS_CURVE_SLOPE", tgs["slope"])),
+        },
+    }
+
+
+def rs_ratio(voltage, r0, vc=VC):
+    """
+    Rs/R0 for sensor output voltage(s), with Rs in units of the load resistor.
+
+    NaN where the voltage is outside (0, vc), e.g. an unplugged sensor reading slightly
+    negative on the ADS1115, so the curves below return NaN there instead of inf or junk.
+    """
+    voltage = np.asarray(voltage, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (vc / voltage - 1) / r0
+    return np.where((voltage > 0) & (voltage < vc), ratio, np.nan)
+
+
+def mq4_ppm(voltage, r0, a=1000.0, b=-2.95, vc=VC):
+    """MQ-4 CH4 concentration: ppm = a * (Rs/R0)**b. Accepts scalars or arrays."""
+    return a * rs_ratio(voltage, r0, vc) ** b
+
+
+def tgs2611_ppm(voltage, r0, intercept=1.4402, slope=-0.3849, vc=VC):
+    """TGS2611 CH4 concentration: log10(Rs/R0) = intercept + slope * log10(ppm). Accepts scalars or arrays."""
+    return 10 ** ((np.log10(rs_ratio(voltage, r0, vc)) - intercept) / slope)
+
+
+def mq4_ratio(ppm, a=1000.0, b=-2.95):
+    """Rs/R0 of the MQ-4 at a given ppm, the inverse of mq4_ppm()."""
+    return (ppm / a) ** (1 / b)
+
+
+def tgs2611_ratio(ppm, intercept=1.4402, slope=-0.3849):
+    """Rs/R0 of the TGS2611 at a given ppm, the inverse of tgs2611_ppm()."""
+    return 10 ** (intercept + slope * np.log10(ppm))
+
+
+def rederive_voltage_csv(voltage_csv, out_csv, calibration):
+    """
+    Recompute the ppm values of a node{node}_YYYYMMDD_voltage.csv archive.
+
+    The whole file is converted with one vectorized call per sensor.
+
+    Args:
+        voltage_csv (str): Input voltage archive
+        out_csv (str): Output file, same layout as the daily ppm archive
+        calibration (dict): Coefficients as returned by load_calibration()
+
+    Returns:
+        int: Number of rows written
+    """
+    with open(voltage_csv, 'r') as f:
+        node = next(csv.reader(f))[1]
+    data = np.genfromtxt(
+        voltage_csv, delimiter=',', skip_header=2, dtype=None, encoding='utf-8',
+        names=("time", "mq4", "tgs"),
+    )
+    data = np.atleast_1d(data)
+    mq4 = np.round(mq4_ppm(data["mq4"], **calibration["mq4"]), 3)
+    tgs = np.round(tgs2611_ppm(data["tgs"], **calibration["tgs"]), 3)
+    with open(out_csv, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["node", node])
+        writer.writerow(["time", "MQ4", "TGS2611"])
+        # out-of-range voltages give NaN, written as empty cells like the node does
+        writer.writerows(
+            (t, m if m == m else None, g if g == g else None)
+            for t, m, g in zip(data["time"], mq4.tolist(), tgs.tolist())
+        )
+    return len(data)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Re-derive ppm archives from _voltage.csv files")
+    parser.add_argument("voltage_files", nargs="+", help="node{node}_YYYYMMDD_voltage.csv files")
+    parser.add_argument("--out-dir", default=".", help="where to write the re-derived ppm files")
+    args = parser.parse_args()
+
+    calibration = load_calibration()
+    print(f"calibration: {calibration}")
+    for path in args.voltage_files:
+        name = os.path.basename(path).replace("_voltage.csv", "_rederived.csv")
+        out = os.path.join(args.out_dir, name)
+        print(f"{path} -> {out} ({rederive_voltage_csv(path, out, calibration)} rows)")
@@ -0,0 +1,199 @@
+"""
+Scriptable control of many nodes, the fleet-scale replacement for iotctl.py.
+
+A command is one JSON message per location on ctl/<location>/thi:
+    {"id": "...", "cmd": "start" | "stop" | "ping" | "set", "nodes": "<glob>", "config": {...}}
+Every node checks the glob itself, so reaching hundreds of nodes costs one publish per
+location. Matching nodes answer on log/<location>/thi/<node> with a JSON ack carrying the
+command id, ok/error, whether they are running and their current settings. Acks are
+collected until the timeout, or until --expect nodes have answered.
+
+Settings for 'set': sample_period, mq4_r0, tgs_r0, agg_window, agg_ppm_threshold,
+agg_rate_threshold, agg_hold, metrics_interval. Nodes keep them across restarts in
+node<node>_config.json next to their archives.
+
+Example:
+    python fleetctl.py --location farm1 --location farm2 ping
+    python fleetctl.py --location farm1 --nodes '0[1-4]' set sample_period=2 agg_window=30
+    python fleetctl.py --location farm1 --nodes 07 --expect 1 stop
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+load_dotenv()
+
+host = os.getenv("HOST", "")
+port = int(os.getenv("PORT", 1883))
+username = os.getenv("USERNAME", "")
+password = os.getenv("PASSWORD")
+
+
+class FleetController:
+    """Send commands to node sets and collect their acknowledgements."""
+
+    def __init__(self, client):
+        """
+        Args:
+            client: Connected paho Client with its network loop running (VERSION1 callbacks)
+        """
+        self.client = client
+        self._subscribed = set()
+        self._pending_subs = {}  # mid -> Event
+        self._acks = {}  # command id -> {(location, node): ack}
+        self._cond = threading.Condition()
+        client.on_message = self._on_message
+        client.on_subscribe = self._on_subscribe
+
+    def send(self, locations, cmd, nodes="*", config=None, timeout=5.0, expect=None):
+        """
+        Send a command to the matching nodes of every location and wait for acks.
+
+        Args:
+            locations (list): Locations to address
+            cmd (str): start, stop, ping or set
+            nodes (str): Glob matched against the NODE of each node, e.g. '0*'
+            config (dict): Settings for 'set'
+            timeout (float): Seconds to wait for acks
+            expect (int): Return as soon as this many nodes have answered
+
+        Returns:
+            dict: (location, node) -> ack dict
+        """
+        for location in locations:
+            self._subscribe(f"log/{location}/thi/+", timeout)
+        command_id = uuid.uuid4().hex[:12]
+        command = {"id": command_id, "cmd": cmd, "nodes": nodes}
+        if config:
+            command["config"] = config
+        payload = json.dumps(command)
+        with self._cond:
+            self._acks[command_id] = {}
+        for location in locations:
+            self.client.publish(f"ctl/{location}/thi", payload, qos=1)
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                acks = self._acks[command_id]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (expect is not None and len(acks) >= expect):
+                    break
+                self._cond.wait(remaining)
+            return self._acks.pop(command_id)
+
+    def _subscribe(self, topic, timeout):
+        if topic in self._subscribed:
+            return
+        # register the event before subscribing, the suback can arrive before subscribe() returns
+        done = threading.Event()
+        with self._cond:
+            rc, mid = self.client.subscribe(topic, qos=1)
+            self._pending_subs[mid] = done
+        if rc != mqtt.MQTT_ERR_SUCCESS or not done.wait(timeout):
+            raise RuntimeError(f"could not subscribe to {topic}")
+        self._subscribed.add(topic)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        _ = client, userdata, granted_qos
+        with self._cond:
+            done = self._pending_subs.pop(mid, None)
+        if done is not None:
+            done.set()
+
+    def _on_message(self, client, userdata, message):
+        _ = client, userdata
+        try:
+            ack = json.loads(message.payload)
+        except ValueError:
+            return  # "True"/"False" answers to plain start/stop
+        if not isinstance(ack, dict):
+            return
+        with self._cond:
+            acks = self._acks.get(ack.get("id"))
+            if acks is None:
+                return  # late answer to a command that already timed out
+            acks[(ack.get("location"), str(ack.get("node")))] = ack
+            self._cond.notify_all()
+
+
+def parse_settings(pairs):
+    config = {}
+    for pair in pairs:
+        name, sep, value = pair.partition("=")
+        if not sep:
+            raise ValueError(f"expected name=value, got {pair!r}")
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError(f"{name} must be a number, got {value!r}") from None
+        # float() takes 'nan' and 'inf', which json.dumps would send as NaN/Infinity
+        if not math.isfinite(number) or number < 0:
+            raise ValueError(f"{name} must be a finite, non-negative number")
+        config[name] = number
+    return config
+
+
+def connect(timeout=10.0):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"fleetctl-{uuid.uuid4().hex[:8]}")
+    client.username_pw_set(username, password)
+    connected = threading.Event()
+    client.on_connect = lambda c, u, f, rc: connected.set() if rc == 0 else None
+    client.connect(host, port)
+    client.loop_start()
+    if not connected.wait(timeout):
+        raise SystemExit(f"could not connect to {host}:{port}")
+    return client
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control and configure fleets of nodes")
+    parser.add_argument("--location", action="append", help="location to address, repeatable (default: LOCATION)")
+    parser.add_argument("--nodes", default="*", help="glob of node ids, e.g. '0*' or '1[0-9]'")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for acks")
+    parser.add_argument("--expect", type=int, help="stop waiting once this many nodes answered")
+    parser.add_argument("--json", action="store_true", help="print the raw acks, one JSON object per line")
+    parser.add_argument("cmd", choices=["start", "stop", "ping", "set"])
+    parser.add_argument("settings", nargs="*", help="name=value pairs for set")
+    args = parser.parse_args()
+    locations = args.location or [os.getenv("LOCATION")]
+    if args.cmd == "set" and not args.settings:
+        parser.error("set needs at least one name=value")
+    try:
+        config = parse_settings(args.settings) if args.cmd == "set" else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    client = connect()
+    controller = FleetController(client)
+    started = time.monotonic()
+    acks = controller.send(locations, args.cmd, args.nodes, config, args.timeout, args.expect)
+    elapsed = time.monotonic() - started
+    client.loop_stop()
+    client.disconnect()
+
+    failed = 0
+    for (location, node), ack in sorted(acks.items()):
+        if args.json:
+            print(json.dumps(ack))
+            continue
+        state = "running" if ack.get("running") else "stopped"
+        if ack.get("ok"):
+            print(f"{location}/{node}: ok, {state}, {ack.get('config')}")
+        else:
+            failed += 1
+            print(f"{location}/{node}: FAILED {ack.get('error')}")
+    failed += sum(1 for ack in acks.values() if args.json and not ack.get("ok"))
+    missing = max(args.expect - len(acks), 0) if args.expect is not None else 0
+    print(f"{len(acks)} nodes answered in {elapsed:.1f} s, {failed} failed"
+          + (f", {missing} of {args.expect} expected did not answer" if missing else ""), file=sys.stderr)
+    if failed or missing:
+        raise SystemExit(1)
@@ -0,0 +1,313 @@
+"""
+Server-side gap detection and targeted resync of node readings.
+
+Every published record carries 'run' (epoch seconds at which the node process started)
+and 'seq' (0, 1, 2, ... within the run), stamped when the reading is taken, so readings
+dropped anywhere on the node show up as holes. Window summaries of the edge aggregation
+cover 'seq' to 'seq_last'. The detector subscribes to data/# and bin/#
+and keeps, per node and run, the received sequence numbers as merged intervals with the
+timestamps at their edges. A hole between two intervals, or before the first one of a
+run that started while the detector was watching, is a set of lost records. They might
+be a truncated backlog, a message dropped on the way, or readings lost in a crash.
+
+Late arrivals are normal: the node replays its backlog after an outage. A hole is
+therefore only requested once it stayed open for GAP_GRACE seconds. The request is a
+JSON command on ctl/<location>/thi, the control topic of fleetctl.py:
+    {"id": ..., "cmd": "resync", "nodes": "<node>", "run": ..., "seq_from": 120, "seq_to": 131,
+     "start": "2024-05-01T10:02:01Z", "end": "2024-05-01T10:14:00Z"}
+The node re-sends the readings of [start, end) from its daily archives through its
+normal store-and-forward path and acks on log/<location>/thi/<node> with the number of
+records. The hole is then closed. Unanswered requests are repeated every GAP_RETRY
+seconds, up to GAP_MAX_ATTEMPTS times.
+
+Run next to the server stack:
+    python gap_detector.py
+"""
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+import wire_format
+
+load_dotenv()
+
+host = os.getenv("HOST", "localhost")
+port = int(os.getenv("PORT", 1883))
+username = os.getenv("USERNAME", "")
+password = os.getenv("PASSWORD")
+gap_grace = float(os.getenv("GAP_GRACE", 300))
+gap_retry = float(os.getenv("GAP_RETRY", 600))
+gap_max_attempts = int(os.getenv("GAP_MAX_ATTEMPTS", 5))
+gap_check_interval = float(os.getenv("GAP_CHECK_INTERVAL", 30))
+stats_interval = float(os.getenv("STATS_INTERVAL", 60))
+
+
+class _Run:
+    """Received sequence numbers of one run of one node, as merged [lo, hi, t_lo, t_hi] intervals."""
+
+    __slots__ = ("run", "intervals", "watched_start", "holes")
+
+    def __init__(self, run, watched_start):
+        self.run = run
+        self.intervals = []
+        self.watched_start = watched_start  # the run began while we were listening
+        self.holes = {}  # seq_from -> {"seen", "requested", "attempts", "id"}
+
+    def add(self, seq, t):
+        """Record a sequence number; returns False for a duplicate."""
+        intervals = self.intervals
+        # the common case: the next number of the newest interval
+        if intervals and intervals[-1][1] + 1 == seq:
+            intervals[-1][1] = seq
+            intervals[-1][3] = t
+            return True
+        i = bisect_left(intervals, [seq])
+        if i > 0 and intervals[i - 1][1] >= seq:
+            return False
+        if i < len(intervals) and intervals[i][0] == seq:
+            return False
+        self.fill(seq, seq, t, t)
+        return True
+
+    def fill(self, lo, hi, t_lo, t_hi):
+        """Insert [lo, hi] and merge it with the intervals it touches."""
+        intervals = self.intervals
+        i = bisect_left(intervals, [lo])
+        if i > 0 and intervals[i - 1][1] + 1 >= lo:
+            i -= 1
+            lo, t_lo = intervals[i][0], intervals[i][2]
+        j = i
+        while j < len(intervals) and intervals[j][0] <= hi + 1:
+            if intervals[j][1] > hi:
+                hi, t_hi = intervals[j][1], intervals[j][3]
+            j += 1
+        intervals[i:j] = [[lo, hi, t_lo, t_hi]]
+
+    def gaps(self):
+        """Yield (seq_from, seq_to, start, end) of every hole; start/end bound its timestamps."""
+        previous = None
+        for lo, hi, t_lo, t_hi in self.intervals:
+            if previous is None:
+                if lo > 0 and self.watched_start:
+                    # min(): a node without RTC may start with a clock that is corrected later
+                    yield 0, lo - 1, min(self.run, t_lo), t_lo
+            else:
+                yield previous[1] + 1, lo - 1, previous[3] + 1, t_lo
+            previous = (lo, hi, t_lo, t_hi)
+
+
+class GapDetector:
+    """Track sequence numbers per node and turn lasting holes into resync requests."""
+
+    def __init__(self, grace=300.0, retry=600.0, max_attempts=5, max_runs=4, now=None):
+        """
+        Args:
+            grace (float): Seconds a hole may stay open before it is requested
+            retry (float): Seconds before an unanswered request is repeated
+            max_attempts (int): Requests per hole before it is given up
+            max_runs (int): Runs kept per node, older ones are forgotten
+            now (float): Start time of the detector, runs that began earlier have no known start
+        """
+        self.grace = grace
+        self.retry = retry
+        self.max_attempts = max_attempts
+        self.max_runs = max_runs
+        self.started = time.time() if now is None else now
+        self.records = 0
+        self.unsequenced = 0
+        self.duplicates = 0
+        self.bad_payloads = 0
+        self.requests = 0
+        self.resynced = 0
+        self.resynced_records = 0
+        self.unrecoverable = 0
+        self.abandoned = 0
+        self._nodes = {}  # (location, node) -> {run: _Run}
+        self._requests = {}  # request id -> (location, node, run, seq_from, seq_to, start, end)
+        self._lock = threading.Lock()
+
+    def handle(self, topic, payload):
+        """Take one message of data/..., bin/... or log/<location>/thi/<node> (resync acks)."""
+        parts = topic.split("/")
+        if parts[0] == "log":
+            self._handle_ack(payload)
+            return
+        try:
+            if len(parts) != 4:
+                raise ValueError("unexpected topic")
+            if parts[0] == "bin":
+                records = wire_format.decode_batch(payload)
+            else:
+                records = json.loads(payload)
+                if not isinstance(records, list):
+                    records = [records]
+            readings = [(int(r["run"]), int(r["seq"]), int(r.get("seq_last", r["seq"])),
+                         wire_format.epoch_ms(r["timestamp"]) // 1000)
+                        if "seq" in r else None for r in records]
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError, UnicodeDecodeError) as e:
+            self.bad_payloads += 1
+            print(f"dropping bad payload on {topic}: {e}")
+            return
+        key = (parts[1], parts[3])
+        with self._lock:
+            runs = self._nodes.setdefault(key, {})
+            for reading in readings:
+                self.records += 1
+                if reading is None:
+                    self.unsequenced += 1  # older firmware, or readings re-sent by a resync
+                    continue
+                run_id, seq, seq_last, t = reading
+                run = runs.get(run_id)
+                if run is None:
+                    if runs and run_id < min(runs) and len(runs) >= self.max_runs:
+                        continue  # a backlog of a run we already forgot
+                    run = runs[run_id] = _Run(run_id, run_id >= self.started)
+                    while len(runs) > self.max_runs:
+                        del runs[min(runs)]
+                if seq_last > seq:
+                    # a window summary; only its first reading's time is known, so a hole after it
+                    # is requested from that time on, which re-sends a little more rather than less
+                    run.fill(seq, seq_last, t, t)
+                elif not run.add(seq, t):
+                    self.duplicates += 1
+
+    def check(self, now=None):
+        """
+        Find holes older than the grace period.
+
+        Returns:
+            list: (topic, command) resync requests to publish
+        """
+        now = time.time() if now is None else now
+        requests = []
+        with self._lock:
+            for (location, node), runs in self._nodes.items():
+                for run in runs.values():
+                    current = set()
+                    for seq_from, seq_to, start, end in run.gaps():
+                        current.add(seq_from)
+                        hole = run.holes.get(seq_from)
+                        if hole is None:
+                            run.holes[seq_from] = {"seen": now, "requested": None, "attempts": 0, "id": None}
+                            continue
+                        if now - hole["seen"] < self.grace:
+                            continue
+                        if hole["requested"] is not None and now - hole["requested"] < self.retry:
+                            continue
+                        if hole["attempts"] >= self.max_attempts:
+                            if hole["attempts"] == self.max_attempts:
+                                hole["attempts"] += 1
+                                self.abandoned += 1
+                                print(f"giving up on {location}/{node} run {run.run} seq {seq_from}-{seq_to}")
+                            continue
+                        self._requests.pop(hole["id"], None)
+                        hole["id"] = uuid.uuid4().hex[:12]
+                        hole["requested"] = now
+                        hole["attempts"] += 1
+                        self._requests[hole["id"]] = (location, node, run.run, seq_from, seq_to, start, end)
+                        self.requests += 1
+                        requests.append((f"ctl/{location}/thi", {
+                            "id": hole["id"], "cmd": "resync", "nodes": glob.escape(node), "run": run.run,
+                            "seq_from": seq_from, "seq_to": seq_to,
+                            "start": time.strftime(wire_format.TIMESTAMP_FORMAT, time.gmtime(start)),
+                            "end": time.strftime(wire_format.TIMESTAMP_FORMAT, time.gmtime(end)),
+                        }))
+                    # holes that were filled by late arrivals
+                    for seq_from in set(run.holes) - current:
+                        self._requests.pop(run.holes.pop(seq_from)["id"], None)
+        return requests
+
+    def _handle_ack(self, payload):
+        try:
+            ack = json.loads(payload)
+        except ValueError:
+            return  # "True"/"False" answers to plain start/stop
+        if not isinstance(ack, dict) or ack.get("cmd") != "resync":
+            return
+        with self._lock:
+            request = self._requests.pop(ack.get("id"), None)
+            if request is None:
+                return
+            location, node, run_id, seq_from, seq_to, start, end = request
+            if not ack.get("ok"):
+                print(f"resync of {location}/{node} seq {seq_from}-{seq_to} failed: {ack.get('error')}")
+                return  # asked again after the retry interval
+            run = self._nodes.get((location, node), {}).get(run_id)
+            if run is None:
+                return
+            # the archives are all the node has, close the hole whatever they held
+            run.holes.pop(seq_from, None)
+            run.fill(seq_from, seq_to, start, end)
+            records = ack.get("records", 0)
+            self.resynced += 1
+            self.resynced_records += records
+            if not records:
+                self.unrecoverable += 1
+            print(f"resynced {location}/{node} seq {seq_from}-{seq_to}: {records} records from the archives")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "nodes": len(self._nodes),
+                "records": self.records,
+                "unsequenced": self.unsequenced,
+                "duplicates": self.duplicates,
+                "bad_payloads": self.bad_payloads,
+                "open_gaps": sum(len(list(run.gaps())) for runs in self._nodes.values() for run in runs.values()),
+                "requests": self.requests,
+                "resynced": self.resynced,
+                "resynced_records": self.resynced_records,
+                "unrecoverable": self.unrecoverable,
+                "abandoned": self.abandoned,
+            }
+
+
+if __name__ == "__main__":
+    detector = GapDetector(gap_grace, gap_retry, gap_max_attempts)
+
+    def on_connect(client, userdata, flags, rc):
+        _ = userdata, flags
+        if rc != 0:
+            print(f"connect failed: {mqtt.connack_string(rc)}")
+            return
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connected to {host}:{port}")
+        client.subscribe([("data/#", 1), ("bin/#", 1), ("log/+/thi/+", 1)])
+
+    def on_message(client, userdata, message):
+        _ = client, userdata
+        detector.handle(message.topic, message.payload)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="gap-detector", clean_session=False)
+    client.username_pw_set(username, password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(1, 60)
+    client.connect_async(host, port)
+    client.loop_start()
+    last_stats = time.monotonic()
+    try:
+        while True:
+            time.sleep(gap_check_interval)
+            for topic, command in detector.check():
+                print(f"requesting {command['nodes']} seq {command['seq_from']}-{command['seq_to']} "
+                      f"({command['start']} - {command['end']}) on {topic}")
+                client.publish(topic, json.dumps(command), qos=1)
+            if time.monotonic() - last_stats >= stats_interval:
+                last_stats = time.monotonic()
+                stats = detector.stats()
+                stats["timestamp"] = datetime.utcnow().strftime(wire_format.TIMESTAMP_FORMAT)
+                print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {stats}")
+                client.publish("metrics/server/gap_detector", json.dumps(stats))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
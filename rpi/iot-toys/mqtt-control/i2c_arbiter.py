@@ -0,0 +1,153 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import Histogram
+
+# Lower numbers are served first
+SENSOR = 0
+DISPLAY = 1
+
+
+class I2CArbiter:
+    """
+    Serialize the devices on one I2C bus, sensors before the display.
+
+    The ADS1115, the LCD backpack, the SHT20 and the SGP30 share the bus but are driven
+    by different libraries and threads. Every access goes through use(), directly or
+    through a wrap()ped device. Waiting threads are served by priority, so a sensor read
+    waits for at most one display transaction, never for a queue of them. Within a
+    priority, waiters for the device that just used the bus go first, up to max_batch
+    grants in a row, so back-to-back reads of one device are not interleaved with others.
+    use() is reentrant: nest several reads in one use() to keep the bus for all of them.
+
+    Bus time, transactions and wait times are kept per device, see stats().
+    """
+
+    def __init__(self, max_batch=8):
+        """
+        Args:
+            max_batch (int): Consecutive grants to one device while others of the same priority wait
+        """
+        self.name = "i2c"
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._owner = None
+        self._depth = 0
+        self._waiting = []  # [priority, ticket, device] of the threads waiting for the bus
+        self._ticket = 0
+        self._last_device = None
+        self._batch = 0
+        self._devices = {}  # device -> [transactions, busy seconds, hold Histogram, wait Histogram]
+        self._last_stats = time.monotonic()
+
+    @contextmanager
+    def use(self, device, priority=SENSOR):
+        """Hold the bus for `device` for the duration of the block."""
+        if self._owner == threading.get_ident():
+            # nested in a transaction of this thread, which already holds the bus
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        requested = time.perf_counter()
+        self._acquire(device, priority)
+        granted = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(device, granted - requested, time.perf_counter() - granted)
+
+    def wrap(self, target, device, priority=SENSOR):
+        """Proxy of a driver object whose method calls and property reads each hold the bus."""
+        return _Arbitrated(self, target, device, priority)
+
+    def stats(self):
+        """Per device transactions, bus time per second and wait/hold percentiles since the last call."""
+        now = time.monotonic()
+        with self._cond:
+            devices, self._devices = self._devices, {}
+            elapsed = max(now - self._last_stats, 1e-9)
+            self._last_stats = now
+        stats = {"utilization": round(sum(d[1] for d in devices.values()) / elapsed, 4)}
+        for device, (transactions, busy, hold, wait) in sorted(devices.items()):
+            stats[f"{device}_transactions"] = transactions
+            stats[f"{device}_busy_ms_per_s"] = round(busy * 1000 / elapsed, 3)
+            stats[f"{device}_hold_p95_ms"] = hold.percentile(0.95)
+            stats[f"{device}_wait_p95_ms"] = wait.percentile(0.95)
+            stats[f"{device}_wait_max_ms"] = round(wait.max, 3)
+        return stats
+
+    def _acquire(self, device, priority):
+        with self._cond:
+            if self._owner is None and not self._waiting:
+                self._grant(device)
+                return
+            self._ticket += 1
+            entry = [priority, self._ticket, device]
+            self._waiting.append(entry)
+            while self._owner is not None or self._next() is not entry:
+                self._cond.wait()
+            self._waiting.remove(entry)
+            self._grant(device)
+
+    def _grant(self, device):
+        self._owner = threading.get_ident()
+        self._depth = 1
+        if device == self._last_device:
+            self._batch += 1
+        else:
+            self._last_device = device
+            self._batch = 1
+
+    def _next(self):
+        best = min(self._waiting)
+        if self._batch < self.max_batch:
+            same = [e for e in self._waiting if e[0] == best[0] and e[2] == self._last_device]
+            if same:
+                return min(same)
+        return best
+
+    def _release(self, device, wait, hold):
+        with self._cond:
+            entry = self._devices.get(device)
+            if entry is None:
+                entry = self._devices[device] = [0, 0.0, Histogram(), Histogram()]
+            entry[0] += 1
+            entry[1] += hold
+            entry[2].observe(hold * 1000)
+            entry[3].observe(wait * 1000)
+            self._owner = None
+            self._depth = 0
+            self._cond.notify_all()
+
+
+class _Arbitrated:
+    """See I2CArbiter.wrap(). Plain attributes pass through, properties such as AnalogIn.voltage hold the bus."""
+
+    def __init__(self, arbiter, target, device, priority):
+        object.__setattr__(self, "_arbiter", arbiter)
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_device", device)
+        object.__setattr__(self, "_priority", priority)
+
+    def __getattr__(self, name):
+        target = self._target
+        if isinstance(getattr(type(target), name, None), property):
+            with self._arbiter.use(self._device, self._priority):
+                return getattr(target, name)
+        value = getattr(target, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with self._arbiter.use(self._device, self._priority):
+                return value(*args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        # driver setters may write registers (ads.gain, ads.mode, ...)
+        with self._arbiter.use(self._device, self._priority):
+            setattr(self._target, name, value)
@@ -0,0 +1,359 @@
+"""
+MQTT -> InfluxDB ingestion bridge, an alternative to Telegraf's mqtt_consumer.
+
+Subscribes to the node topics, decodes JSON (data/...) and binary (bin/..., see
+wire_format.py) payloads and writes them through the client's batching WriteApi, with
+configurable batch size, flush interval, retries with jitter and exponential backoff.
+Batches that still fail (InfluxDB down longer than the retry budget) go to a SQLite
+spool on disk and are written again once InfluxDB answers. A batch InfluxDB rejects as
+malformed is split in halves until only the offending points are dropped. Points look
+like the ones Telegraf writes: measurement 'mqtt_consumer', tags 'topic' (data/...) and
+'host' (INFLUX_HOST_TAG), float fields (see WireBridge.to_point()).
+
+Throughput, lag and spool size are printed and published as JSON to
+metrics/server/influx_bridge every STATS_INTERVAL seconds.
+
+Remove "data/#" from telegraf.conf when running it, or both will write the same points:
+    python influx_bridge.py
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import influxdb_client
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+from influxdb_client.client.write_api import SYNCHRONOUS, WriteOptions
+from influxdb_client.rest import ApiException
+
+import wire_format
+from loss_queue import LossQueue
+from wire_bridge import WireBridge
+
+load_dotenv()
+
+host = os.getenv("HOST", "localhost")
+port = int(os.getenv("PORT", 1883))
+username = os.getenv("USERNAME", "")
+password = os.getenv("PASSWORD")
+influx_url = os.getenv("INFLUX_URL", "http://localhost:8086")
+influx_token = os.getenv("INFLUX_TOKEN", "")
+influx_org = os.getenv("INFLUX_ORG", "bblab")
+influx_bucket = os.getenv("INFLUX_BUCKET", "sensor_data")
+influx_host_tag = os.getenv("INFLUX_HOST_TAG", "telegraf")
+bridge_topics = [t for t in os.getenv("BRIDGE_TOPICS", "data/#,bin/#").split(",") if t]
+bridge_batch_size = int(os.getenv("BRIDGE_BATCH_SIZE", 5000))
+bridge_flush_interval = int(os.getenv("BRIDGE_FLUSH_INTERVAL_MS", 1000))
+bridge_jitter = int(os.getenv("BRIDGE_JITTER_MS", 500))
+bridge_retry_interval = int(os.getenv("BRIDGE_RETRY_INTERVAL_MS", 5000))
+bridge_max_retries = int(os.getenv("BRIDGE_MAX_RETRIES", 5))
+bridge_max_retry_delay = int(os.getenv("BRIDGE_MAX_RETRY_DELAY_MS", 60000))
+bridge_spool = os.getenv("BRIDGE_SPOOL", "influx_bridge_spool.db")
+spool_retry_interval = float(os.getenv("BRIDGE_SPOOL_RETRY_INTERVAL", 30))
+stats_interval = float(os.getenv("STATS_INTERVAL", 60))
+
+
+def decode_payload(topic, payload):
+    """
+    Decode a node payload into readings.
+
+    data/... carries a JSON object or array (as Telegraf's json parser reads it),
+    bin/... a wire_format payload.
+
+    Raises:
+        ValueError: The payload is malformed or a reading is not a JSON object
+    """
+    if topic.startswith("bin/"):
+        return wire_format.decode_batch(payload)
+    records = json.loads(payload)
+    records = records if isinstance(records, list) else [records]
+    if not all(isinstance(record, dict) for record in records):
+        raise ValueError("readings must be JSON objects")
+    return records
+
+
+def is_permanent(exception):
+    """True for errors a retry cannot fix, e.g. 400 for malformed points or 401 for a bad token."""
+    status = getattr(exception, "status", None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def is_bad_data(exception):
+    """True when InfluxDB refused the points themselves (400 malformed, 422 e.g. a field type conflict)."""
+    return getattr(exception, "status", None) in (400, 422)
+
+
+def describe(exception):
+    """One-line description; ApiException's str() includes the response headers."""
+    status = getattr(exception, "status", None)
+    return f"HTTP {status} {getattr(exception, 'reason', '')}".strip() if status else str(exception)
+
+
+def newest_timestamp(data):
+    """Newest point time (epoch seconds) in a line protocol batch written with WritePrecision.S."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return max(int(line.rsplit(" ", 1)[1]) for line in data.splitlines() if line)
+
+
+class InfluxBridge:
+    """Turn MQTT messages into points, write them in batches and spool what cannot be written."""
+
+    def __init__(self, influx, bucket, org, spool, batch_size=5000, flush_interval=1000, jitter=500,
+                 retry_interval=5000, max_retries=5, max_retry_delay=60000, host=None):
+        """
+        Args:
+            influx (InfluxDBClient): Client of the target InfluxDB
+            bucket (str): Bucket to write to
+            org (str): Organization of the bucket
+            spool (LossQueue): Durable store for batches that failed after all retries
+            batch_size (int): Points per write request
+            flush_interval (int): Milliseconds before a partial batch is written
+            jitter (int): Milliseconds of random delay added to flushes and retries
+            retry_interval (int): Milliseconds before the first retry, doubled on every further one
+            max_retries (int): Retries before a batch goes to the spool
+            max_retry_delay (int): Upper bound of the retry delay in milliseconds
+            host (str): 'host' tag of the points, the hostname Telegraf writes with
+        """
+        self.bucket = bucket
+        self.host = host
+        self.org = org
+        self.spool = spool
+        self.messages = 0
+        self.points_received = 0
+        self.points_written = 0
+        self.batches_written = 0
+        self.retries = 0
+        self.batches_spooled = 0
+        self.batches_rejected = 0
+        self.points_rejected = 0
+        self.spool_replayed = 0
+        self.bad_payloads = 0
+        self.receive_lag = 0.0  # seconds between a reading's timestamp and its arrival, worst since last stats
+        self.write_lag = 0.0  # seconds between a reading's timestamp and its write, worst since last stats
+        self._lock = threading.Lock()
+        self._last_stats = (time.monotonic(), 0, 0)
+        self._stop = threading.Event()
+        self._sync_write = influx.write_api(write_options=SYNCHRONOUS)
+        self.write_api = influx.write_api(
+            write_options=WriteOptions(
+                batch_size=batch_size,
+                flush_interval=flush_interval,
+                jitter_interval=jitter,
+                retry_interval=retry_interval,
+                max_retries=max_retries,
+                max_retry_delay=max_retry_delay,
+                exponential_base=2,
+            ),
+            success_callback=self._on_success,
+            error_callback=self._on_error,
+            retry_callback=self._on_retry,
+        )
+        self._spool_thread = threading.Thread(target=self._drain_spool, name="spool", daemon=True)
+
+    def start(self, spool_retry_interval=30.0):
+        self.spool_retry_interval = spool_retry_interval
+        self._spool_thread.start()
+        return self
+
+    def on_connect(self, client, userdata, flags, rc):
+        _ = userdata, flags
+        if rc != 0:
+            print(f"connect failed: {mqtt.connack_string(rc)}")
+            return
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connected to {host}:{port}")
+        for topic in bridge_topics:
+            client.subscribe(topic, qos=1)
+
+    def on_message(self, client, userdata, message):
+        _ = client, userdata
+        self.handle(message.topic, message.payload)
+
+    def handle(self, topic, payload):
+        """Decode one message and queue its points for writing."""
+        try:
+            records = decode_payload(topic, payload)
+            # points carry the data/... topic tag whichever encoding the node used
+            data_topic = "data/" + topic.split("/", 1)[1]
+            points = [WireBridge.to_point(data_topic, record, self.host) for record in records]
+            newest = max(wire_format.epoch_ms(record["timestamp"]) for record in records) / 1000 if records else None
+        except (ValueError, TypeError, KeyError) as e:
+            # decode errors are all ValueError; TypeError/KeyError are readings without a usable timestamp
+            self.bad_payloads += 1
+            print(f"dropping bad payload on {topic}: {e}")
+            return
+        if not points:
+            return
+        with self._lock:
+            self.messages += 1
+            self.points_received += len(points)
+            self.receive_lag = max(self.receive_lag, time.time() - newest)
+        self.write_api.write(bucket=self.bucket, org=self.org, record=points,
+                             write_precision=influxdb_client.WritePrecision.S)
+
+    def stats(self):
+        """Counters, rates since the previous call and the worst lag seen since then."""
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_received, last_written = self._last_stats
+            elapsed = max(now - last_time, 1e-9)
+            stats = {
+                "messages": self.messages,
+                "points_received": self.points_received,
+                "points_written": self.points_written,
+                "received_per_s": round((self.points_received - last_received) / elapsed, 1),
+                "written_per_s": round((self.points_written - last_written) / elapsed, 1),
+                "batches_written": self.batches_written,
+                "retries": self.retries,
+                "batches_spooled": self.batches_spooled,
+                "batches_rejected": self.batches_rejected,
+                "points_rejected": self.points_rejected,
+                "spool_replayed": self.spool_replayed,
+                "spool_backlog": len(self.spool),
+                "bad_payloads": self.bad_payloads,
+                "receive_lag_s": round(self.receive_lag, 1),
+                "write_lag_s": round(self.write_lag, 1),
+            }
+            self._last_stats = (now, self.points_received, self.points_written)
+            self.receive_lag = 0.0
+            self.write_lag = 0.0
+        return stats
+
+    def close(self):
+        """Flush pending batches (spooling what fails) and stop the spool thread."""
+        self.write_api.close()
+        self._stop.set()
+        if self._spool_thread.is_alive():
+            self._spool_thread.join(5)
+
+    def _written(self, data):
+        points = data.count(b"\n" if isinstance(data, bytes) else "\n") + 1
+        lag = time.time() - newest_timestamp(data)
+        with self._lock:
+            self.points_written += points
+            self.batches_written += 1
+            self.write_lag = max(self.write_lag, lag)
+
+    def _on_success(self, conf, data):
+        _ = conf
+        self._written(data)
+
+    def _on_retry(self, conf, data, exception):
+        _ = conf, data
+        self.retries += 1
+        print(f"InfluxDB write failed, retrying: {describe(exception)}")
+
+    def _on_error(self, conf, data, exception):
+        _ = conf
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        if is_bad_data(exception):
+            self._split(data, exception)
+            return
+        if is_permanent(exception):
+            # a retry would fail the same way, keep the spool for outages
+            self.batches_rejected += 1
+            print(f"InfluxDB rejected a batch: {describe(exception)}")
+            return
+        self.spool.push(data)
+        self.batches_spooled += 1
+        print(f"InfluxDB unavailable, spooled a batch: {describe(exception)}")
+
+    def _split(self, data, exception):
+        """
+        Write a batch InfluxDB refused as bad data in halves, so one bad point cannot cost the others.
+
+        Halves that fail again are split further down to single points, which are dropped.
+        Parts that fail for another reason (InfluxDB went away meanwhile) are spooled.
+        """
+        self.batches_rejected += 1
+        print(f"InfluxDB rejected a batch, writing it in parts: {describe(exception)}")
+        lines = data.splitlines()
+        if len(lines) == 1:
+            self.points_rejected += 1
+            print(f"dropping point: {lines[0]}")
+            return
+        parts = [lines[len(lines) // 2:], lines[:len(lines) // 2]]
+        while parts:
+            part = parts.pop()
+            if not part:
+                continue
+            body = "\n".join(part)
+            try:
+                self._sync_write.write(bucket=self.bucket, org=self.org, record=body,
+                                       write_precision=influxdb_client.WritePrecision.S)
+            except ApiException as e:
+                if not is_bad_data(e):
+                    self.spool.push(body)
+                    self.batches_spooled += 1
+                elif len(part) == 1:
+                    self.points_rejected += 1
+                    print(f"dropping point ({describe(e)}): {part[0]}")
+                else:
+                    parts += [part[len(part) // 2:], part[:len(part) // 2]]
+            except Exception:
+                self.spool.push(body)
+                self.batches_spooled += 1
+            else:
+                self._written(body)
+
+    def _drain_spool(self):
+        while not self._stop.wait(self.spool_retry_interval):
+            while len(self.spool) and not self._stop.is_set():
+                rows = self.spool.peek(1)
+                if not rows:
+                    break
+                row_id, data = rows[0]
+                try:
+                    self._sync_write.write(bucket=self.bucket, org=self.org, record=data,
+                                           write_precision=influxdb_client.WritePrecision.S)
+                except ApiException as e:
+                    if is_bad_data(e):
+                        self._split(data, e)
+                    elif not is_permanent(e):
+                        break
+                    else:
+                        self.batches_rejected += 1
+                        print(f"InfluxDB rejected a spooled batch: {describe(e)}")
+                except Exception:
+                    break  # still down, try again next interval
+                else:
+                    self._written(data)
+                    self.spool_replayed += 1
+                self.spool.ack([row_id])
+
+
+if __name__ == "__main__":
+    influx = influxdb_client.InfluxDBClient(url=influx_url, token=influx_token, org=influx_org)
+    spool = LossQueue(bridge_spool)
+    bridge = InfluxBridge(
+        influx, influx_bucket, influx_org, spool,
+        batch_size=bridge_batch_size, flush_interval=bridge_flush_interval, jitter=bridge_jitter,
+        retry_interval=bridge_retry_interval, max_retries=bridge_max_retries,
+        max_retry_delay=bridge_max_retry_delay, host=influx_host_tag,
+    ).start(spool_retry_interval)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="influx-bridge", clean_session=False)
+    client.username_pw_set(username, password)
+    client.on_connect = bridge.on_connect
+    client.on_message = bridge.on_message
+    client.reconnect_delay_set(1, 60)
+    client.connect_async(host, port)
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(stats_interval)
+            stats = bridge.stats()
+            stats["timestamp"] = datetime.utcnow().strftime(wire_format.TIMESTAMP_FORMAT)
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {stats}")
+            client.publish("metrics/server/influx_bridge", json.dumps(stats))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        bridge.close()
+        spool.close()
+        influx.close()
@@ -0,0 +1,113 @@
+import threading
+import time
+
+# HD44780 DDRAM address of the first character of each line (as used by rpi_lcd)
+LINE_ADDRESS = {1: 0x80, 2: 0xC0, 3: 0x94, 4: 0xD4}
+
+
+class LcdWorker:
+    """
+    Update an rpi_lcd display from a background thread.
+
+    show() only stores the text and returns immediately. The worker redraws at most
+    refresh_hz times per second, always with the latest text (intermediate updates are
+    dropped), and only sends the characters that differ from what is on the display.
+    """
+
+    def __init__(self, lcd, refresh_hz=2.0, metrics=None):
+        """
+        Args:
+            lcd: rpi_lcd.LCD instance (or sim.FakeLCD)
+            refresh_hz (float): Maximum number of redraws per second
+            metrics (Metrics): Optional, times every redraw as 'lcd_write'
+        """
+        self.name = "lcd"
+        self.lcd = lcd
+        self.metrics = metrics
+        self.width = getattr(lcd, "width", 16)
+        self.min_interval = 1.0 / refresh_hz
+        self.redraws = 0
+        self.chars_written = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._shown = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lcd", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def show(self, *lines):
+        """Set the text of lines 1, 2, ... without waiting for the display."""
+        with self._lock:
+            if self._pending:
+                self.coalesced += 1
+            for row, text in enumerate(lines, start=1):
+                self._pending[row] = text[:self.width].ljust(self.width)
+        self._changed.set()
+
+    def stop(self):
+        """Draw the last pending text and stop the worker."""
+        self._stop.set()
+        self._changed.set()
+        self._thread.join(5)
+
+    def stats(self):
+        return {"redraws": self.redraws, "chars_written": self.chars_written, "coalesced": self.coalesced}
+
+    def _run(self):
+        last_draw = 0.0
+        while not self._stop.is_set():
+            self._changed.wait()
+            # throttle, and let updates that arrive meanwhile replace the pending text
+            delay = last_draw + self.min_interval - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            if self.metrics is not None:
+                with self.metrics.timer("lcd_write"):
+                    self._draw()
+            else:
+                self._draw()
+            last_draw = time.monotonic()
+        self._draw()
+
+    def _draw(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._changed.clear()
+        for row, text in pending.items():
+            try:
+                self._draw_line(row, text)
+            except OSError as e:
+                # I2C hiccup: forget what is on screen so the next draw repaints the line
+                self._shown.pop(row, None)
+                print(f"LCD error: {e}")
+        if pending:
+            self.redraws += 1
+
+    def _draw_line(self, row, text):
+        shown = self._shown.get(row)
+        if not hasattr(self.lcd, "write") or shown is None:
+            self.lcd.text(text, row)
+            self.chars_written += len(text)
+            self._shown[row] = text
+            return
+        col = 0
+        while col < len(text):
+            if text[col] == shown[col]:
+                col += 1
+                continue
+            # one cursor move per run of changed characters
+            end = col
+            while end < len(text) and text[end] != shown[end]:
+                end += 1
+            self.lcd.write(LINE_ADDRESS[row] + col)
+            for char in text[col:end]:
+                self.lcd.write(ord(char), mode=1)
+            self.chars_written += end - col
+            col = end
+        self._shown[row] = text
@@ -0,0 +1,213 @@
+"""
+Load generator for the mosquitto -> telegraf -> influxdb ingest path.
+
+Emulates N virtual nodes that publish the same JSON readings as node_client_thread.py,
+optionally starting with a backlog burst like a node that was offline, then counts what arrived
+in InfluxDB. Every run uses its own LOCATION (loadtest_<time>) so its points can be told
+apart from real data through the 'topic' tag Telegraf adds.
+
+Example:
+    python loadgen.py --nodes 200 --processes 8 --duration 120 --backlog 3600 --batch-records 60
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+import influxdb_client
+import numpy as np
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+from batching import encode_batch, split_batches
+
+load_dotenv()
+
+host = os.getenv("HOST", "localhost")
+port = int(os.getenv("PORT", 1883))
+username = os.getenv("USERNAME", "")
+password = os.getenv("PASSWORD")
+influx_url = os.getenv("INFLUX_URL", "http://localhost:8086")
+influx_token = os.getenv("INFLUX_TOKEN", "")
+influx_org = os.getenv("INFLUX_ORG", "bblab")
+influx_bucket = os.getenv("INFLUX_BUCKET", "sensor_data")
+
+
+def iso(epoch):
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def reading(node, epoch, rng):
+    return {
+        "node": node,
+        "MQ4": round(rng.uniform(1.5, 3.0), 3),
+        "TGS": round(rng.uniform(1.5, 3.0), 3),
+        "TGS_voltage": round(rng.uniform(2.0, 2.2), 3),
+        "timestamp": iso(epoch),
+    }
+
+
+def connect(client_id):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+    client.username_pw_set(username, password)
+    client.connect(host, port)
+    client.loop_start()
+    return client
+
+
+def worker(worker_id, nodes, args, location, t0, results):
+    """Publish for a slice of the virtual nodes and report what was sent."""
+    rng = random.Random(worker_id)
+    clients = {node: connect(f"loadgen-{location}-{node}") for node in nodes}
+    sent_messages = sent_points = errors = 0
+    last_info = {}  # node -> MessageInfo of its latest publish
+
+    def publish(node, records):
+        nonlocal sent_messages, sent_points, errors
+        for batch in split_batches(records, args.batch_records, args.batch_bytes):
+            info = clients[node].publish(f"data/{location}/sensors/{node}", encode_batch(batch), qos=args.qos)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                errors += len(batch)
+                continue
+            last_info[node] = info
+            sent_messages += 1
+            sent_points += len(batch)
+
+    # Backlog burst: one row per second before t0, replayed as fast as possible
+    for node in nodes:
+        publish(node, [reading(node, t0 - args.backlog + i, rng) for i in range(args.backlog)])
+
+    # Steady state: one reading per node every period, timestamps stay unique per node
+    ticks = int(args.duration / args.period)
+    start = time.monotonic()
+    for tick in range(ticks):
+        epoch = t0 + int(tick * args.period)
+        for node in nodes:
+            publish(node, [reading(node, epoch, rng)])
+        delay = start + (tick + 1) * args.period - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.monotonic() - start
+
+    # Messages leave in order, so once the last one is written the out queue is empty;
+    # stopping the loop earlier would throw the rest away and count them as ingest drops
+    for info in last_info.values():
+        info.wait_for_publish(timeout=30)
+    for client in clients.values():
+        client.disconnect()
+        client.loop_stop()
+    results.put({"messages": sent_messages, "points": sent_points, "errors": errors, "elapsed": elapsed})
+
+
+def count_points(query_api, location, start):
+    flux = f'''
+from(bucket: "{influx_bucket}")
+  |> range(start: {start})
+  |> filter(fn: (r) => r._measurement == "mqtt_consumer" and r._field == "MQ4")
+  |> filter(fn: (r) => r.topic =~ /^data\\/{location}\\//)
+  |> group()
+  |> count()
+'''
+    tables = query_api.query(flux, org=influx_org)
+    return sum(record.get_value() for table in tables for record in table.records)
+
+
+def probe_latency(client, query_api, location, probes, interval, timeout):
+    """Publish marked readings one by one and time how long each takes to show up in InfluxDB."""
+    latencies = []
+    rng = random.Random(0)
+    for i in range(probes):
+        node = "probe"
+        record = reading(node, int(time.time()), rng)
+        record["probe_id"] = i
+        sent = time.monotonic()
+        client.publish(f"data/{location}/sensors/{node}", encode_batch([record]), qos=1)
+        flux = f'''
+from(bucket: "{influx_bucket}")
+  |> range(start: -10m)
+  |> filter(fn: (r) => r._measurement == "mqtt_consumer" and r._field == "probe_id")
+  |> filter(fn: (r) => r.topic == "data/{location}/sensors/{node}" and r._value == {i})
+'''
+        while time.monotonic() - sent < timeout:
+            if any(table.records for table in query_api.query(flux, org=influx_org)):
+                latencies.append(time.monotonic() - sent)
+                break
+            time.sleep(interval)
+        else:
+            print(f"probe {i}: not seen after {timeout} s")
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate a fleet of nodes and measure the ingest path")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of steady-state publishing")
+    parser.add_argument("--period", type=float, default=1.0, help="seconds between readings per node (>= 1)")
+    parser.add_argument("--backlog", type=int, default=0, help="backlog rows per node replayed at start")
+    parser.add_argument("--batch-records", type=int, default=1)
+    parser.add_argument("--batch-bytes", type=int, default=16384)
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1])
+    parser.add_argument("--probes", type=int, default=5, help="latency probes sent after the load")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="seconds to wait for all points")
+    args = parser.parse_args()
+    if args.period < 1:
+        parser.error("--period must be >= 1, timestamps have one second resolution")
+
+    location = f"loadtest_{int(time.time())}"
+    t0 = int(time.time())
+    node_ids = [f"{i:04d}" for i in range(args.nodes)]
+    slices = [node_ids[i::args.processes] for i in range(args.processes)]
+    results = multiprocessing.Queue()
+    print(f"location: {location}, {args.nodes} nodes in {args.processes} processes")
+
+    started = time.monotonic()
+    procs = [
+        multiprocessing.Process(target=worker, args=(i, nodes, args, location, t0, results))
+        for i, nodes in enumerate(slices) if nodes
+    ]
+    for p in procs:
+        p.start()
+    totals = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    publish_time = time.monotonic() - started
+
+    messages = sum(t["messages"] for t in totals)
+    points = sum(t["points"] for t in totals)
+    errors = sum(t["errors"] for t in totals)
+    print(f"published:  {points} points in {messages} messages over {publish_time:.1f} s "
+          f"({points / publish_time:.0f} points/s, {messages / publish_time:.0f} messages/s), {errors} publish errors")
+
+    influx = influxdb_client.InfluxDBClient(url=influx_url, token=influx_token, org=influx_org)
+    query_api = influx.query_api()
+    range_start = iso(t0 - args.backlog - 60)
+    drain_start = time.monotonic()
+    counted = last = -1
+    stable_since = time.monotonic()
+    while time.monotonic() - drain_start < args.drain_timeout:
+        counted = count_points(query_api, location, range_start)
+        if counted >= points:
+            break
+        if counted != last:
+            last = counted
+            stable_since = time.monotonic()
+        elif time.monotonic() - stable_since > 30:
+            break  # nothing new for 30 s, the rest is lost
+        time.sleep(2)
+    drain_time = time.monotonic() - drain_start
+    print(f"ingested:   {counted} / {points} points, {points - counted} dropped, "
+          f"all visible {drain_time:.1f} s after the last publish")
+    print(f"ingest rate: {counted / (publish_time + drain_time):.0f} points/s end to end")
+
+    if args.probes:
+        probe_client = connect(f"loadgen-{location}-probe")
+        latencies = probe_latency(probe_client, query_api, location, args.probes, 0.5, args.drain_timeout)
+        probe_client.loop_stop()
+        if latencies:
+            p50, p95 = np.percentile(latencies, [50, 95])
+            print(f"latency:    publish -> queryable p50 {p50:.1f} s, p95 {p95:.1f} s, max {max(latencies):.1f} s "
+                  f"({len(latencies)} probes)")
+    influx.close()
@@ -0,0 +1,111 @@
+import csv
+import json
+import os
+import sqlite3
+import threading
+
+
+class LossQueue:
+    """
+    Durable store-and-forward queue for readings that have not reached the server yet.
+
+    Records are kept in a SQLite table running in WAL mode. push() appends, peek()
+    returns the oldest records and ack() removes the ones the broker accepted, so every
+    call only touches one batch no matter how long the outage was. Whatever has not
+    been acked is still on disk after a crash or power cut and is replayed on restart.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): SQLite file, e.g. '/home/pi/CH4_data/node04_loss_data.db'
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS backlog ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT NOT NULL)"
+        )
+        # Counting rows is a full scan in SQLite, so do it once and track it from here on
+        self._size = self._conn.execute("SELECT COUNT(*) FROM backlog").fetchone()[0]
+
+    def push(self, record):
+        """Append one reading (a dict) to the end of the queue."""
+        self.push_many([record])
+
+    def push_many(self, records):
+        """Append several readings in a single transaction."""
+        rows = [(json.dumps(r),) for r in records]
+        if not rows:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT INTO backlog (record) VALUES (?)", rows)
+            self._size += len(rows)
+
+    def peek(self, n, after_id=0):
+        """
+        Return up to n of the oldest queued readings without removing them.
+
+        Args:
+            n (int): Maximum number of records
+            after_id (int): Only return records with an id above this one
+
+        Returns:
+            list: (id, record) tuples in insertion order
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, record FROM backlog WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, n),
+            ).fetchall()
+        return [(row_id, json.loads(record)) for row_id, record in rows]
+
+    def ack(self, ids):
+        """Remove delivered records. Unknown ids are ignored."""
+        ids = [(i,) for i in ids]
+        if not ids:
+            return
+        with self._lock:
+            before = self._conn.total_changes
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("DELETE FROM backlog WHERE id = ?", ids)
+            self._size -= self._conn.total_changes - before
+
+    def import_csv(self, csv_path, node):
+        """
+        Move rows from the old node{node}_loss_data.csv file into the queue.
+
+        The CSV is deleted once its rows are committed, so this is a no-op on later starts.
+
+        Returns:
+            int: Number of imported rows
+        """
+        if not os.path.exists(csv_path):
+            return 0
+        with open(csv_path, 'r') as read_file:
+            records = [
+                {"node": node, "MQ4": float(row[1]), "TGS": float(row[2]), "timestamp": row[0]}
+                for row in csv.reader(read_file) if row
+            ]
+        self.push_many(records)
+        os.remove(csv_path)
+        return len(records)
+
+    def last_id(self):
+        """Highest id handed out so far. AUTOINCREMENT never reuses one, even once its row was acked."""
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'backlog'").fetchone()
+        return row[0] if row else 0
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
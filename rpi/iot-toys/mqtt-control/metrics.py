@@ -0,0 +1,120 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in milliseconds, roughly 3 per decade from 10 us to 10 s
+BUCKETS_MS = (
+    0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+)
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram.
+
+    observe() is a bisect and a few additions, cheap enough for the 1 Hz hot path and for
+    the stage threads. Percentiles are the upper bound of the bucket they fall in, so they
+    are accurate to the bucket spacing.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                # the overflow bucket has no upper bound, report the largest value seen
+                return round(min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max, 3)
+        return round(self.max, 3)
+
+    def summary(self, name):
+        return {
+            f"{name}_count": self.count,
+            f"{name}_mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            f"{name}_p50_ms": self.percentile(0.5),
+            f"{name}_p95_ms": self.percentile(0.95),
+            f"{name}_p99_ms": self.percentile(0.99),
+            f"{name}_max_ms": round(self.max, 3),
+        }
+
+
+class Metrics:
+    """
+    Timers, counters and gauges of one node, flattened into one record per interval.
+
+    Timers and counters cover the interval since the previous snapshot(); gauges are
+    callables read when the snapshot is taken (queue depths, backlog size, ...).
+    """
+
+    def __init__(self):
+        self.name = "metrics"
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        """Time a block: with metrics.timer("adc_read"): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds * 1000)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name, read):
+        """Register a callable returning a number, or a dict of numbers flattened as name_key."""
+        self._gauges[name] = read
+
+    def snapshot(self):
+        """Return the metrics of the interval as one flat dict and start a new interval."""
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+            counters, self._counters = self._counters, {}
+        fields = {}
+        for name, histogram in sorted(histograms.items()):
+            fields.update(histogram.summary(name))
+        fields.update(counters)
+        for name, read in self._gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                print(f"metrics gauge {name} error: {e}")
+                continue
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    if isinstance(item, (int, float)):
+                        fields[f"{name}_{key}"] = item
+            else:
+                fields[name] = value
+        return fields
+
+    def stats(self):
+        with self._lock:
+            return {name: h.count for name, h in self._histograms.items()}
@@ -1,44 +1,114 @@
 from datetime import datetime
+import threading
 import time
-import board
-import busio
 import math
 import serial
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+import numpy as np
+import calibration
+# Blinka only works on the Pi; elsewhere the classes run on the stand-ins from sim.py
+try:
+    import board
+    import busio
+    import adafruit_ads1x15.ads1115 as ADS
+    from adafruit_ads1x15.analog_in import AnalogIn
+except (ImportError, NotImplementedError):
+    board = busio = ADS = AnalogIn = None
 # import adafruit_sgp30
 # from sht20 import SHT20
 
 class MQ4GasSensor:
-    def __init__(self, channel, R0=8.3):
+    def __init__(self, channel, R0=8.3, a=1000.0, b=-2.95):
         #self.ads = ads
         self.channel = channel
         self.R0 = R0
+        self.a = a
+        self.b = b
     
-    def read_ppm(self):
-        voltage = self.channel.voltage
-        RS_gas = ((5 * 1) / voltage) - 1
-        ratio = RS_gas / self.R0
-        ppm = 1000 * pow(ratio, -2.95)
-        return round(ppm,3) , round(voltage,3)
+    def read_ppm(self, voltage=None):
+        # voltage: use an already averaged reading (see BurstSampler) instead of reading the channel
+        if voltage is None:
+            voltage = self.channel.voltage
+        ppm = float(calibration.mq4_ppm(voltage, self.R0, self.a, self.b))
+        # None for a voltage out of range: json.dumps would send NaN, which is not valid JSON
+        return (round(ppm,3) if math.isfinite(ppm) else None), round(voltage,3)
 
 class TGS2611:
-    def __init__(self, channel, R0=2.94):
+    def __init__(self, channel, R0=2.94, intercept=1.4402, slope=-0.3849):
         self.channel = channel
         self.R0 = R0
+        #(intercept, slope) = (1.3113, -0.33678), (1.3877, -0.2445) were earlier fits
+        self.intercept = intercept
+        self.slope = slope
     
-    def read_ppm(self):
-        voltage = self.channel.voltage
-        RS_gas = ((5 * 1) / voltage) - 1
-        ratio = RS_gas / self.R0
-        #ppm = pow(10, (math.log10(ratio)-1.3113)/(-0.33678))
-        #ppm = pow(10, ((math.log10(voltage)+0.60305))/(0.22191))
-        #ppm = pow(10, (math.log10(ratio)-1.3877)/(-0.2445))
-        ppm = pow(10, (math.log10(ratio)-1.4402)/(-0.3849)) #V2
-        return round(ppm,3), round(voltage,3)
+    def read_ppm(self, voltage=None):
+        if voltage is None:
+            voltage = self.channel.voltage
+        ppm = float(calibration.tgs2611_ppm(voltage, self.R0, self.intercept, self.slope)) #V2
+        return (round(ppm,3) if math.isfinite(ppm) else None), round(voltage,3)
+
+class BurstSampler:
+    def __init__(self, ads, channels, samples=16, data_rate=860, reducer="mean", trim=0.1):
+        """
+        Oversample ADS1115 channels and reduce each burst to one value.
+
+        The ADC is switched to continuous conversion so consecutive reads of a channel
+        only fetch the latest conversion instead of starting a new one each time.
+
+        Args:
+            ads: ADS1115 instance shared by the channels
+            channels (list): AnalogIn channels to sample
+            samples (int): Conversions collected per channel and burst
+            data_rate (int): ADS1115 data rate in samples/s (8 ... 860)
+            reducer (str): 'mean', 'median' or 'trimmed' (trimmed mean)
+            trim (float): Fraction cut from each end for the trimmed mean
+        """
+        if reducer not in ("mean", "median", "trimmed"):
+            raise ValueError(f"unknown reducer: {reducer}")
+        self.ads = ads
+        self.channels = channels
+        self.samples = samples
+        self.reducer = reducer
+        self.trim = trim
+        if ADS is not None:
+            self.ads.mode = ADS.Mode.CONTINUOUS
+        self.ads.data_rate = data_rate
+        self.interval = 1.0 / data_rate
+        self._buffer = np.empty((len(channels), samples))
+
+    def read(self):
+        """
+        Collect one burst from every channel.
+
+        Returns:
+            tuple: (values, stds) NumPy arrays with one entry per channel
+        """
+        for i, chan in enumerate(self.channels):
+            next_read = time.monotonic()
+            for k in range(self.samples):
+                # pace the reads to the data rate so no conversion is read twice
+                delay = next_read - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self._buffer[i, k] = chan.voltage
+                next_read += self.interval
+        return self.reduce(self._buffer)
+
+    def reduce(self, buffer):
+        """Reduce a (channels, samples) array along the sample axis in one step."""
+        if self.reducer == "median":
+            values = np.median(buffer, axis=1)
+        elif self.reducer == "trimmed":
+            cut = int(buffer.shape[1] * self.trim)
+            values = np.sort(buffer, axis=1)[:, cut:buffer.shape[1] - cut].mean(axis=1)
+        else:
+            values = buffer.mean(axis=1)
+        stds = buffer.std(axis=1, ddof=1) if buffer.shape[1] > 1 else np.zeros(buffer.shape[0])
+        return values, stds
 
 class SHT20Sensor:
     def __init__(self):
+        from sht20 import SHT20  # only needed on nodes that have the sensor
+
         self.sht = SHT20(1, resolution=SHT20.TEMP_RES_14bit)
     
     def read_temperature(self):
@@ -49,6 +119,9 @@ class SHT20Sensor:
 
 class SGP30GasSensor:
     def __init__(self, i2c):
+        import adafruit_sgp30  # only needed on nodes that have the sensor
+
+        self.elapsed_sec = 0
         self.sgp30 = adafruit_sgp30.Adafruit_SGP30(i2c)
     
     def initialize(self, temperature, humidity):
@@ -73,55 +146,141 @@ class SGP30GasSensor:
             #     % (self.sgp30.baseline_eCO2, self.sgp30.baseline_TVOC)
             # )
 
+MHT7042A_READ_CMD = b'\xFF\x01\x86\x00\x00\x00\x00\x00\x79'
+MHT7042A_FRAME_SIZE = 9
+
+def mht7042a_checksum(frame):
+    """Checksum byte of a 9-byte MH-T7042A frame: two's complement of bytes 1..7"""
+    return (0xFF - (sum(frame[1:8]) & 0xFF) + 1) & 0xFF
+
+def parse_mht7042a_frames(buffer):
+    """
+    Extract CH4 readings from received bytes
+    
+    Frames start with 0xFF 0x86. Bytes before a frame start and frames with a bad
+    checksum are skipped, so the parser resynchronizes after line noise. Parsed and
+    skipped bytes are removed from buffer; an incomplete frame is left for the next call.
+    
+    Args:
+        buffer (bytearray): Received bytes, modified in place
+    
+    Returns:
+        tuple: (list of CH4 readings in ppm, number of frames with a bad checksum)
+    """
+    readings = []
+    bad = 0
+    while True:
+        start = buffer.find(b'\xFF\x86')
+        if start < 0:
+            # a trailing 0xFF may be the first byte of the next frame
+            del buffer[:len(buffer) - 1 if buffer.endswith(b'\xFF') else len(buffer)]
+            return readings, bad
+        del buffer[:start]
+        if len(buffer) < MHT7042A_FRAME_SIZE:
+            return readings, bad
+        if mht7042a_checksum(buffer) == buffer[8]:
+            readings.append((buffer[2] << 8) + buffer[3])
+            del buffer[:MHT7042A_FRAME_SIZE]
+        else:
+            bad += 1
+            del buffer[:1]
+
 class MHT7042A:
-    def __init__(self, port='/dev/serial0', baudrate=9600, timeout=1):
+    BUFFER_SIZE = 256
+
+    def __init__(self, port='/dev/serial0', baudrate=9600, timeout=1, ser=None, poll_interval=1.0, max_age=None):
         """
         Initialize MH-T7042A CH4 sensor
         
+        A background thread sends the read command every poll_interval seconds and
+        parses the replies, so read_ch4() returns the cached value without waiting.
+        
         Args:
             port (str): Serial port path, default '/dev/serial0'
             baudrate (int): Communication baud rate, default 9600
-            timeout (float): Serial timeout in seconds, default 1
+            timeout (float): Serial timeout in seconds, default 1 (the reader caps it at 0.1)
+            ser: Already opened serial-like object (e.g. sim.FakeSerial), overrides port
+            poll_interval (float): Seconds between read commands, default 1
+            max_age (float): read_ch4() returns None once the value is older, default 3 poll intervals
         """
-        try:
-            self.ser = serial.Serial(port, baudrate=baudrate, timeout=timeout)
-            time.sleep(0.1)  # Allow serial connection to stabilize
-        except Exception as e:
-            print(f"Error initializing MH-T7042A sensor: {e}")
-            self.ser = None
+        self.poll_interval = poll_interval
+        self.max_age = max_age if max_age is not None else 3 * poll_interval
+        self.frames = 0
+        self.bad_frames = 0
+        self._value = None
+        self._time = None
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if ser is not None:
+            self.ser = ser
+        else:
+            try:
+                self.ser = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+                time.sleep(0.1)  # Allow serial connection to stabilize
+            except Exception as e:
+                print(f"Error initializing MH-T7042A sensor: {e}")
+                self.ser = None
+        if self.ser is not None:
+            # short reads keep the request schedule on time while the line is quiet
+            self.ser.timeout = min(timeout, 0.1)
+            self._thread = threading.Thread(target=self._run, name="mht7042a", daemon=True)
+            self._thread.start()
     
     def read_ch4(self):
         """
         Read CH4 concentration from MH-T7042A sensor
         
         Returns:
-            int or None: CH4 concentration in ppm, or None if reading failed
+            int or None: Latest CH4 concentration in ppm, or None if there is no recent valid reading
         """
-        if self.ser is None:
-            return None
-        
-        try:
-            # Send command to read CH4 concentration
-            self.ser.write(b'\xFF\x01\x86\x00\x00\x00\x00\x00\x79')
-            
-            # Read response
-            data = self.ser.read(9)
-            
-            if len(data) == 9 and data[0] == 0xFF and data[1] == 0x86:
-                high = data[2]
-                low = data[3]
-                ch4_ppm = (high << 8) + low
-                return ch4_ppm
-            else:
-                print("MH-T7042A: Invalid response")
-                return None
-                
-        except Exception as e:
-            print(f"MH-T7042A read error: {e}")
+        value, age = self.latest()
+        if value is None or age > self.max_age:
             return None
+        return value
+    
+    def latest(self):
+        """
+        Returns:
+            tuple: (last valid CH4 reading in ppm or None, its age in seconds or None)
+        """
+        with self._lock:
+            if self._time is None:
+                return None, None
+            return self._value, time.monotonic() - self._time
+    
+    def _run(self):
+        next_request = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= next_request:
+                    # Send command to read CH4 concentration
+                    self.ser.write(MHT7042A_READ_CMD)
+                    next_request = max(next_request + self.poll_interval, time.monotonic())
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as e:
+                print(f"MH-T7042A read error: {e}")
+                self._stop.wait(self.poll_interval)
+                continue
+            if not data:
+                continue
+            self._buffer += data
+            if len(self._buffer) > self.BUFFER_SIZE:
+                del self._buffer[:len(self._buffer) - self.BUFFER_SIZE]
+            readings, bad = parse_mht7042a_frames(self._buffer)
+            self.bad_frames += bad
+            if readings:
+                self.frames += len(readings)
+                with self._lock:
+                    self._value = readings[-1]
+                    self._time = time.monotonic()
     
     def close(self):
-        """Close serial connection"""
+        """Stop the reader and close serial connection"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(1)
         if self.ser and self.ser.is_open:
             self.ser.close()
     
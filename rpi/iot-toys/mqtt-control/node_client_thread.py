@@ -1,49 +1,140 @@
 import os
-import socket
+import fnmatch
+import math
 import threading
 import paho.mqtt.client as mqtt
 import time
 from datetime import datetime
 from dotenv import load_dotenv
 import json
-import csv
 import multisensor
-import board
-import busio
-import math
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-from rpi_lcd import LCD
+from loss_queue import LossQueue
+from batching import PayloadBatcher, encode_batch
+import wire_format
+from aggregation import EdgeAggregator
+from publisher import ReliablePublisher
+from pipeline import FixedRateScheduler, Stage
+from rotating_csv import DailyCsvWriter
+from binary_archive import DailyBinaryWriter
+from calibration import load_calibration, mq4_ratio, tgs2611_ratio
+from r0_calibration import R0Calibrator, load_state, save_state
+from lcd_worker import LcdWorker
+from sensor_scheduler import SensorScheduler
+from metrics import Metrics
+from i2c_arbiter import I2CArbiter, SENSOR, DISPLAY
+from query_server import ArchiveReader, QueryServer
 
 
 load_dotenv()
 
 is_stop = False
 
-MQ4_R0=3.323
-TGS_R0=0.679
-
 host = os.getenv("HOST", "")
 port = int(os.getenv("PORT", 1883))
 username = os.getenv("USERNAME", "")
 password = os.getenv("PASSWORD")
 node = os.getenv("NODE")
 location = os.getenv("LOCATION")
+data_dir = os.getenv("DATA_DIR", "/home/pi/CH4_data")
+loss_batch_size = int(os.getenv("LOSS_BATCH_SIZE", 100))
+batch_max_records = int(os.getenv("BATCH_MAX_RECORDS", 1))
+batch_max_bytes = int(os.getenv("BATCH_MAX_BYTES", 16384))
+batch_max_latency = float(os.getenv("BATCH_MAX_LATENCY", 10))
+# json: readable payloads on data/..., read by Telegraf; binary: wire_format payloads on bin/..., read by wire_bridge.py
+wire_format_name = os.getenv("WIRE_FORMAT", "json")
+# Edge aggregation: seconds per summary (0 = send every reading), and the triggers for full-rate reporting
+agg_window = float(os.getenv("AGG_WINDOW", 0))
+agg_ppm_threshold = float(os.getenv("AGG_PPM_THRESHOLD", 0)) or None
+agg_rate_threshold = float(os.getenv("AGG_RATE_THRESHOLD", 0)) or None
+agg_hold = float(os.getenv("AGG_HOLD", 60))
+keepalive = int(os.getenv("MQTT_KEEPALIVE", 30))
+mqtt_qos = int(os.getenv("MQTT_QOS", 1))
+mqtt_max_inflight = int(os.getenv("MQTT_MAX_INFLIGHT", 20))
+mqtt_max_queued = int(os.getenv("MQTT_MAX_QUEUED", 100))
+ack_timeout = float(os.getenv("ACK_TIMEOUT", 60))
+sample_period = float(os.getenv("SAMPLE_PERIOD", 1))
+queue_size = int(os.getenv("QUEUE_SIZE", 600))
+stats_interval = float(os.getenv("STATS_INTERVAL", 60))
+# Seconds between self-metrics on metrics/{location}/{node} (0 = off)
+metrics_interval = float(os.getenv("METRICS_INTERVAL", 60))
+csv_flush_interval = float(os.getenv("CSV_FLUSH_INTERVAL", 10))
+csv_fsync = os.getenv("CSV_FSYNC", "0") == "1"
+archive_format = os.getenv("ARCHIVE_FORMAT", "csv")  # csv, bin or both
+burst_samples = int(os.getenv("BURST_SAMPLES", 1))
+adc_data_rate = int(os.getenv("ADC_DATA_RATE", 860))
+burst_reducer = os.getenv("BURST_REDUCER", "mean")  # mean, median or trimmed
+lcd_refresh_hz = float(os.getenv("LCD_REFRESH_HZ", 2))
+# Extra sensors polled on their own threads, e.g. "SHT20,SGP30,MHT7042A"
+extra_sensors = [name for name in os.getenv("EXTRA_SENSORS", "").split(",") if name]
+# Online R0 calibration against clean air (0 = keep MQ4_R0/TGS_R0 as set), see r0_calibration.py
+autocal = os.getenv("AUTOCAL", "0") == "1"
+autocal_ambient_ppm = float(os.getenv("AUTOCAL_AMBIENT_PPM", 2.0))
+autocal_percentile = float(os.getenv("AUTOCAL_PERCENTILE", 0.05))
+autocal_epoch = float(os.getenv("AUTOCAL_EPOCH", 86400))
+autocal_weight = float(os.getenv("AUTOCAL_WEIGHT", 0.2))
+autocal_max_step = float(os.getenv("AUTOCAL_MAX_STEP", 0.1))
+autocal_min_samples = int(os.getenv("AUTOCAL_MIN_SAMPLES", 3600))
+autocal_save_interval = float(os.getenv("AUTOCAL_SAVE_INTERVAL", 600))
+autocal_path = os.path.join(data_dir, f"node{node}_r0_state.json")
+# Local HTTP query API over the archives (0 = off), see query_server.py
+query_port = int(os.getenv("QUERY_PORT", 0))
+query_bind = os.getenv("QUERY_BIND", "")
+query_token = os.getenv("QUERY_TOKEN") or None
+# Longest time range a resync request of gap_detector.py may ask for, in seconds
+resync_max_span = float(os.getenv("RESYNC_MAX_SPAN", 7 * 86400))
+reconnect_min_delay = int(os.getenv("RECONNECT_MIN_DELAY", 1))
+reconnect_max_delay = int(os.getenv("RECONNECT_MAX_DELAY", 120))
+
+# Set/cleared by the paho network thread, the sampling loop only reads it
+mqtt_connected = threading.Event()
+publisher = None
+# Timers, counters and gauges of the hot path, see publish_metrics()
+metrics = Metrics()
+# Every device on the shared I2C bus goes through it, sensor reads before LCD writes
+i2c_arbiter = I2CArbiter(max_batch=int(os.getenv("I2C_MAX_BATCH", 8)))
+# Settings fleetctl.py can change at runtime: name -> (getter, setter), see register_tunables()
+tunables = {}
+config_path = os.path.join(data_dir, f"node{node}_config.json")
+# Every published record carries (run, seq), seq counting from 0 per run, so gap_detector.py can spot holes
+run_id = int(time.time())
+next_seq = 0
+archive_reader = ArchiveReader(data_dir, node)
+resync_lock = threading.Lock()
 
 def mqtt_connect_setup():
-    try: 
-        client.username_pw_set(username, password)
-        client.connect(host, port)
-        
-        client.message_callback_add(f"ctl/{location}/thi", ctl_thi_cb)
-        client.message_callback_add(f"ctl/{location}/thi/{node}", ctl_thi_cb)
-        client.on_message = default_cb  # default received callback
-
-        client.subscribe(f"ctl/{location}/thi/#")
-        client.loop_start()
-        mqttSetupStatus = True
-    except ConnectionError as e:
-        print(e)
+    # Connect in the background; paho keeps reconnecting with exponential backoff
+    client.username_pw_set(username, password)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+
+    client.max_inflight_messages_set(mqtt_max_inflight)
+    client.max_queued_messages_set(mqtt_max_queued)
+    client.message_callback_add(f"ctl/{location}/thi", ctl_thi_cb)
+    client.message_callback_add(f"ctl/{location}/thi/{node}", ctl_thi_cb)
+    client.on_message = default_cb  # default received callback
+
+    client.reconnect_delay_set(min_delay=reconnect_min_delay, max_delay=reconnect_max_delay)
+    client.connect_async(host, port, keepalive)
+    client.loop_start()
+
+def on_connect(client: mqtt.Client, userdata, flags, rc):
+    _ = userdata, flags
+    if rc != 0:
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connection refused ({mqtt.connack_string(rc)})")
+        return
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connected to {host}:{port}")
+    # subscriptions do not survive a reconnect, so renew them every time
+    client.subscribe(f"ctl/{location}/thi/#")
+    if publisher is not None:
+        publisher.reconnected()
+    mqtt_connected.set()
+
+def on_disconnect(client: mqtt.Client, userdata, rc):
+    _ = client, userdata
+    mqtt_connected.clear()
+    metrics.count("mqtt_disconnects")
+    if rc != 0:
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connection lost, reconnecting...")
 
 def default_cb(client: mqtt.Client, userdata, message):
     _ = client, userdata
@@ -54,12 +145,31 @@ def default_cb(client: mqtt.Client, userdata, message):
 
 
 def ctl_thi_cb(client: mqtt.Client, userdata, message):
-    _ = client, userdata
-    global is_stop
+    _ = userdata
     msg = str(message.payload.decode("utf-8"))
+    try:
+        command = json.loads(msg)
+    except ValueError:
+        command = None
+    if not isinstance(command, dict):
+        # plain "start"/"stop" (iotctl.py), answered like before
+        set_running(msg != "stop")
+        client.publish(f"log/{location}/thi/{node}", str(is_stop))
+        return
+
+    # fleetctl.py broadcasts one JSON command per location, every node checks the glob itself
+    if not fnmatch.fnmatchcase(str(node), str(command.get("nodes", "*"))):
+        return
+    if command.get("cmd") == "resync":
+        # reading the archives can take a while, keep it off the network thread
+        threading.Thread(target=resync, args=(client, command), name="resync", daemon=True).start()
+        return
+    client.publish(f"log/{location}/thi/{node}", json.dumps(handle_command(command)), qos=1)
+
+def set_running(running):
+    global is_stop
+    is_stop = not running
     print(" " * 100, end="\r")
-    is_stop = True if msg == "stop" else False
-
     if is_stop:
         print(
             f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:" " ...Stopped",
@@ -69,50 +179,420 @@ def ctl_thi_cb(client: mqtt.Client, userdata, message):
             f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:" " ...Start",
         )
 
-    # return log
-    client.publish(f"log/{location}/thi/{node}", str(is_stop))
+def handle_command(command):
+    # {"id": ..., "cmd": "start" | "stop" | "ping" | "set", "nodes": glob, "config": {name: value}}
+    cmd = command.get("cmd")
+    ack = {"id": command.get("id"), "node": node, "location": location, "cmd": cmd, "ok": True}
+    try:
+        if cmd in ("start", "stop"):
+            set_running(cmd == "start")
+        elif cmd == "set":
+            apply_config(command.get("config", {}), persist=True)
+        elif cmd != "ping":
+            raise ValueError(f"unknown command {cmd!r}")
+    except (ValueError, TypeError, OSError) as e:
+        # runs on the paho network thread, nothing may escape from here
+        ack["ok"] = False
+        ack["error"] = str(e)
+    ack["running"] = not is_stop
+    ack["config"] = {name: getter() for name, (getter, _) in tunables.items()}
+    return ack
+
+def resync(client, command):
+    # {"id": ..., "cmd": "resync", "start": timestamp, "end": timestamp, ...} from gap_detector.py
+    ack = {"id": command.get("id"), "node": node, "location": location, "cmd": "resync", "ok": True, "records": 0}
+    with resync_lock:
+        try:
+            start = wire_format.epoch_ms(command["start"]) / 1000
+            end = wire_format.epoch_ms(command["end"]) / 1000
+            if end - start > resync_max_span:
+                raise ValueError(f"range longer than RESYNC_MAX_SPAN ({resync_max_span:.0f} s)")
+            # through the loss queue like live readings, without seq: they fill a gap, they are not new
+            batch = []
+            for t, values in archive_reader.rows(start, end, ("MQ4", "TGS", "TGS_voltage")):
+                record = {"node": node}
+                for name, value in zip(("MQ4", "TGS", "MQ4_voltage", "TGS_voltage"), values):
+                    if value is not None and name != "MQ4_voltage":
+                        record[name] = value
+                record["timestamp"] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+                batch.append(record)
+                if len(batch) >= 1000:
+                    publisher.enqueue(batch)
+                    ack["records"] += len(batch)
+                    batch = []
+            publisher.enqueue(batch)
+            ack["records"] += len(batch)
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            ack["ok"] = False
+            ack["error"] = str(e)
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: resync {command.get('start')} - {command.get('end')}: {ack}")
+    client.publish(f"log/{location}/thi/{node}", json.dumps(ack), qos=1)
+
+def stamp_sequence(record):
+    # only called from take_sample() on the sampling thread
+    global next_seq
+    record["run"] = run_id
+    record["seq"] = next_seq
+    next_seq += 1
+    return record
+
+def apply_config(config, persist=False):
+    # validate everything first so a bad value does not leave half a change applied
+    if not isinstance(config, dict):
+        raise ValueError("config must be an object of name: value")
+    values = {}
+    for name, value in config.items():
+        if name not in tunables:
+            raise ValueError(f"unknown setting {name!r}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} must be a number")
+        try:
+            value = float(value)
+        except OverflowError:  # an int beyond the float range
+            value = math.inf
+        # json.loads accepts NaN and Infinity, and NaN passes every comparison below
+        if not math.isfinite(value):
+            raise ValueError(f"{name} must be finite")
+        if value < 0:
+            raise ValueError(f"{name} must not be negative")
+        values[name] = value
+    if "sample_period" in values and values["sample_period"] < 0.01:
+        # the scheduler would spin, and 0 divides by zero in its overrun count
+        raise ValueError("sample_period must be at least 0.01 s")
+    if not values:
+        return
+    for name, value in values.items():
+        tunables[name][1](value)
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: config {values}")
+    if persist:
+        # survive restarts: the overrides are applied again on top of .env at startup
+        try:
+            saved = load_config_overrides()
+            saved.update(values)
+            tmp = config_path + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp, config_path)
+        except (OSError, ValueError) as e:
+            raise OSError(f"applied, but not saved for restarts: {e}") from e
+
+def load_config_overrides():
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r') as f:
+        saved = json.load(f)
+    return saved if isinstance(saved, dict) else {}
+
+def register_tunables(scheduler, mq4_sensor, tgs_sensor, aggregator, calibrators=None):
+    def set_metrics_interval(value):
+        global metrics_interval
+        metrics_interval = value
+
+    def set_calibrated_r0(calibrator):
+        # a manual R0 restarts the calibration from there, the state file keeps it across restarts
+        def set_r0(value):
+            calibrator.r0 = value
+            save_calibration(calibrators)
+        return set_r0
+
+    def setter(obj, attr, none_if_zero=False):
+        return lambda value: setattr(obj, attr, None if none_if_zero and not value else value)
+
+    tunables.update({
+        "sample_period": (lambda: scheduler.period, setter(scheduler, "period")),
+        "mq4_r0": (lambda: mq4_sensor.R0, setter(mq4_sensor, "R0")),
+        "tgs_r0": (lambda: tgs_sensor.R0, setter(tgs_sensor, "R0")),
+        "agg_window": (lambda: aggregator.window, setter(aggregator, "window")),
+        "agg_ppm_threshold": (lambda: aggregator.threshold or 0, setter(aggregator, "threshold", True)),
+        "agg_rate_threshold": (lambda: aggregator.rate_threshold or 0, setter(aggregator, "rate_threshold", True)),
+        "agg_hold": (lambda: aggregator.hold, setter(aggregator, "hold")),
+        "metrics_interval": (lambda: metrics_interval, set_metrics_interval),
+    })
+    if calibrators:
+        tunables["mq4_r0"] = (lambda: calibrators["mq4"].r0, set_calibrated_r0(calibrators["mq4"]))
+        tunables["tgs_r0"] = (lambda: calibrators["tgs"].r0, set_calibrated_r0(calibrators["tgs"]))
+
+# ===== Hardware / sensors =====
+def setup_hardware():
+    # Imported here so the rest of this module also works off the Pi (see sim.py)
+    import board
+    import busio
+    import adafruit_ads1x15.ads1115 as ADS
+    from adafruit_ads1x15.analog_in import AnalogIn
+    from rpi_lcd import LCD
 
-def have_internet(host="8.8.8.8", port=53, timeout=3):
-    '''
-    Check internet status. Return 'True' if connected; 'False' if NOT connected.
-    '''
+    # Create the I2C bus
+    i2c = busio.I2C(board.SCL, board.SDA, frequency=100000)
+    ads = ADS.ADS1115(i2c)
+    ads.gain = 1
+    chan0 = AnalogIn(ads, ADS.P0)
+    chan1 = AnalogIn(ads, ADS.P1)
+    # the LCD driver opens the bus through smbus on its own, it is arbitrated all the same
+    return (
+        i2c,
+        i2c_arbiter.wrap(ads, "ads1115"),
+        i2c_arbiter.wrap(chan0, "ads1115"),
+        i2c_arbiter.wrap(chan1, "ads1115"),
+        i2c_arbiter.wrap(LCD(), "lcd", DISPLAY),
+    )
+
+def setup_sensors(ads, chan0, chan1):
+    cal = load_calibration()
+    mq4_sensor = multisensor.MQ4GasSensor(chan0, R0=cal["mq4"]["r0"], a=cal["mq4"]["a"], b=cal["mq4"]["b"])
+    tgs_sensor = multisensor.TGS2611(
+        chan1, R0=cal["tgs"]["r0"], intercept=cal["tgs"]["intercept"], slope=cal["tgs"]["slope"]
+    )
+    burst_sampler = None
+    if burst_samples > 1:
+        burst_sampler = multisensor.BurstSampler(
+            ads, [chan0, chan1], samples=burst_samples, data_rate=adc_data_rate, reducer=burst_reducer
+        )
+    return mq4_sensor, tgs_sensor, burst_sampler
+
+def setup_calibrators():
+    if not autocal:
+        return None
+    cal = load_calibration()
+    options = dict(
+        percentile=autocal_percentile, epoch=autocal_epoch, weight=autocal_weight,
+        max_step=autocal_max_step, min_samples=autocal_min_samples,
+    )
+    calibrators = {
+        "mq4": R0Calibrator(
+            cal["mq4"]["r0"], mq4_ratio(autocal_ambient_ppm, cal["mq4"]["a"], cal["mq4"]["b"]),
+            temp_coef=float(os.getenv("MQ4_TEMP_COEF", -0.004)), hum_coef=float(os.getenv("MQ4_HUM_COEF", -0.0013)),
+            **options,
+        ),
+        "tgs": R0Calibrator(
+            cal["tgs"]["r0"], float(tgs2611_ratio(autocal_ambient_ppm, cal["tgs"]["intercept"], cal["tgs"]["slope"])),
+            temp_coef=float(os.getenv("TGS_TEMP_COEF", -0.004)), hum_coef=float(os.getenv("TGS_HUM_COEF", -0.0013)),
+            **options,
+        ),
+    }
+    # once there is a state file it takes precedence over MQ4_R0/TGS_R0
     try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
-    except socket.error as err:
-        print(err)
-        return False
-
-def is_file_empty(file_path):
-    if not os.path.exists(file_path):
-        return True
-    return os.path.getsize(file_path) == 0
-
-# ===== Sensor upload func =====
-def upload_data(data):
-    # Upload current data to server
-    client.publish(f"data/{location}/sensors/{node}", data)
-    
-            
-# ===== Resend loss data func =====
-def send_loss_data(tempFilePath):
-    # Check if there is loss data
-        if not is_file_empty(tempFilePath):
-            # Insert data from temp file
-            with open(tempFilePath, 'r') as read_file:
-                csv_reader = csv.reader(read_file)
-                for row in csv_reader:
-                    data = json.dumps(
-                        {"node": node, "MQ4": float(row[1]), "TGS": float(row[2]), "timestamp": row[0]}
-                    )
-                    client.publish(f"data/{location}/sensors/{node}", data)
-                    print(data)
-                  
-
-            # Cleanup file after sending to server
-            with open(tempFilePath, 'w') as clean_file:
-                clean_file.truncate(0)
+        if load_state(autocal_path, calibrators):
+            print(f"R0 calibration: {({name: c.stats() for name, c in calibrators.items()})}")
+    except (ValueError, OSError) as e:
+        # e.g. truncated by a power cut before the atomic writes, start again from MQ4_R0/TGS_R0
+        print(f"ignoring the saved calibration {autocal_path}: {e}")
+    return calibrators
+
+def save_calibration(calibrators):
+    # a full or read-only card must not stop sampling, the next save tries again
+    try:
+        save_state(autocal_path, calibrators)
+    except OSError as e:
+        metrics.count("autocal_save_errors")
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: could not save {autocal_path}: {e}")
+
+def ambient_conditions(extra):
+    # (temperature, humidity) of the SHT20 poller, (None, None) without one, None while it has no fresh values
+    if extra is None or "SHT20" not in extra.pollers:
+        return None, None
+    poller = extra.pollers["SHT20"]
+    sht, read_time = poller.latest()
+    if sht is None or time.time() - read_time > poller.stale_after:
+        return None
+    return sht["temperature"], sht["humidity"]
+
+def setup_extra_sensors(i2c, mht7042a_serial=None):
+    # Each sensor gets its own poller so a slow or hung device cannot stall the others
+    if not extra_sensors:
+        return None
+    scheduler = SensorScheduler()
+    if "SHT20" in extra_sensors:
+        sht20_sensor = multisensor.SHT20Sensor()
+        sht20_sensor.sht = i2c_arbiter.wrap(sht20_sensor.sht, "sht20")
+        scheduler.add(
+            "SHT20",
+            lambda: {"temperature": sht20_sensor.read_temperature(), "humidity": sht20_sensor.read_humidity()},
+            float(os.getenv("SHT20_INTERVAL", 10)),
+        )
+    if "SGP30" in extra_sensors:
+        sgp30_sensor = multisensor.SGP30GasSensor(i2c)
+        # wrap the driver, not SGP30GasSensor: self_calibration() sleeps a second between bus accesses
+        sgp30_sensor.sgp30 = i2c_arbiter.wrap(sgp30_sensor.sgp30, "sgp30")
+
+        def read_sgp30():
+            eCO2, TVOC = sgp30_sensor.read_eCO2_TVOC()
+            sht = scheduler.latest("SHT20") if "SHT20" in scheduler.pollers else None
+            if sht is not None:
+                # sleeps for a second, but only on the SGP30 thread
+                sgp30_sensor.self_calibration(sht["temperature"], sht["humidity"])
+            return {"eCO2": eCO2, "TVOC": TVOC}
+
+        scheduler.add("SGP30", read_sgp30, float(os.getenv("SGP30_INTERVAL", 1)))
+    if "MHT7042A" in extra_sensors:
+        mht7042a_interval = float(os.getenv("MHT7042A_INTERVAL", 2))
+        # the driver polls the UART on its own thread; read_ch4() only returns its cached value
+        mht7042a_sensor = multisensor.MHT7042A(ser=mht7042a_serial, poll_interval=mht7042a_interval)
+
+        def read_mht7042a():
+            ch4 = mht7042a_sensor.read_ch4()
+            return None if ch4 is None else {"CH4": ch4}
+
+        scheduler.add("MHT7042A", read_mht7042a, mht7042a_interval)
+    return scheduler.start()
+
+def take_sample(mq4_sensor, tgs_sensor, burst_sampler, extra=None, calibrators=None):
+    # get thi from sensor. and return the data like below
+    if calibrators:
+        conditions = ambient_conditions(extra)
+        stale = conditions is None
+        if stale:
+            # convert at the reference R0 rather than with conditions that may be long gone
+            conditions = (None, None)
+        mq4_sensor.R0 = calibrators["mq4"].effective_r0(*conditions)
+        tgs_sensor.R0 = calibrators["tgs"].effective_r0(*conditions)
+    with metrics.timer("adc_read"):
+        if burst_sampler is None:
+            # both channels in one bus hold
+            with i2c_arbiter.use("ads1115", SENSOR):
+                mq4_ch4, mq4_voltage = mq4_sensor.read_ppm()
+                tgs_ch4, tgs_voltage = tgs_sensor.read_ppm()
+        else:
+            # one transaction per conversion, the pacing sleeps in between leave the bus to others
+            voltages, voltage_stds = burst_sampler.read()
+            mq4_ch4, mq4_voltage = mq4_sensor.read_ppm(float(voltages[0]))
+            tgs_ch4, tgs_voltage = tgs_sensor.read_ppm(float(voltages[1]))
+    if calibrators and stale:
+        # uncompensated Rs would bias an epoch of compensated ones, leave the reading out
+        metrics.count("autocal_stale_skips")
+    elif calibrators:
+        # both calibrators share the epoch length, so they close their epochs together
+        mq4_closed = calibrators["mq4"].update(mq4_voltage, *conditions)
+        if calibrators["tgs"].update(tgs_voltage, *conditions) or mq4_closed:
+            save_calibration(calibrators)
+
+    now = datetime.utcnow()
+    sample = {"time": now, "MQ4": mq4_ch4, "TGS": tgs_ch4, "MQ4_voltage": mq4_voltage, "TGS_voltage": tgs_voltage}
+    record = {"node": node, "MQ4": mq4_ch4, "TGS": tgs_ch4, "TGS_voltage": tgs_voltage, "timestamp": now.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    if burst_sampler is not None:
+        record["MQ4_voltage_std"] = round(float(voltage_stds[0]), 4)
+        record["TGS_voltage_std"] = round(float(voltage_stds[1]), 4)
+    if extra is not None:
+        record.update(extra.snapshot())
+    # stamped before the uploader's bounded queue, so a reading dropped there leaves a hole
+    return sample, stamp_sequence(record)
+
+def lcd_lines(sample):
+    # ppm is None while a sensor reads out of range, e.g. unplugged
+    return [f"{name}: " + ("--" if sample[name] is None else f"{sample[name]:.2f} ppm") for name in ("MQ4", "TGS")]
+
+# ===== Local logging stage =====
+def open_archive_writers():
+    ppm_writer = voltage_writer = bin_writer = None
+    if archive_format in ("csv", "both"):
+        ppm_writer = DailyCsvWriter(
+            os.path.join(data_dir, f"node{node}_{{date}}.csv"),
+            [["node", node], ["time", "MQ4", "TGS2611"]],
+            flush_interval=csv_flush_interval,
+            fsync=csv_fsync,
+        )
+        voltage_writer = DailyCsvWriter(
+            os.path.join(data_dir, f"node{node}_{{date}}_voltage.csv"),
+            [["node", node], ["time", "MQ4_voltage", "TGS2611_voltage"]],
+            flush_interval=csv_flush_interval,
+            fsync=csv_fsync,
+        )
+    if archive_format in ("bin", "both"):
+        bin_writer = DailyBinaryWriter(
+            os.path.join(data_dir, f"node{node}_{{date}}.bin"),
+            flush_interval=csv_flush_interval,
+            fsync=csv_fsync,
+        )
+    return ppm_writer, voltage_writer, bin_writer
+
+def save_data_local(sample, ppm_writer, voltage_writer, bin_writer):
+    now = sample["time"]
+    timestamp = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+    with metrics.timer("archive_write"):
+        if ppm_writer is not None:
+            ppm_writer.writerow(now, [timestamp, sample["MQ4"], sample["TGS"]])
+            voltage_writer.writerow(now, [timestamp, sample["MQ4_voltage"], sample["TGS_voltage"]])
+        if bin_writer is not None:
+            bin_writer.write(sample)
+
+# ===== Upload stage =====
+def data_topic():
+    prefix = "bin" if wire_format_name == "binary" else "data"
+    return f"{prefix}/{location}/sensors/{node}"
+
+def payload_encoder():
+    return wire_format.encode_batch if wire_format_name == "binary" else encode_batch
+
+def upload_stage(record, aggregator, batcher, publisher):
+    # Readings go into the loss queue first and are only deleted there once the broker acked them
+    for out in aggregator.add(record):
+        for batch in batcher.add(out):
+            with metrics.timer("enqueue"):
+                publisher.enqueue(batch)
+    with metrics.timer("publish"):
+        publisher.pump(mqtt_connected.is_set())
+
+def upload_idle(batcher, publisher):
+    # Store a batch that waited long enough and keep draining the backlog between samples
+    if batcher.is_due():
+        with metrics.timer("enqueue"):
+            publisher.enqueue(batcher.flush())
+    if mqtt_connected.is_set() and len(publisher.loss_queue):
+        with metrics.timer("backlog_replay"):
+            publisher.pump()
+
+def start_stages(archive_writers, aggregator, batcher, publisher):
+    # sampler (main thread) -> writer stage (SD card) and uploader stage (broker / backlog)
+    ppm_writer, voltage_writer, bin_writer = archive_writers
+    open_writers = [w for w in archive_writers if w is not None]
+    writer = Stage(
+        "writer",
+        lambda sample: save_data_local(sample, ppm_writer, voltage_writer, bin_writer),
+        maxsize=queue_size,
+        on_idle=lambda: [w.flush_if_due() for w in open_writers],
+    ).start()
+    uploader = Stage(
+        "uploader",
+        lambda record: upload_stage(record, aggregator, batcher, publisher),
+        maxsize=queue_size,
+        on_idle=lambda: upload_idle(batcher, publisher),
+    ).start()
+    return writer, uploader
+
+def stop_stages(writer, uploader, archive_writers, aggregator, batcher, publisher):
+    writer.stop()
+    for w in archive_writers:
+        if w is not None:
+            w.close()
+    uploader.stop()
+    # the partial window is sent rather than lost
+    for out in aggregator.flush():
+        for batch in batcher.add(out):
+            publisher.enqueue(batch)
+    publisher.enqueue(batcher.flush())
+
+def print_stats(scheduler, stages):
+    stats = {"sampler": scheduler.stats()}
+    for stage in stages:
+        stats[stage.name] = stage.stats()
+    print(" " * 100, end="\r")
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {stats}")
+
+def register_gauges(scheduler, writer, uploader, loss_queue):
+    metrics.gauge("mqtt_connected", lambda: int(mqtt_connected.is_set()))
+    metrics.gauge("backlog", lambda: len(loss_queue))
+    metrics.gauge("inflight", publisher.inflight)
+    metrics.gauge("sampler", scheduler.stats)
+    metrics.gauge("writer", writer.stats)
+    metrics.gauge("uploader", uploader.stats)
+    metrics.gauge("i2c", i2c_arbiter.stats)
+
+def publish_metrics(interval):
+    # QoS 0 and not via the loss queue: a lost metrics record is not worth a retry
+    fields = metrics.snapshot()
+    fields["sample_rate_hz"] = round(fields.pop("samples", 0) / interval, 3)
+    payload = {"node": node, "timestamp": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+    payload.update(fields)
+    client.publish(f"metrics/{location}/{node}", json.dumps(payload))
 
 if __name__ == "__main__":
     print(f"node: {node}")
@@ -124,101 +604,100 @@ if __name__ == "__main__":
     print("demo: use ctrl-c to exit the program")
     print()
 
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-    mqttSetupStatus = False
-    if have_internet():
-        mqtt_connect_setup()
-        mqttSetupStatus = True
+    # A fixed client id and clean_session=False keep the broker session (and QoS 1 state) across reconnects
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"ch4-{location}-{node}", clean_session=False)
 ### for sensors
-    # Create the I2C bus
-    i2c = busio.I2C(board.SCL, board.SDA, frequency=100000)
-    ads = ADS.ADS1115(i2c)
-    ads.gain = 1
-    chan0 = AnalogIn(ads, ADS.P0)
-    chan1 = AnalogIn(ads, ADS.P1)
-    mq4_sensor = multisensor.MQ4GasSensor(chan0, R0=MQ4_R0)
-    tgs_sensor = multisensor.TGS2611(chan1, R0=TGS_R0)
-
-    lcd = LCD()
+    i2c, ads, chan0, chan1, lcd = setup_hardware()
+    lcd_worker = LcdWorker(lcd, refresh_hz=lcd_refresh_hz, metrics=metrics).start()
+    mq4_sensor, tgs_sensor, burst_sampler = setup_sensors(ads, chan0, chan1)
+    extra = setup_extra_sensors(i2c)
+    calibrators = setup_calibrators()
+
+    loss_queue = LossQueue(os.path.join(data_dir, f"node{node}_loss_data.db"))
+    imported = loss_queue.import_csv(os.path.join(data_dir, f"node{node}_loss_data.csv"), node)
+    if imported:
+        print(f"moved {imported} rows from the old loss data csv into the queue")
+    aggregator = EdgeAggregator(
+        agg_window, threshold=agg_ppm_threshold, rate_threshold=agg_rate_threshold, hold=agg_hold,
+    )
+    batcher = PayloadBatcher(batch_max_records, batch_max_bytes, batch_max_latency)
+    publisher = ReliablePublisher(
+        client, loss_queue, data_topic(), qos=mqtt_qos,
+        max_inflight=mqtt_max_inflight, max_records=batch_max_records, max_bytes=batch_max_bytes,
+        read_size=loss_batch_size, ack_timeout=ack_timeout, encode=payload_encoder(),
+    )
+    client.on_publish = publisher.on_publish
+    scheduler = FixedRateScheduler(sample_period)
+    register_tunables(scheduler, mq4_sensor, tgs_sensor, aggregator, calibrators)
+    try:
+        overrides = load_config_overrides()
+        if calibrators:
+            # the calibration state file already holds the newest R0, including ones set by fleetctl
+            overrides.pop("mq4_r0", None)
+            overrides.pop("tgs_r0", None)
+        apply_config(overrides)
+    except ValueError as e:
+        # e.g. saved by an older version that accepted it; starting on .env beats crashing on every restart
+        print(f"ignoring the saved config {config_path}: {e}")
+    mqtt_connect_setup()
+
+    archive_writers = open_archive_writers()
+    writer, uploader = start_stages(archive_writers, aggregator, batcher, publisher)
+    query_server = None
+    if query_port:
+        query_server = QueryServer(data_dir, node, (query_bind, query_port), query_token).start()
+        metrics.gauge("query", query_server.stats)
+    register_gauges(scheduler, writer, uploader, loss_queue)
+    if calibrators:
+        metrics.gauge("mq4_cal", calibrators["mq4"].stats)
+        metrics.gauge("tgs_cal", calibrators["tgs"].stats)
+    last_stats = last_metrics = last_cal_save = time.monotonic()
 
     try:
         while True:
+            loop_start = time.perf_counter()
             if not is_stop:
                 print(
                     f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:"
                     " ...Colleting data",
                     end="\r",
                 )
-            # TODO: write yout logic here
 
-            # get thi from sensor. and return the data like below
-                mq4_ch4, mq4_voltage = mq4_sensor.read_ppm()
-                tgs_ch4, tgs_voltage = tgs_sensor.read_ppm()
-            # print("MQ4 ppm:", mq4_ch4, "Voltage:", mq4_voltage)
-                #print("TGS ppm:", tgs_ch4, "Voltage:", tgs_voltage)
-
-                lcd.text(f"MQ4: {mq4_ch4:.2f} ppm", 1)
-                lcd.text(f"TGS: {tgs_ch4:.2f} ppm", 2)
-                
-                now = datetime.utcnow()
-                 
-                
-            # ===== Save the data to a local file =====
-                file_path = f"/home/pi/CH4_data/node{node}_{datetime.now().strftime('%Y%m%d')}.csv"
-                file_exist = os.path.exists(file_path)
-                with open(file_path, 'a') as f:
-                    # now = datetime.now()
-
-                    writer_object =csv.writer(f)
-                    if not file_exist:
-                        writer_object.writerow(["node", node])
-                        writer_object.writerow(["time", "MQ4", "TGS2611"])
-
-                    writer_object.writerow([now.strftime('%Y-%m-%dT%H:%M:%SZ'), mq4_ch4, tgs_ch4])
-                    f.close()
-
-                file_path_voltage = f"/home/pi/CH4_data/node{node}_{datetime.now().strftime('%Y%m%d')}_voltage.csv"
-                file_voltage_exist = os.path.exists(file_path_voltage)
-
-                with open(file_path_voltage, 'a') as f:
-                    # now = datetime.now()
-
-                    writer_object =csv.writer(f)
-                    if not file_voltage_exist:
-                        writer_object.writerow(["node", node])
-                        writer_object.writerow(["time", "MQ4_voltage", "TGS2611_voltage"])
-
-                    writer_object.writerow([now.strftime('%Y-%m-%dT%H:%M:%SZ'), mq4_voltage, tgs_voltage])
-                    f.close()
-
-            # ===== Save data to server =====
-                data = json.dumps(
-                    {"node": node, "MQ4": mq4_ch4, "TGS": tgs_ch4, "TGS_voltage": tgs_voltage, "timestamp": now.strftime('%Y-%m-%dT%H:%M:%SZ')}
-                )
-                loss_data_file_path = f"/home/pi/CH4_data/node{node}_loss_data.csv"
-                if have_internet():
-                    if not mqttSetupStatus:
-                        mqtt_connect_setup()
-                        mqttSetupStatus = True
-                    
-                    thread1 = threading.Thread(target=upload_data, args=(data,))
-                    thread2 = threading.Thread(target=send_loss_data, args=(loss_data_file_path,))
-
-                    thread1.start()
-                    thread2.start()
-                    thread1.join()
-                    thread2.join()
-                else:
-                    with open(loss_data_file_path, 'a') as f:
-                        writer_object =csv.writer(f)
-                        writer_object.writerow([now.strftime('%Y-%m-%dT%H:%M:%SZ'), mq4_ch4, tgs_ch4])
-    # print(now)
-            time.sleep(1)
+                sample, record = take_sample(mq4_sensor, tgs_sensor, burst_sampler, extra, calibrators)
+
+                lcd_worker.show(*lcd_lines(sample))
+
+            # ===== Hand off to the local logging and upload stages =====
+                writer.submit(sample)
+                uploader.submit(record)
+                metrics.count("samples")
+            metrics.observe("loop", time.perf_counter() - loop_start)
+
+            if time.monotonic() - last_stats >= stats_interval:
+                last_stats = time.monotonic()
+                print_stats(scheduler, [writer, uploader, aggregator, publisher, lcd_worker] + ([extra] if extra else []))
+            if metrics_interval and time.monotonic() - last_metrics >= metrics_interval:
+                elapsed = time.monotonic() - last_metrics
+                last_metrics = time.monotonic()
+                publish_metrics(elapsed)
+            if calibrators and time.monotonic() - last_cal_save >= autocal_save_interval:
+                # the running epoch survives a restart, at most one interval of readings is lost
+                last_cal_save = time.monotonic()
+                save_calibration(calibrators)
+            metrics.observe("loop_jitter", scheduler.wait())
     except KeyboardInterrupt:
         pass
     finally:
+        if extra is not None:
+            extra.stop()
+        if query_server is not None:
+            query_server.shutdown()
+        lcd_worker.stop()
         lcd.clear()
+        stop_stages(writer, uploader, archive_writers, aggregator, batcher, publisher)
+        loss_queue.close()
+        if calibrators:
+            save_calibration(calibrators)
 
     # NOTE: this shouldn't be execute. Use kill to close the program
     # client.loop_stop()
-
@@ -0,0 +1,128 @@
+import queue
+import threading
+import time
+
+
+class Stage:
+    """
+    Worker thread that consumes items from a bounded queue.
+
+    The producer calls submit(), which never blocks: when the queue is full the item is
+    dropped and counted, so a slow SD card or broker cannot hold up the sampler.
+    """
+
+    def __init__(self, name, handler, maxsize=600, on_idle=None, idle_interval=1.0):
+        """
+        Args:
+            name (str): Name used in the stats output
+            handler (callable): Called with every submitted item on the worker thread
+            maxsize (int): Queue capacity
+            on_idle (callable): Optional housekeeping, called at least every idle_interval seconds
+            idle_interval (float): Seconds between on_idle calls
+        """
+        self.name = name
+        self.handler = handler
+        self.on_idle = on_idle
+        self.idle_interval = idle_interval
+        self.queue = queue.Queue(maxsize)
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, item):
+        """Queue an item without blocking. Returns False if it had to be dropped."""
+        self.submitted += 1
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def stop(self, timeout=10):
+        """Process what is still queued, then stop the worker."""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "max_queued": self.max_depth,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        last_idle = time.monotonic()
+        while not (self._stop.is_set() and self.queue.empty()):
+            try:
+                item = self.queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                item = None
+            else:
+                self._call(self.handler, item)
+                self.processed += 1
+            if self.on_idle is not None and time.monotonic() - last_idle >= self.idle_interval:
+                last_idle = time.monotonic()
+                self._call(self.on_idle)
+        if self.on_idle is not None:
+            self._call(self.on_idle)
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            # Keep the worker alive, one bad item must not stop logging or uploading
+            self.errors += 1
+            print(f"{self.name} error: {e}")
+
+
+class FixedRateScheduler:
+    """
+    Drift-free fixed-rate ticker based on monotonic deadlines.
+
+    Every deadline is computed from the start time, not from when the previous tick
+    finished, so the work done in a tick does not stretch the period. When a tick runs
+    past one or more deadlines those ticks are skipped and counted as overruns.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.ticks = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self._next = time.monotonic() + period
+
+    def wait(self):
+        """
+        Sleep until the next deadline.
+
+        Returns:
+            float: Seconds between the deadline and the actual wake-up (loop jitter)
+        """
+        now = time.monotonic()
+        lateness = now - self._next
+        if lateness > 0:
+            self.max_lateness = max(self.max_lateness, lateness)
+            missed = int(lateness // self.period)
+            self.overruns += missed
+            self._next += missed * self.period
+        else:
+            time.sleep(-lateness)
+            lateness = time.monotonic() - self._next
+        self._next += self.period
+        self.ticks += 1
+        return lateness
+
+    def stats(self):
+        return {"ticks": self.ticks, "overruns": self.overruns, "max_lateness": round(self.max_lateness, 3)}
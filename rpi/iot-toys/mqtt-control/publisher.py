@@ -0,0 +1,158 @@
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from batching import encode_batch, split_batches
+
+
+class ReliablePublisher:
+    """
+    Publish readings from the LossQueue and delete them only once they are delivered.
+
+    Readings are written to the queue first. pump() sends queued rows in batches, keeping
+    at most max_inflight messages unacknowledged, and remembers which rows every message
+    carries. A row leaves the queue when paho reports the message through on_publish,
+    i.e. on PUBACK for QoS 1. Messages that are not acknowledged within ack_timeout, and
+    everything still queued after a restart, are sent again. Duplicates are harmless
+    because InfluxDB keeps one point per node and timestamp.
+    """
+
+    def __init__(self, client, loss_queue, topic, qos=1, max_inflight=20, max_records=1,
+                 max_bytes=16384, read_size=100, ack_timeout=60.0, encode=encode_batch):
+        """
+        Args:
+            client: paho Client, connected with clean_session=False for QoS 1
+            loss_queue (LossQueue): Durable queue the readings are kept in until delivered
+            topic (str): Topic to publish on
+            qos (int): MQTT QoS of the data messages
+            max_inflight (int): Messages allowed to wait for their acknowledgement
+            max_records (int): Readings per message (see batching.split_batches)
+            max_bytes (int): Maximum message size
+            read_size (int): Rows read from the queue per pump step
+            ack_timeout (float): Seconds after which an unacknowledged message is sent again
+            encode (callable): Turns a list of readings into a payload, e.g. wire_format.encode_batch
+        """
+        self.name = "publisher"
+        self.client = client
+        self.loss_queue = loss_queue
+        self.topic = topic
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.read_size = read_size
+        self.ack_timeout = ack_timeout
+        self.encode = encode
+        self.published = 0
+        self.delivered = 0
+        self.resent = 0
+        self.rejected = 0
+        self._inflight = {}  # mid -> (row ids, send time)
+        self._early_acks = {}  # mid -> time, on_publish that arrived before publish() returned
+        self._cursor = 0  # highest row id handed to the client
+        self._lock = threading.Lock()
+
+    def enqueue(self, records):
+        """Store readings durably; pump() sends them."""
+        self.loss_queue.push_many(records)
+
+    def on_publish(self, client, userdata, mid):
+        """paho on_publish callback (VERSION1 signature)."""
+        _ = client, userdata
+        with self._lock:
+            entry = self._inflight.pop(mid, None)
+            if entry is None:
+                self._early_acks[mid] = time.monotonic()
+                return
+        self._delivered(entry[0])
+
+    def pump(self, connected=True):
+        """
+        Send queued rows until the in-flight window is full or the queue is drained.
+
+        Returns:
+            int: Number of readings handed to the client
+        """
+        if not connected:
+            return 0
+        self._expire()
+        sent = 0
+        while True:
+            with self._lock:
+                room = self.max_inflight - len(self._inflight)
+                cursor = self._cursor
+            if room <= 0:
+                break
+            rows = self.loss_queue.peek(self.read_size, after_id=cursor)
+            if not rows:
+                break
+            offset = 0
+            for batch in split_batches([record for _, record in rows], self.max_records, self.max_bytes):
+                ids = [row_id for row_id, _ in rows[offset:offset + len(batch)]]
+                if not self._send(batch, ids):
+                    return sent
+                offset += len(batch)
+                sent += len(batch)
+                room -= 1
+                if room <= 0:
+                    break
+            if offset < len(rows):
+                break
+        return sent
+
+    def reconnected(self):
+        """Call from on_connect: paho resends in-flight messages itself, restart their ack timers."""
+        now = time.monotonic()
+        with self._lock:
+            for mid, (ids, _) in list(self._inflight.items()):
+                self._inflight[mid] = (ids, now)
+
+    def inflight(self):
+        with self._lock:
+            return len(self._inflight)
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "delivered": self.delivered,
+            "inflight": self.inflight(),
+            "resent": self.resent,
+            "rejected": self.rejected,
+            "backlog": len(self.loss_queue),
+        }
+
+    def _send(self, batch, ids):
+        info = self.client.publish(self.topic, self.encode(batch), qos=self.qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            # not even queued by paho (disconnected or its queue is full), try again later
+            self.rejected += 1
+            return False
+        self.published += 1
+        with self._lock:
+            self._cursor = max(self._cursor, ids[-1])
+            acked = self._early_acks.pop(info.mid, None) is not None
+            if not acked:
+                self._inflight[info.mid] = (ids, time.monotonic())
+        if acked:
+            self._delivered(ids)
+        return True
+
+    def _delivered(self, ids):
+        self.loss_queue.ack(ids)
+        self.delivered += len(ids)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            for mid, t in list(self._early_acks.items()):
+                if now - t > self.ack_timeout:
+                    del self._early_acks[mid]
+            expired = [mid for mid, (_, t) in self._inflight.items() if now - t > self.ack_timeout]
+            if not expired:
+                return
+            # rewind to the oldest unacknowledged row and send everything from there again
+            oldest = min(ids[0] for ids, _ in self._inflight.values())
+            self.resent += len(expired)
+            self._inflight.clear()
+            self._cursor = oldest - 1
@@ -0,0 +1,421 @@
+"""
+Local HTTP query API over the daily archives of a node.
+
+Lets a field laptop pull just the window it needs over a weak link, instead of
+copying whole CSV days when the node cannot reach the broker:
+    GET /days                      archived days, formats and sizes (JSON)
+    GET /query?start=...&end=...   readings, streamed as CSV (or format=ndjson)
+        start, end   UTC 'YYYY-mm-ddTHH:MM:SS' (optionally with Z) or epoch seconds;
+                     default the last hour
+        step         seconds per downsampled row, aligned to the UTC clock (0 = every reading)
+        agg          mean, min, max or last per step (default mean)
+        fields       comma separated, from MQ4, TGS, MQ4_voltage, TGS_voltage (default MQ4,TGS)
+        format       csv or ndjson
+
+Responses are chunked and gzip compressed when the client accepts it, and rows are
+written while the archives are read, so neither side holds the result in memory.
+A .bin archive of a day is read through its .idx file; CSV archives get an in-memory
+index of the byte offset of every CSV_INDEX_STRIDE-th row, built on first use and
+extended as the node appends. A query reads only the rows it returns. The newest
+CSV_FLUSH_INTERVAL seconds may still be in the node's write buffer.
+
+A CSV day whose rows are not in time order (the clock stepped back) is read in full
+and sorted. Archives written before the daily files were named after the UTC date
+are named after the node's local date, so the files of the neighbouring days are
+read as well; a step that straddles the switch may then come out as two rows.
+
+Started by node_client_thread.py when QUERY_PORT is set, or on its own:
+    python query_server.py --dir /home/pi/CH4_data --node 04 --port 8080
+    curl --compressed 'http://node04:8080/query?start=2024-05-01T06:00:00&end=2024-05-01T09:00:00&step=60'
+"""
+import argparse
+import bisect
+import calendar
+import json
+import math
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import binary_archive
+
+FIELDS = ("MQ4", "TGS", "MQ4_voltage", "TGS_voltage")
+AGGREGATES = ("mean", "min", "max", "last")
+CSV_INDEX_STRIDE = 600
+CHUNK_SIZE = 16384
+
+
+def parse_time(value):
+    """Epoch seconds from 'YYYY-mm-ddTHH:MM:SS[Z]' (UTC) or a number of epoch seconds."""
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        if not math.isfinite(seconds):
+            raise ValueError(f"invalid time {value!r}")
+        return seconds
+    timestamp = datetime.fromisoformat(value.rstrip("Z"))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return calendar.timegm(timestamp.timetuple())
+
+
+def _epoch(timestamp):
+    # fixed 'YYYY-mm-ddTHH:MM:SSZ' layout, see wire_format.epoch_ms
+    return calendar.timegm((
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+    ))
+
+
+def _parse_row(line):
+    """(epoch seconds, first value, second value) of a 'time,a,b' archive row, None for other lines."""
+    parts = line.split(b",")
+    if len(parts) != 3 or len(parts[0]) != 20:
+        return None
+    try:
+        return _epoch(parts[0].decode("ascii")), _number(parts[1]), _number(parts[2])
+    except ValueError:
+        return None
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
+class CsvIndex:
+    """
+    Byte offsets of every `stride`-th row of one daily CSV archive.
+
+    Only complete lines are indexed, and refresh() continues from where the last scan
+    stopped, so the file of the current day costs a scan of the new rows only.
+    """
+
+    def __init__(self, path, stride=CSV_INDEX_STRIDE):
+        self.path = path
+        self.stride = stride
+        self.times = []
+        self.offsets = []
+        self.rows = 0
+        self.scanned = 0  # bytes indexed so far, always at a line boundary
+        self.in_order = True  # no row older than the one before it, so the offsets can be bisected
+        self._last = None
+
+    def refresh(self):
+        size = os.path.getsize(self.path)
+        if size < self.scanned:  # replaced or truncated, start over
+            self.times, self.offsets, self.rows, self.scanned = [], [], 0, 0
+            self.in_order, self._last = True, None
+        if size == self.scanned:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.scanned)
+            offset = self.scanned
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # the node is still writing this row
+                row = _parse_row(line)
+                if row is not None:
+                    if self._last is not None and row[0] < self._last:
+                        self.in_order = False
+                    self._last = row[0]
+                    if self.rows % self.stride == 0:
+                        self.times.append(row[0])
+                        self.offsets.append(offset)
+                    self.rows += 1
+                offset += len(line)
+        self.scanned = offset
+
+    def offset(self, start):
+        """Offset of an indexed row at or before `start`, where a scan for `start` can begin."""
+        if not self.in_order:
+            return 0
+        i = bisect.bisect_right(self.times, start) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+
+class ArchiveReader:
+    """Time-range reads over the node{node}_YYYYMMDD archives of one node."""
+
+    def __init__(self, directory, node):
+        self.directory = directory
+        self.node = node
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def path(self, day, suffix):
+        return os.path.join(self.directory, f"node{self.node}_{day.strftime('%Y%m%d')}{suffix}")
+
+    def days(self):
+        prefix = f"node{self.node}_"
+        days = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.startswith(prefix):
+                continue
+            stem, ext = os.path.splitext(name[len(prefix):])
+            if len(stem) == 8 and stem.isdigit() and ext in (".csv", ".bin"):
+                day = days.setdefault(stem, {"day": stem, "formats": [], "bytes": 0})
+                day["formats"].append(ext[1:])
+                day["bytes"] += os.path.getsize(os.path.join(self.directory, name))
+        return list(days.values())
+
+    def rows(self, start, end, fields=FIELDS):
+        """Yield (epoch seconds, values in FIELDS order, None where missing) with start <= time < end."""
+        # one day either side: older archives are named after the local date (see the module docstring)
+        day = datetime.utcfromtimestamp(start).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        while calendar.timegm(day.timetuple()) < end + 86400:
+            bin_path = self.path(day, ".bin")
+            csv_path = self.path(day, ".csv")
+            if os.path.exists(bin_path):
+                yield from self._bin_rows(bin_path, start, end)
+            elif os.path.exists(csv_path):
+                voltages = any(field.endswith("_voltage") for field in fields)
+                yield from self._csv_rows(csv_path, start, end, voltages)
+            day += timedelta(days=1)
+
+    def _bin_rows(self, path, start, end):
+        records = binary_archive.read_range(path, int(start * 1000), int(math.ceil(end) * 1000))
+        for i in range(0, len(records), 4096):
+            chunk = records[i:i + 4096]
+            columns = [chunk[field].tolist() for field in FIELDS]
+            for time_ms, *values in zip(chunk["time_ms"].tolist(), *columns):
+                # float32 values, rounded back to the digits the node measured
+                yield time_ms / 1000, [float(f"{v:.7g}") if math.isfinite(v) else None for v in values]
+
+    def _scan(self, path, start, end):
+        """Rows of one CSV archive with start <= time < end, in time order."""
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is None:
+                index = self._indexes[path] = CsvIndex(path)
+            index.refresh()
+            offset, scanned, in_order = index.offset(start), index.scanned, index.in_order
+        rows = self._read(path, offset, scanned, start, end, in_order)
+        return rows if in_order else iter(sorted(rows, key=lambda row: row[0]))
+
+    @staticmethod
+    def _read(path, offset, scanned, start, end, in_order):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            position = offset
+            for line in f:
+                position += len(line)
+                if position > scanned:
+                    break  # beyond the indexed, complete lines
+                row = _parse_row(line)
+                if row is None or row[0] < start:
+                    continue
+                if row[0] >= end:
+                    if in_order:
+                        break
+                    continue
+                yield row
+
+    def _csv_rows(self, path, start, end, voltages):
+        voltage_path = path[:-len(".csv")] + "_voltage.csv"
+        voltage_rows = self._scan(voltage_path, start, end) if voltages and os.path.exists(voltage_path) else iter(())
+        pending = next(voltage_rows, None)
+        for t, mq4, tgs in self._scan(path, start, end):
+            # both files get one row per sample, in the same order; match them by time
+            while pending is not None and pending[0] < t:
+                pending = next(voltage_rows, None)
+            if pending is not None and pending[0] == t:
+                yield t, [mq4, tgs, pending[1], pending[2]]
+            else:
+                yield t, [mq4, tgs, None, None]
+
+
+def downsample(rows, step, agg):
+    """Reduce rows to one per `step` seconds, stamped with the start of the step."""
+    bucket = None
+    count = 0
+    acc = []
+    for t, values in rows:
+        b = t - t % step
+        if b != bucket:
+            if bucket is not None:
+                yield bucket, _reduce(acc, agg), count
+            bucket = b
+            count = 0
+            acc = [[0.0, 0] if agg == "mean" else None for _ in values]
+        count += 1
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            if agg == "mean":
+                acc[i][0] += value
+                acc[i][1] += 1
+            elif agg == "last" or acc[i] is None:
+                acc[i] = value
+            elif agg == "min":
+                acc[i] = min(acc[i], value)
+            else:
+                acc[i] = max(acc[i], value)
+    if bucket is not None:
+        yield bucket, _reduce(acc, agg), count
+
+
+def _reduce(acc, agg):
+    if agg == "mean":
+        return [round(total / n, 4) if n else None for total, n in acc]
+    return acc
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ch4-query/1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        token = self.server.token
+        if token and params.get("token") != token and self.headers.get("Authorization") != f"Bearer {token}":
+            self._send_json(401, {"error": "missing or wrong token"})
+            return
+        try:
+            if url.path == "/days":
+                self._send_json(200, self.server.reader.days())
+            elif url.path == "/query":
+                self._query(params)
+            else:
+                self._send_json(404, {"error": f"unknown path {url.path}"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up, e.g. a dropped link
+
+    def _query(self, params):
+        try:
+            end = parse_time(params["end"]) if "end" in params else time.time()
+            start = parse_time(params["start"]) if "start" in params else end - 3600
+            step = float(params.get("step", 0))
+            agg = params.get("agg", "mean")
+            fields = params.get("fields", "MQ4,TGS").split(",")
+            output = params.get("format", "csv")
+            if agg not in AGGREGATES:
+                raise ValueError(f"agg must be one of {', '.join(AGGREGATES)}")
+            unknown = [field for field in fields if field not in FIELDS]
+            if unknown:
+                raise ValueError(f"unknown fields {unknown}, choose from {', '.join(FIELDS)}")
+            if output not in ("csv", "ndjson"):
+                raise ValueError("format must be csv or ndjson")
+            if step < 0 or end <= start:
+                raise ValueError("need start < end and step >= 0")
+        except (KeyError, ValueError, OverflowError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        columns = [FIELDS.index(field) for field in fields]
+        rows = self.server.reader.rows(start, end, fields)
+        if step:
+            rows = downsample(rows, step, agg)
+            names = ["time"] + fields + ["samples"]
+        else:
+            rows = ((t, values, None) for t, values in rows)
+            names = ["time"] + fields
+
+        gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv" if output == "csv" else "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        if gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+        buffer = []
+        size = 0
+        if output == "csv":
+            buffer.append(",".join(names) + "\n")
+        count = 0
+        for t, values, samples in rows:
+            row = [time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))] + [values[i] for i in columns]
+            if samples is not None:
+                row.append(samples)
+            if output == "csv":
+                line = ",".join("" if v is None else str(v) for v in row) + "\n"
+            else:
+                line = json.dumps(dict(zip(names, row))) + "\n"
+            buffer.append(line)
+            size += len(line)
+            count += 1
+            if size >= CHUNK_SIZE:
+                self._write_chunk("".join(buffer).encode(), compressor)
+                buffer, size = [], 0
+        self._write_chunk("".join(buffer).encode(), compressor)
+        if compressor is not None:
+            self._write_raw_chunk(compressor.flush())
+        self.wfile.write(b"0\r\n\r\n")
+        self.server.count(count)
+
+    def _write_chunk(self, data, compressor):
+        self._write_raw_chunk(compressor.compress(data) if compressor is not None else data)
+
+    def _write_raw_chunk(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: query {self.address_string()} {format % args}")
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server over the archives of one node, see the module docstring for the API."""
+
+    daemon_threads = True
+
+    def __init__(self, directory, node, address=("", 8080), token=None):
+        super().__init__(address, QueryHandler)
+        self.name = "query"
+        self.reader = ArchiveReader(directory, node)
+        self.token = token
+        self.queries = 0
+        self.rows_sent = 0
+        self._lock = threading.Lock()
+
+    def count(self, rows):
+        with self._lock:
+            self.queries += 1
+            self.rows_sent += rows
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="query", daemon=True).start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {"queries": self.queries, "rows_sent": self.rows_sent}
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Serve time-range queries over a node's daily archives")
+    parser.add_argument("--dir", default=os.getenv("DATA_DIR", "/home/pi/CH4_data"))
+    parser.add_argument("--node", default=os.getenv("NODE"))
+    parser.add_argument("--bind", default=os.getenv("QUERY_BIND", ""))
+    parser.add_argument("--port", type=int, default=int(os.getenv("QUERY_PORT") or 8080))
+    parser.add_argument("--token", default=os.getenv("QUERY_TOKEN") or None, help="require ?token= or a Bearer header")
+    args = parser.parse_args()
+    server = QueryServer(args.dir, args.node, (args.bind, args.port), args.token)
+    print(f"serving node {args.node} archives in {args.dir} on {args.bind or '*'}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,282 @@
+"""
+Online R0 calibration of the MQ-4 and TGS2611 against clean air.
+
+MOS sensors drift with age, and their resistance Rs also changes with temperature and
+humidity, so a fixed MQ4_R0/TGS_R0 slowly turns into a ppm offset. Most hours of a
+day the air is clean, i.e. near the ambient CH4 level. Rs is highest then, since Rs
+falls as the gas concentration rises. The calibrator therefore:
+    1. converts each reading to Rs and scales it to reference conditions (20 C, 65 %RH)
+       with a linear temperature/humidity model, using the latest SHT20 reading
+    2. tracks a high quantile of that Rs over an epoch (default one day) with the P²
+       estimator: five markers, no stored samples. The high quantile of Rs is the low
+       percentile of the concentration
+    3. at the end of the epoch maps it to a candidate R0 through the sensor curve at the
+       ambient ppm, and moves R0 a fraction of the way there, limited to max_step
+Readings are converted with the R0 scaled back to the current temperature and humidity.
+
+The state (R0, the running epoch and its markers) is a small JSON file written
+atomically, so a restart continues the epoch and nothing has to re-read the archives.
+
+Example, a month of synthetic drift and daily temperature cycles:
+    python r0_calibration.py --days 30
+"""
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+
+from calibration import VC, mq4_ppm, mq4_ratio
+
+
+class P2Quantile:
+    """
+    Streaming quantile estimate in constant memory (Jain & Chlamtac, 1985).
+
+    Keeps five markers: the minimum, the maximum, the quantile and two points halfway
+    to it, and moves them with piecewise-parabolic steps as readings arrive.
+    """
+
+    __slots__ = ("q", "count", "heights", "positions", "desired", "increments")
+
+    def __init__(self, q):
+        self.q = q
+        self.count = 0
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def add(self, x):
+        h = self.heights
+        self.count += 1
+        if self.count <= 5:
+            h.append(x)
+            if self.count == 5:
+                h.sort()
+            return
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self.desired
+        for i in range(5):
+            desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # parabolic prediction, linear if it would leave the neighbouring markers
+                height = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not h[i - 1] < height < h[i + 1]:
+                    height = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = height
+                n[i] += d
+
+    def value(self):
+        if not self.count:
+            return None
+        if self.count < 5:
+            ordered = sorted(self.heights)
+            return ordered[min(int(self.q * len(ordered)), len(ordered) - 1)]
+        return self.heights[2]
+
+    def state(self):
+        return {"count": self.count, "heights": self.heights, "positions": self.positions, "desired": self.desired}
+
+    def restore(self, state):
+        self.count = state["count"]
+        self.heights = list(state["heights"])
+        self.positions = list(state["positions"])
+        self.desired = list(state["desired"])
+
+
+class R0Calibrator:
+    """Clean-air R0 of one sensor, updated once per epoch from a streaming Rs quantile."""
+
+    def __init__(self, r0, clean_ratio, percentile=0.05, epoch=86400.0, weight=0.2, max_step=0.1,
+                 min_samples=3600, temp_coef=-0.004, hum_coef=-0.0013, ref_temperature=20.0,
+                 ref_humidity=65.0, vc=VC):
+        """
+        Args:
+            r0 (float): Starting R0, from .env or the saved state
+            clean_ratio (float): Rs/R0 of the sensor at the ambient ppm (calibration.mq4_ratio(), ...)
+            percentile (float): Low percentile of the concentration taken as clean air
+            epoch (float): Seconds of readings behind each R0 update
+            weight (float): Fraction of the way R0 moves towards an epoch's candidate
+            max_step (float): Largest relative R0 change per epoch, so a day-long leak cannot
+                drag the calibration far
+            min_samples (int): Readings an epoch needs to update R0
+            temp_coef (float): Relative Rs change per degree C
+            hum_coef (float): Relative Rs change per %RH
+            ref_temperature (float): Temperature R0 refers to
+            ref_humidity (float): Humidity R0 refers to
+            vc (float): Supply voltage of the sensor divider
+        """
+        self.r0 = r0
+        self.clean_ratio = clean_ratio
+        self.percentile = percentile
+        self.epoch = epoch
+        self.weight = weight
+        self.max_step = max_step
+        self.min_samples = min_samples
+        self.temp_coef = temp_coef
+        self.hum_coef = hum_coef
+        self.ref_temperature = ref_temperature
+        self.ref_humidity = ref_humidity
+        self.vc = vc
+        self.epochs = 0
+        self.candidate = None  # R0 suggested by the last complete epoch
+        self.epoch_start = None  # wall clock, so the epoch survives restarts
+        self._rs = P2Quantile(1 - percentile)
+
+    def compensation(self, temperature=None, humidity=None):
+        """Rs at the given conditions relative to Rs at the reference conditions."""
+        factor = 1.0
+        if temperature is not None:
+            factor += self.temp_coef * (temperature - self.ref_temperature)
+        if humidity is not None:
+            factor += self.hum_coef * (humidity - self.ref_humidity)
+        return max(factor, 0.1)
+
+    def effective_r0(self, temperature=None, humidity=None):
+        """R0 to convert readings taken at the given conditions."""
+        return self.r0 * self.compensation(temperature, humidity)
+
+    def update(self, voltage, temperature=None, humidity=None, now=None):
+        """
+        Add one reading.
+
+        Returns:
+            bool: True when an epoch ended and the state should be saved
+        """
+        now = time.time() if now is None else now
+        if self.epoch_start is None:
+            self.epoch_start = now
+        if 0 < voltage < self.vc:  # the rails mean a missing or saturated sensor
+            self._rs.add((self.vc / voltage - 1) / self.compensation(temperature, humidity))
+        if now - self.epoch_start < self.epoch:
+            return False
+        if self._rs.count >= self.min_samples:
+            self.candidate = self._rs.value() / self.clean_ratio
+            step = self.weight * (self.candidate - self.r0)
+            limit = self.max_step * self.r0
+            self.r0 += min(max(step, -limit), limit)
+            self.epochs += 1
+        self._rs = P2Quantile(1 - self.percentile)
+        self.epoch_start = now
+        return True
+
+    def stats(self):
+        return {
+            "r0": round(self.r0, 4),
+            "candidate": round(self.candidate, 4) if self.candidate is not None else None,
+            "epochs": self.epochs,
+            "epoch_samples": self._rs.count,
+        }
+
+    def state(self):
+        return {"r0": self.r0, "candidate": self.candidate, "epochs": self.epochs,
+                "epoch_start": self.epoch_start, "quantile": self._rs.state()}
+
+    def restore(self, state):
+        self.r0 = state["r0"]
+        self.candidate = state.get("candidate")
+        self.epochs = state.get("epochs", 0)
+        self.epoch_start = state.get("epoch_start")
+        self._rs.restore(state["quantile"])
+
+
+_save_lock = threading.Lock()  # the sampling and the network thread both save
+
+
+def load_state(path, calibrators):
+    """
+    Restore calibrators ({name: R0Calibrator}) saved by save_state(); missing names keep their R0.
+
+    Raises:
+        ValueError: The file is empty, truncated or not a saved state; the calibrators are left as they were
+        OSError: The file cannot be read
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as f:
+        text = f.read()
+    before = {name: calibrator.state() for name, calibrator in calibrators.items()}
+    try:
+        saved = json.loads(text)
+        for name, calibrator in calibrators.items():
+            if name in saved:
+                calibrator.restore(saved[name])
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        for name, state in before.items():
+            calibrators[name].restore(state)
+        raise ValueError(f"{path} is not a calibration state: {e!r}") from e
+    return True
+
+
+def save_state(path, calibrators):
+    """Write the calibrators' state atomically; a failed write leaves the previous file in place."""
+    with _save_lock:
+        state = {name: calibrator.state() for name, calibrator in calibrators.items()}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def _simulate(days, true_r0, start_r0, drift, ambient, period, seed=1):
+    """MQ-4 readings with a drifting true R0, daily temperature/humidity cycles and a few leaks."""
+    rng = random.Random(seed)
+    calibrator = R0Calibrator(start_r0, mq4_ratio(ambient), min_samples=int(3600 / period))
+    # the simulated sensor uses the calibrator's own T/RH model, so the error left is the estimator's
+    model = R0Calibrator(1.0, 1.0)
+    start = 1714521600
+    print(f"{'day':>4} {'true R0':>8} {'R0':>8} {'candidate':>10} {'clean-air ppm':>14}")
+    for step in range(int(days * 86400 / period)):
+        now = start + step * period
+        day = step * period / 86400
+        r0 = true_r0 * (1 + drift * day)
+        hour = (now % 86400) / 3600
+        temperature = 20 + 8 * math.sin((hour - 9) / 24 * 2 * math.pi)
+        humidity = 65 - 20 * math.sin((hour - 9) / 24 * 2 * math.pi)
+        # mostly clean air with some noise; a two hour leak every few days
+        ppm = ambient * math.exp(rng.gauss(0, 0.05)) + rng.expovariate(1.0)
+        if int(day) % 4 == 3 and 10 <= hour < 12:
+            ppm += 50
+        rs = r0 * mq4_ratio(ppm) * model.compensation(temperature, humidity)
+        voltage = VC / (1 + rs)
+        if calibrator.update(voltage, temperature, humidity, now) and calibrator.epochs:
+            clean = mq4_ppm(VC / (1 + r0 * mq4_ratio(ambient)), calibrator.r0)
+            print(f"{int(day):>4} {r0:>8.3f} {calibrator.r0:>8.3f} {calibrator.candidate:>10.3f} {float(clean):>14.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the R0 calibration on synthetic MQ-4 drift")
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--true-r0", type=float, default=3.0, help="R0 of the simulated sensor on day 0")
+    parser.add_argument("--start-r0", type=float, default=3.323, help="R0 the calibration starts from")
+    parser.add_argument("--drift", type=float, default=0.005, help="relative R0 drift per day")
+    parser.add_argument("--ambient", type=float, default=2.0, help="clean-air CH4 in ppm")
+    parser.add_argument("--period", type=float, default=10, help="seconds between simulated readings")
+    args = parser.parse_args()
+    _simulate(args.days, args.true_r0, args.start_r0, args.drift, args.ambient, args.period)
@@ -0,0 +1,76 @@
+import csv
+import os
+import time
+
+
+class DailyCsvWriter:
+    """
+    CSV writer that keeps its file open and switches to a new file every UTC day.
+
+    Rows are buffered in memory and written out at most every flush_interval seconds
+    (0 writes every row), optionally followed by an fsync. The header rows are only
+    written when a new, empty daily file is opened.
+    """
+
+    def __init__(self, path_template, header_rows, flush_interval=10.0, fsync=False, buffer_size=65536):
+        """
+        Args:
+            path_template (str): File path with a '{date}' field, filled with YYYYMMDD
+            header_rows (list): Rows written at the top of every new file
+            flush_interval (float): Seconds between flushes to the OS
+            fsync (bool): Also fsync on every flush (safer on power loss, more SD wear)
+            buffer_size (int): Size of the file buffer in bytes
+        """
+        self.path_template = path_template
+        self.header_rows = header_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        self.path = None
+        self._file = None
+        self._writer = None
+        self._day = None
+        self._last_flush = time.monotonic()
+
+    def writerow(self, timestamp, row):
+        """
+        Append a row to the file of the UTC day of timestamp.
+
+        Args:
+            timestamp (datetime): UTC time of the row, selects the daily file
+            row (list): Values to write
+        """
+        day = timestamp.strftime('%Y%m%d')
+        if day != self._day:
+            self._rotate(day)
+        self._writer.writerow(row)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._file is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+            self._writer = None
+            self._day = None
+
+    def _rotate(self, day):
+        self.close()
+        self.path = self.path_template.format(date=day)
+        self._file = open(self.path, 'a', newline='', buffering=self.buffer_size)
+        self._writer = csv.writer(self._file)
+        self._day = day
+        if self._file.tell() == 0:
+            self._writer.writerows(self.header_rows)
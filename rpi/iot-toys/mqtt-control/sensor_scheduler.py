@@ -0,0 +1,111 @@
+import threading
+import time
+
+
+class SensorPoller:
+    """
+    Poll one sensor on its own thread at its own rate.
+
+    A slow or hanging read (e.g. a serial timeout) only delays this poller; the last
+    good values stay available and are flagged stale once they are older than stale_after.
+    """
+
+    def __init__(self, name, read, interval, stale_after=None):
+        """
+        Args:
+            name (str): Prefix of the published fields, e.g. 'SHT20'
+            read (callable): Returns a dict of values, or None if the reading failed
+            interval (float): Seconds between reads
+            stale_after (float): Age in seconds after which values count as stale, default 3 intervals
+        """
+        self.name = name
+        self.read = read
+        self.interval = interval
+        self.stale_after = stale_after if stale_after is not None else 3 * interval
+        self.reads = 0
+        self.errors = 0
+        self._values = None
+        self._time = None  # epoch seconds of the last good reading
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"poll-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def latest(self):
+        """Return (values, epoch seconds) of the last good reading, or (None, None)."""
+        with self._lock:
+            return self._values, self._time
+
+    def _run(self):
+        next_read = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                values = self.read()
+            except Exception as e:
+                print(f"{self.name} read error: {e}")
+                values = None
+            self.reads += 1
+            if values is None:
+                self.errors += 1
+            else:
+                with self._lock:
+                    self._values = values
+                    self._time = time.time()
+            next_read += self.interval
+            # a read that overran its slot starts the schedule over instead of bursting
+            next_read = max(next_read, time.monotonic())
+            self._stop.wait(next_read - time.monotonic())
+
+
+class SensorScheduler:
+    """Run several SensorPollers and merge their latest values into one record."""
+
+    def __init__(self):
+        self.name = "sensors"
+        self.pollers = {}
+
+    def add(self, name, read, interval, stale_after=None):
+        self.pollers[name] = SensorPoller(name, read, interval, stale_after)
+
+    def start(self):
+        for poller in self.pollers.values():
+            poller.start()
+        return self
+
+    def stop(self):
+        for poller in self.pollers.values():
+            poller.stop()
+
+    def latest(self, name):
+        """Last good values of one sensor, or None."""
+        return self.pollers[name].latest()[0]
+
+    def snapshot(self):
+        """
+        Flatten the latest readings for the published record.
+
+        Every sensor contributes '<name>_<field>' values, '<name>_time' (epoch ms of
+        the reading) and '<name>_stale'. A sensor without any reading yet only
+        contributes '<name>_stale': True.
+        """
+        now = time.time()
+        fields = {}
+        for name, poller in self.pollers.items():
+            values, read_time = poller.latest()
+            if values is None:
+                fields[f"{name}_stale"] = True
+                continue
+            for key, value in values.items():
+                fields[f"{name}_{key}"] = value
+            fields[f"{name}_time"] = int(read_time * 1000)
+            fields[f"{name}_stale"] = now - read_time > poller.stale_after
+        return fields
+
+    def stats(self):
+        return {name: {"reads": p.reads, "errors": p.errors} for name, p in self.pollers.items()}
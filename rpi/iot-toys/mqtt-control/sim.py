@@ -0,0 +1,239 @@
+"""
+Hardware-free stand-ins for the node's devices and MQTT client.
+
+They mimic the small part of the adafruit / pyserial / paho APIs the node uses, so
+node_client_thread.py and multisensor.py can be run, tested and profiled on any
+machine, faster than real time.
+"""
+import itertools
+import math
+import random
+import threading
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+# the emulator speaks the driver's own protocol definitions, so it keeps testing the real parser
+from multisensor import MHT7042A_READ_CMD, mht7042a_checksum
+
+
+class FakeChannel:
+    """Stand-in for AnalogIn: every .voltage read returns the next value of a sequence."""
+
+    def __init__(self, values, loop=True):
+        """
+        Args:
+            values (iterable): Voltages to return, e.g. an array or synthetic_voltage()
+            loop (bool): Start over when a finite sequence runs out
+        """
+        self._values = itertools.cycle(values) if loop else iter(values)
+        self.reads = 0
+
+    @property
+    def voltage(self):
+        self.reads += 1
+        return float(next(self._values))
+
+
+class FakeADS:
+    """Stand-in for ADS1115, only holds the settings the node writes."""
+
+    def __init__(self):
+        self.gain = 1
+        self.mode = None
+        self.data_rate = 128
+
+
+class FakeLCD:
+    """Stand-in for rpi_lcd.LCD that keeps the displayed text in memory."""
+
+    def __init__(self, width=16, rows=2):
+        self.width = width
+        self.lines = {row: " " * width for row in range(1, rows + 1)}
+        self.writes = 0
+
+    def text(self, text, line, align='left'):
+        _ = align
+        self.lines[line] = text[:self.width].ljust(self.width)
+        self.writes += self.width
+
+    def write(self, byte, mode=0):
+        _ = byte, mode
+        self.writes += 1
+
+    def clear(self):
+        for row in self.lines:
+            self.lines[row] = " " * self.width
+
+
+def load_voltage_csv(path):
+    """
+    Read a node{node}_YYYYMMDD_voltage.csv archive.
+
+    Returns:
+        tuple: (mq4_voltages, tgs_voltages) NumPy arrays
+    """
+    data = np.genfromtxt(
+        path, delimiter=',', skip_header=2, dtype=None, encoding='utf-8',
+        names=("time", "mq4", "tgs"),
+    )
+    data = np.atleast_1d(data)
+    return data["mq4"].astype(float), data["tgs"].astype(float)
+
+
+def replay_channels(paths):
+    """Build (mq4, tgs) FakeChannels that replay one or more _voltage.csv archives in a loop."""
+    parts = [load_voltage_csv(path) for path in paths]
+    mq4 = np.concatenate([p[0] for p in parts])
+    tgs = np.concatenate([p[1] for p in parts])
+    return FakeChannel(mq4), FakeChannel(tgs)
+
+
+def synthetic_voltage(baseline, amplitude=0.05, period=3600, noise=0.005,
+                      spike_rate=0.0, spike_height=0.5, spike_decay=0.95, sample_period=1.0, seed=None):
+    """
+    Endless synthetic sensor voltage: slow sine drift, Gaussian noise and optional leak spikes.
+
+    Args:
+        baseline (float): Clean-air voltage
+        amplitude (float): Amplitude of the drift
+        period (float): Drift period in seconds
+        noise (float): Standard deviation of the noise
+        spike_rate (float): Probability per sample that a spike starts
+        spike_height (float): Voltage added at the start of a spike
+        spike_decay (float): Factor the spike shrinks by every sample
+        sample_period (float): Seconds between samples
+        seed (int): Random seed for reproducible runs
+    """
+    rng = random.Random(seed)
+    spike = 0.0
+    for n in itertools.count():
+        if spike_rate and rng.random() < spike_rate:
+            spike += spike_height
+        spike *= spike_decay
+        drift = amplitude * math.sin(2 * math.pi * n * sample_period / period)
+        yield baseline + drift + spike + rng.gauss(0, noise)
+
+
+class FakeSerial:
+    """
+    MH-T7042A emulator with the pyserial calls the driver uses.
+
+    Every read command queues a 9-byte response carrying the next ppm value. With
+    noise > 0 random junk bytes are inserted before some responses and some frames
+    get a corrupted checksum, to exercise frame resynchronisation.
+    """
+
+    def __init__(self, ppm_values, noise=0.0, seed=None):
+        self._ppm = itertools.cycle(ppm_values)
+        self.noise = noise
+        self._rng = random.Random(seed)
+        self._rx = bytearray()
+        self._lock = threading.Lock()
+        self._data_ready = threading.Condition(self._lock)
+        self.is_open = True
+        self.timeout = 1
+
+    def write(self, data):
+        if bytes(data) == MHT7042A_READ_CMD:
+            ppm = int(next(self._ppm))
+            frame = bytearray([0xFF, 0x86, (ppm >> 8) & 0xFF, ppm & 0xFF, 0, 0, 0, 0, 0])
+            frame[8] = mht7042a_checksum(frame)
+            if self.noise and self._rng.random() < self.noise:
+                junk = bytes(self._rng.randrange(256) for _ in range(self._rng.randrange(1, 5)))
+                frame = bytearray(junk) + frame
+            if self.noise and self._rng.random() < self.noise:
+                frame[-1] ^= 0x5A
+            with self._data_ready:
+                self._rx += frame
+                self._data_ready.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            return len(self._rx)
+
+    def read(self, size=1):
+        with self._data_ready:
+            if not self._rx and self.timeout:
+                self._data_ready.wait(self.timeout)
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+        return data
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._rx.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeMessageInfo:
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+    def is_published(self):
+        return self.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout=None):
+        _ = timeout
+
+
+class FakeMqttClient:
+    """
+    In-process broker stand-in with the parts of paho's Client the node uses.
+
+    publish() counts messages and bytes per topic and calls on_publish right away,
+    as if the broker acknowledged instantly. Set connected=False to simulate an
+    outage; publishes then fail with MQTT_ERR_NO_CONN like paho's do.
+    """
+
+    def __init__(self, keep_payloads=False):
+        self.connected = True
+        self.keep_payloads = keep_payloads
+        self.payloads = []
+        self.messages = 0
+        self.bytes = 0
+        self.per_topic = {}
+        self.on_publish = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self._mid = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        _ = qos, retain
+        mid = next(self._mid)
+        if not self.connected:
+            return FakeMessageInfo(mqtt.MQTT_ERR_NO_CONN, mid)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(payload or b"")
+            self.per_topic[topic] = self.per_topic.get(topic, 0) + 1
+            if self.keep_payloads:
+                self.payloads.append((topic, payload))
+        if self.on_publish is not None:
+            self.on_publish(self, None, mid)
+        return FakeMessageInfo(mqtt.MQTT_ERR_SUCCESS, mid)
+
+    def subscribe(self, topic, qos=0):
+        _ = topic, qos
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mid)
+
+    def message_callback_add(self, sub, callback):
+        _ = sub, callback
+
+    def username_pw_set(self, username, password=None):
+        _ = username, password
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
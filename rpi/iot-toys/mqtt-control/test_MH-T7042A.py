@@ -1,17 +1,13 @@
-import serial
 import time
+from multisensor import MHT7042A
 
-ser = serial.Serial('/dev/serial0', baudrate=9600, timeout=1)
+sensor = MHT7042A('/dev/serial0', poll_interval=2)
 
 def read_ch4():
     while True:
-        ser.write(b'\xFF\x01\x86\x00\x00\x00\x00\x00\x79')
-        data = ser.read(9)
-        if len(data) == 9 and data[0] == 0xFF and data[1]== 0x86:
-            high = data[2]
-            low = data[3]
-            ch4_ppm = (high << 8) +low
-            print(f"CH4: {ch4_ppm} ppm")
+        ch4_ppm = sensor.read_ch4()
+        if ch4_ppm is not None:
+            print(f"CH4: {ch4_ppm} ppm (frames: {sensor.frames}, bad checksum: {sensor.bad_frames})")
         else:
             print("Invalid resoponse")
         time.sleep(2)
@@ -19,5 +15,5 @@ def read_ch4():
 try:
     read_ch4()
 except KeyboardInterrupt:
-    ser.close()
+    sensor.close()
     print("Stopped")
@@ -0,0 +1,131 @@
+"""
+Server-side decoder for nodes running with WIRE_FORMAT=binary.
+
+Subscribes to bin/#, decodes the wire_format payloads and writes the readings to InfluxDB
+as if Telegraf's mqtt_consumer had read the JSON form: measurement 'mqtt_consumer', tags
+'topic' with the data/... topic and 'host' (INFLUX_HOST_TAG, the hostname telegraf.conf
+pins), and the numbers as float fields ('node' is a string and is dropped, as Telegraf
+does). Existing queries and dashboards see no difference.
+
+Runs next to the docker-compose stack and reads HOST/PORT/USERNAME/PASSWORD (broker) and
+INFLUX_URL/INFLUX_TOKEN/INFLUX_ORG/INFLUX_BUCKET from .env:
+    python wire_bridge.py
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+import influxdb_client
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+from influxdb_client.client.write_api import WriteOptions
+
+import wire_format
+
+load_dotenv()
+
+host = os.getenv("HOST", "localhost")
+port = int(os.getenv("PORT", 1883))
+username = os.getenv("USERNAME", "")
+password = os.getenv("PASSWORD")
+influx_url = os.getenv("INFLUX_URL", "http://localhost:8086")
+influx_token = os.getenv("INFLUX_TOKEN", "")
+influx_org = os.getenv("INFLUX_ORG", "bblab")
+influx_bucket = os.getenv("INFLUX_BUCKET", "sensor_data")
+# 'host' tag of Telegraf's points (its [agent] hostname), empty if it runs with omit_hostname = true
+influx_host_tag = os.getenv("INFLUX_HOST_TAG", "telegraf")
+stats_interval = float(os.getenv("STATS_INTERVAL", 60))
+
+
+class WireBridge:
+    """Decode binary payloads into InfluxDB points and hand them to a batching write API."""
+
+    def __init__(self, write_api, bucket, org, host=None):
+        self.write_api = write_api
+        self.bucket = bucket
+        self.org = org
+        self.host = host
+        self.messages = 0
+        self.points = 0
+        self.bad_payloads = 0
+        self.decode_time = 0.0
+        self._lock = threading.Lock()
+
+    def on_connect(self, client, userdata, flags, rc):
+        _ = userdata, flags
+        if rc != 0:
+            print(f"connect failed: {mqtt.connack_string(rc)}")
+            return
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: connected to {host}:{port}")
+        client.subscribe("bin/#", qos=1)
+
+    def on_message(self, client, userdata, message):
+        _ = client, userdata
+        started = time.perf_counter()
+        try:
+            records = wire_format.decode_batch(message.payload)
+        except ValueError as e:
+            self.bad_payloads += 1
+            print(f"dropping bad payload on {message.topic}: {e}")
+            return
+        # bin/<location>/sensors/<node> -> the topic tag Telegraf gives the JSON form
+        topic = "data/" + message.topic.split("/", 1)[1]
+        points = [self.to_point(topic, record, self.host) for record in records]
+        self.write_api.write(bucket=self.bucket, org=self.org, record=points)
+        with self._lock:
+            self.messages += 1
+            self.points += len(points)
+            self.decode_time += time.perf_counter() - started
+
+    @staticmethod
+    def to_point(topic, record, host=None):
+        point = influxdb_client.Point("mqtt_consumer").tag("topic", topic)
+        if host:
+            # Telegraf tags every point with its hostname; without it these would be other series
+            point.tag("host", host)
+        for key, value in record.items():
+            # strings are dropped like Telegraf's json parser does, run/seq/seq_last like its fielddrop
+            if key in ("node", "timestamp", "run", "seq", "seq_last") or value is None or isinstance(value, str):
+                continue
+            if isinstance(value, int) and not isinstance(value, bool):
+                # Telegraf writes every JSON number as a float; an integer field would be
+                # rejected by InfluxDB as a type conflict wherever Telegraf wrote it first
+                value = float(value)
+            point.field(key, value)
+        return point.time(datetime.strptime(record["timestamp"], wire_format.TIMESTAMP_FORMAT),
+                          influxdb_client.WritePrecision.S)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "messages": self.messages,
+                "points": self.points,
+                "bad_payloads": self.bad_payloads,
+                "decode_us_per_point": round(self.decode_time / max(self.points, 1) * 1e6, 1),
+            }
+
+
+if __name__ == "__main__":
+    influx = influxdb_client.InfluxDBClient(url=influx_url, token=influx_token, org=influx_org)
+    write_api = influx.write_api(write_options=WriteOptions(batch_size=1000, flush_interval=1000))
+    bridge = WireBridge(write_api, influx_bucket, influx_org, influx_host_tag)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="wire-bridge", clean_session=False)
+    client.username_pw_set(username, password)
+    client.on_connect = bridge.on_connect
+    client.on_message = bridge.on_message
+    client.reconnect_delay_set(1, 60)
+    client.connect_async(host, port)
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(stats_interval)
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {bridge.stats()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        write_api.close()
+        influx.close()
@@ -0,0 +1,242 @@
+"""
+Compact binary encoding of reading batches, an alternative to the JSON payloads.
+
+Layout (little-endian):
+    header   magic 0xC4, version, node length (uint8), node (utf-8)
+    blocks   until the end of the payload, one per run of readings with the same fields:
+             field count (uint8), per field its type code and name length (uint8 each) and name
+             (name length 0 is followed by a uint8 index into KNOWN_FIELDS instead of the name),
+             reading count (uint16), then one packed row per reading: epoch ms (int64) followed
+             by the fields ('f' float32, 'q' int64, '?' bool)
+
+A reading with burst std fields takes about 50 bytes instead of about 150 as JSON, and in
+a batch of 60 about 28 bytes per reading, since the field names are sent once per block.
+
+Example (bytes on wire and encode/decode time per reading):
+    python wire_format.py --batches 1 10 60
+"""
+import argparse
+import calendar
+import json
+import math
+import struct
+import time
+from datetime import datetime, timezone
+
+MAGIC = 0xC4
+VERSION = 1
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Field names sent as one byte. Append only: the position is part of the wire format.
+KNOWN_FIELDS = (
+    "MQ4", "TGS", "TGS_voltage", "MQ4_voltage", "MQ4_voltage_std", "TGS_voltage_std", "samples",
+    "MQ4_min", "MQ4_max", "MQ4_std", "TGS_min", "TGS_max", "TGS_std",
+    "TGS_voltage_min", "TGS_voltage_max",
+    "SHT20_temperature", "SHT20_humidity", "SHT20_time", "SHT20_stale",
+    "SGP30_eCO2", "SGP30_TVOC", "SGP30_time", "SGP30_stale",
+    "MHT7042A_CH4", "MHT7042A_time", "MHT7042A_stale",
+    "run", "seq",
+    # window std of aggregation.py; MQ4_std and TGS_std above are from before it was renamed
+    "MQ4_wstd", "TGS_wstd", "TGS_voltage_wstd",
+    "seq_last",
+)
+_KNOWN_INDEX = {name: i for i, name in enumerate(KNOWN_FIELDS)}
+
+_HEADER = struct.Struct("<BBB")
+_FIELD = struct.Struct("<cB")
+_COUNT = struct.Struct("<H")
+_MAX_BLOCK = 0xFFFF
+_row_structs = {}
+
+
+def _type_code(value):
+    if isinstance(value, bool):
+        return b"?"
+    if isinstance(value, int):
+        return b"q"
+    if value is None or isinstance(value, float):
+        return b"f"
+    raise TypeError(f"cannot encode {type(value).__name__} value {value!r}")
+
+
+def _row_struct(codes):
+    row = _row_structs.get(codes)
+    if row is None:
+        row = _row_structs[codes] = struct.Struct("<q" + codes.decode("ascii"))
+    return row
+
+
+def epoch_ms(timestamp):
+    # fixed 'YYYY-mm-ddTHH:MM:SSZ' layout, slicing is several times faster than strptime
+    return calendar.timegm((
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+    )) * 1000
+
+
+def _format_ms(time_ms):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(time_ms // 1000))
+
+
+def encode_batch(records):
+    """
+    Encode readings of one node as a binary payload (drop-in for batching.encode_batch).
+
+    Every reading needs 'node' and 'timestamp'; the other values must be float, int or bool.
+    """
+    node = str(records[0]["node"]).encode("utf-8")
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, len(node)))
+    out += node
+    block_schema = None
+    block_rows = []
+
+    def close_block():
+        if not block_rows:
+            return
+        names, codes = block_schema
+        out.append(len(names))
+        for name, code in zip(names, codes):
+            known = _KNOWN_INDEX.get(name)
+            if known is not None:
+                out.extend(_FIELD.pack(bytes([code]), 0))
+                out.append(known)
+                continue
+            encoded = name.encode("utf-8")
+            out.extend(_FIELD.pack(bytes([code]), len(encoded)))
+            out.extend(encoded)
+        out.extend(_COUNT.pack(len(block_rows)))
+        row = _row_struct(codes)
+        for values in block_rows:
+            out.extend(row.pack(*values))
+
+    for record in records:
+        if str(record["node"]).encode("utf-8") != node:
+            raise ValueError("all readings of a payload must come from the same node")
+        names = tuple(key for key in record if key not in ("node", "timestamp"))
+        codes = b"".join(_type_code(record[name]) for name in names)
+        if (names, codes) != block_schema or len(block_rows) == _MAX_BLOCK:
+            close_block()
+            block_schema = (names, codes)
+            block_rows = []
+        values = [epoch_ms(record["timestamp"])]
+        for name in names:
+            value = record[name]
+            values.append(math.nan if value is None else value)
+        block_rows.append(values)
+    close_block()
+    return bytes(out)
+
+
+def _check_length(payload, offset, size):
+    if offset + size > len(payload):
+        raise ValueError(f"truncated payload: {size} bytes needed at offset {offset}, {len(payload)} in total")
+
+
+def decode_batch(payload):
+    """
+    Decode a payload from encode_batch.
+
+    Returns:
+        list: Readings as dicts, like the JSON form (float32 values rounded to 7 digits)
+
+    Raises:
+        ValueError: The payload is truncated or malformed, so callers only need to catch this
+    """
+    payload = bytes(payload)
+    _check_length(payload, 0, _HEADER.size)
+    magic, version, node_len = _HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"not a version {VERSION} binary payload")
+    offset = _HEADER.size
+    _check_length(payload, offset, node_len)
+    node = payload[offset:offset + node_len].decode("utf-8")  # UnicodeDecodeError is a ValueError
+    offset += node_len
+    records = []
+    while offset < len(payload):
+        field_count = payload[offset]
+        offset += 1
+        names = []
+        codes = b""
+        for _ in range(field_count):
+            _check_length(payload, offset, _FIELD.size)
+            code, name_len = _FIELD.unpack_from(payload, offset)
+            offset += _FIELD.size
+            if code not in (b"f", b"q", b"?"):
+                raise ValueError(f"unknown type code {code!r}")
+            if name_len == 0:
+                _check_length(payload, offset, 1)
+                if payload[offset] >= len(KNOWN_FIELDS):
+                    raise ValueError(f"unknown field index {payload[offset]}")
+                names.append(KNOWN_FIELDS[payload[offset]])
+                offset += 1
+            else:
+                _check_length(payload, offset, name_len)
+                names.append(payload[offset:offset + name_len].decode("utf-8"))
+                offset += name_len
+            codes += code
+        _check_length(payload, offset, _COUNT.size)
+        (count,) = _COUNT.unpack_from(payload, offset)
+        offset += _COUNT.size
+        row = _row_struct(codes)
+        _check_length(payload, offset, count * row.size)
+        floats = [i for i, code in enumerate(codes) if code == ord("f")]
+        for values in row.iter_unpack(payload[offset:offset + count * row.size]):
+            values = list(values)
+            for i in floats:
+                value = values[i + 1]
+                values[i + 1] = None if math.isnan(value) else float(f"{value:.7g}")
+            record = {"node": node}
+            record.update(zip(names, values[1:]))
+            try:
+                record["timestamp"] = _format_ms(values[0])
+            except (OverflowError, OSError) as e:
+                raise ValueError(f"timestamp out of range: {values[0]}") from e
+            records.append(record)
+        offset += count * row.size
+    return records
+
+
+def _sample_records(count):
+    start = 1714521600
+    return [
+        {
+            "node": "04",
+            "MQ4": round(2.1 + 0.01 * (i % 7), 3),
+            "TGS": round(1.9 + 0.01 * (i % 5), 3),
+            "TGS_voltage": round(2.1 + 0.001 * (i % 3), 3),
+            "timestamp": datetime.fromtimestamp(start + i, tz=timezone.utc).strftime(TIMESTAMP_FORMAT),
+            "MQ4_voltage_std": 0.0012,
+            "TGS_voltage_std": 0.0009,
+        }
+        for i in range(count)
+    ]
+
+
+def _time_per_reading(func, arg, readings, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / (repeat * readings) * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare JSON and binary payload size and CPU cost")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 10, 60], help="readings per payload")
+    parser.add_argument("--readings", type=int, default=6000, help="readings encoded per measurement")
+    args = parser.parse_args()
+
+    print(f"{'batch':>6} {'format':>7} {'bytes/reading':>14} {'encode us/reading':>18} {'decode us/reading':>18}")
+    for size in args.batches:
+        records = _sample_records(size)
+        repeat = max(1, args.readings // size)
+        json_payload = json.dumps(records[0]) if size == 1 else json.dumps(records)
+        binary_payload = encode_batch(records)
+        assert decode_batch(binary_payload) == records
+        rows = [
+            ("json", len(json_payload), lambda r: json.dumps(r[0]) if len(r) == 1 else json.dumps(r), json.loads, json_payload),
+            ("binary", len(binary_payload), encode_batch, decode_batch, binary_payload),
+        ]
+        for name, length, encode, decode, payload in rows:
+            print(f"{size:>6} {name:>7} {length / size:>14.1f} "
+                  f"{_time_per_reading(encode, records, size, repeat):>18.2f} "
+                  f"{_time_per_reading(decode, payload, size, repeat):>18.2f}")